@@ -1,54 +1,30 @@
 import os
-import requests 
+import requests
 import fastapi
 import json
 import time
-PC=[
-    {
-        "IP":"129.323.421.313",
-        "status": True
-    },
-    {
-        "IP":"129.323.21.324",
-        "status": True
-    }
-]
+from CommuAI import dispatcher, receive_the_image as complete_job, start_dispatching
+
+#Danh sách máy AI nằm trong dispatcher (CommuAI.AI_NODES + máy tự đăng ký), không còn dict status True/False
 def send_the_image(file_local=None):
-    for unit in PC:
-        if unit['status']==True:
-            #Đẩy dữ liệu vào máy AI
-            print(f'Unit {unit['IP']} is running succesfully')
-            unit["status"]=False
-            #Dùng os để xóa link file_local đấy.
-            return True
-    return False
+    #Đưa ảnh vào hàng đợi, dispatcher chọn máy còn slot và ít tải nhất
+    job_id=dispatcher.submit(file_local)
+    print(f'Queued {file_local} as job {job_id}')
+    return job_id
 
 def receive_the_image(response_from_AI=None):
-    for unit in PC:
-        if response_from_AI['PC']==unit['PC']:
-            folder_under_data=response_from_AI['Image']
-            #Từ đây push dữ liệu vào undatabase
-            #<<<
+    #response_from_AI: {"PC": địa chỉ máy AI, "job_id": ..., "Image": thư mục kết quả}
+    folder_under_data=response_from_AI.get('Image')
+    #Từ đây push dữ liệu vào undatabase
+    #<<<
 
 
 
-            #>>>>
-            unit['status']= True
+    #>>>>
+    return complete_job(response_from_AI['job_id'], response_from_AI.get('PC'))
 
 
 if __name__=="__main__":
-    #Dùng OS để tracking vào trong folder nếu nó tồn tại và có file thì mình sẽ lấy file local bằng filename
-    while True:
-        folder='Undatabase\AIrequest'
-        files =os.listdir(folder)
-        if len(files):
-            for file in files:
-                filename=os.path.join(folder, file)
-                print(filename)
-        else:   
-            print('Chưa có file')
-
-        time.sleep(5)
-    
-
-    
+    #Quét Undatabase/AIrequest và nhận kết quả qua ServerForAI trong cùng một process
+    import ServerForAI
+    ServerForAI.main()
@@ -1,41 +1,125 @@
-import requests
+import http_client
 import time
 import datetime
 import os
+import shutil
+import threading
+from dispatcher import Dispatcher, JOB_TIMEOUT
+from job_queue import JobQueue
+import worker_protocol
 #Địa chi của API của khác có nhiệm vụ đẩy ảnh
 api_url_post='http://127.0.0.1:8188/image/post' #Tiêu chuẩn của đường link sẽ thế này
 
-PC={
-        "129.323.421.313": True
-    ,
-        "129.323.21.324": True
-}
+REQUEST_FOLDER=os.path.join('Undatabase', 'AIrequest')
+FAILED_FOLDER=os.path.join('Undatabase', 'AIfailed')
+RESULT_FOLDER=os.path.join('Undatabase', 'AIService')
+#"stream": nhiều ảnh trong một request, kết quả trả về ngay trong response (worker_protocol.py)
+#"legacy": mỗi ảnh một request /image/post, kết quả gửi về /upload
+AI_PROTOCOL=os.environ.get('AI_PROTOCOL', 'stream')
+#Máy AI gửi kết quả về /upload của ServerForAI.py
+SERVER_URL=os.environ.get('AI_SERVER_URL', 'http://127.0.0.1:5000')
+
+#Các máy AI ban đầu dạng "IP[:port][=số slot]", máy mới tự tham gia qua /nodes/register hoặc /nodes/heartbeat
+AI_NODES=os.environ.get('AI_NODES', '129.323.421.313,129.323.21.324')
+
+def parse_nodes(spec):
+    nodes=[]
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        address, _, slots = item.partition('=')
+        nodes.append((address, int(slots or 1)))
+    return nodes
+
 #Hàm đẩy ảnh vào API vào máy khác
-def Post_image_to_AI(filename, API):
+def Post_image_to_AI(filename, API, job_id=None):
     api_url_post=f'http://{API}/image/post'
     with open(filename, 'rb') as f:
-        response = requests.post(api_url_post, files={'file': f})
-    
+        #Session dùng chung: kết nối tới mỗi máy AI được giữ lại giữa các ảnh
+        response = http_client.post(api_url_post, files={'file': f},
+                                    data={'job_id': job_id or '', 'reply_to': f'{SERVER_URL}/upload'})
+
     if response.status_code == 200:
         print("Ảnh đã được đẩy lên server thành công!")
         print("Phản hồi từ server:", response.json())
+        return True
     else:
         print(f"Không thể đẩy ảnh. Mã lỗi: {response.status_code}")
         print("Phản hồi từ server:", response.text)
-    return
+        return False
 
-if __name__=="__main__":
-    folder='Undatabase\AIrequest'
+def send_the_image(API, job):
+    return Post_image_to_AI(job['path'], API, job['id'])
+
+def result_path(filename, job_id=None):
+    #Ghép job id vào tên: hai ảnh cùng tên từ hai thư mục khác nhau không ghi đè lên nhau
+    name=os.path.basename(filename)
+    return os.path.join(RESULT_FOLDER, f'{job_id}-{name}' if job_id else name)
+
+def save_result(filename, content, job_id=None):
+    os.makedirs(RESULT_FOLDER, exist_ok=True)
+    filepath=result_path(filename, job_id)
+    with open(filepath + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(filepath + '.tmp', filepath)
+    return filepath
+
+def stream_the_images(API, jobs):
+    #Đẩy cả loạt ảnh trong một request, nhận kết quả theo thứ tự máy AI làm xong
+    def on_result(job, header, payload):
+        if header.get('status') == 'done':
+            save_result(header.get('filename') or os.path.basename(job['path']), payload, job['id'])
+            receive_the_image(job['id'], API)
+        else:
+            print(f"Máy {API} không xử lý được {job['path']}: {header.get('error')}")
+            receive_the_image(job['id'], API, success=False)
+    #Read timeout theo AI_JOB_TIMEOUT: một ảnh chậm không làm hỏng cả loạt sau 30s mặc định của HTTP
+    timeout=(http_client.HTTP_TIMEOUT[0], JOB_TIMEOUT)
+    for job in worker_protocol.deliver_stream(API, jobs, on_result, timeout=timeout):
+        receive_the_image(job['id'], API, success=False)
+
+def remove_request_file(job):
+    #Ảnh đã có kết quả thì xóa khỏi thư mục yêu cầu
+    try:
+        os.remove(job['path'])
+    except FileNotFoundError:
+        pass
+
+def move_to_failed(job):
+    #Hết số lần thử: chuyển sang AIfailed để vòng quét sau không gửi lại mãi
+    os.makedirs(FAILED_FOLDER, exist_ok=True)
+    try:
+        shutil.move(job['path'], os.path.join(FAILED_FOLDER, os.path.basename(job['path'])))
+    except FileNotFoundError:
+        pass
+
+#Job được lưu trong SQLite: crash rồi khởi động lại vẫn gửi tiếp đúng các ảnh chưa có kết quả
+senders={'send_batch': stream_the_images} if AI_PROTOCOL == 'stream' else {'send': send_the_image}
+dispatcher=Dispatcher(on_done=remove_request_file, on_failed=move_to_failed,
+                      store=JobQueue(), queue_name='ai-request', **senders)
+for address, slots in parse_nodes(AI_NODES):
+    dispatcher.register(address, slots)
+
+def receive_the_image(job_id, IP=None, success=True):
+    #Máy AI trả kết quả: giải phóng slot của máy đó
+    return dispatcher.complete(job_id, IP, success)
+
+def poll_request_folder(folder=REQUEST_FOLDER, interval=5):
+    os.makedirs(folder, exist_ok=True)
     while True:
-        time.sleep(5)
-        for unit in PC:
-            if PC[unit]== True:
-                files=os.listdir(folder)
-                if not files:
-                    print('Thư mục trống. Vui lòng chờ 5s nữa')
-                    continue
-                file=files[0]
-                filename=os.path.join(folder, file)
-                Post_image_to_AI(filename, unit)
-                PC[unit]=False
+        files=[file for file in os.listdir(folder) if not file.startswith('.')]
+        if not files:
+            print('Thư mục trống. Vui lòng chờ 5s nữa')
+        for file in files:
+            #File đang chờ hoặc đang được xử lý giữ nguyên job id, không bị gửi hai lần
+            dispatcher.submit(os.path.join(folder, file))
+        time.sleep(interval)
+
+def start_dispatching(folder=REQUEST_FOLDER):
+    dispatcher.recover()
+    dispatcher.start()
+    threading.Thread(target=poll_request_folder, args=(folder,), name='ai-request-poll', daemon=True).start()
+    return dispatcher
 
+if __name__=="__main__":
+    #Kết quả trả về qua /upload nên bộ điều phối chạy cùng process với ServerForAI
+    import ServerForAI
+    ServerForAI.main()
@@ -1,27 +1,69 @@
 from flask import Flask, request, jsonify
 import os
-from CommuAI import PC
+import shutil
+import worker_protocol
+from CommuAI import dispatcher, receive_the_image, start_dispatching, save_result, result_path, RESULT_FOLDER
 
 app=Flask(__name__)
 
 #Thư mục lưu trữ ảnh được đẩy lên
-UPLOAD_FOLDER='Undatabase/AIService'
+UPLOAD_FOLDER=RESULT_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+CHUNK_SIZE=1024 * 1024
 
 @app.route('/upload', methods=['POST'])
 def upload_image():
     if 'file' not in request.files:
-        return jsonify({"error": "No file part in the request"}), 400  
+        return jsonify({"error": "No file part in the request"}), 400
     file = request.files['file']
-    IP=request.files['IP']
-    PC[IP]=True
+    IP=request.form.get('IP')
+    job_id=request.form.get('job_id')
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
-    
+
     if file:
-        filepath=os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
-        return jsonify({"message": "File uploaded successfully", "filename": file.filename}), 200
+        filepath=result_path(file.filename, job_id)
+        #Ghi theo từng khối vào file tạm rồi đổi tên, không giữ cả ảnh trong bộ nhớ
+        with open(filepath + '.tmp', 'wb') as f:
+            shutil.copyfileobj(file.stream, f, CHUNK_SIZE)
+        os.replace(filepath + '.tmp', filepath)
+        #Lưu xong mới báo hoàn thành, job trùng (giao lại) chỉ được tính một lần
+        first=receive_the_image(job_id, IP) if job_id else False
+        return jsonify({"message": "File uploaded successfully", "filename": file.filename, "duplicate": bool(job_id) and not first}), 200
+
+@app.route('/upload/stream', methods=['POST'])
+def upload_stream():
+    #Máy AI gửi nhiều kết quả trong một request (frame của worker_protocol), mỗi frame xử lý ngay khi đọc xong
+    IP=request.args.get('IP') or request.remote_addr
+    received=duplicates=failed=0
+    for header, payload in worker_protocol.read_frames(request.stream):
+        job_id=header.get('job_id')
+        if header.get('status', 'done') != 'done':
+            receive_the_image(job_id, IP, success=False)
+            failed+=1
+            continue
+        save_result(header['filename'], payload, job_id)
+        if receive_the_image(job_id, IP):
+            received+=1
+        else:
+            duplicates+=1
+    return jsonify({"received": received, "duplicates": duplicates, "failed": failed}), 200
+
+@app.route('/nodes/register', methods=['POST'])
+@app.route('/nodes/heartbeat', methods=['POST'])
+def node_heartbeat():
+    data=request.get_json(silent=True) or {}
+    address=data.get('address') or request.remote_addr
+    node=dispatcher.heartbeat(address, data.get('capacity'))
+    return jsonify(node.info()), 200
+
+@app.route('/nodes', methods=['GET'])
+def node_status():
+    return jsonify(dispatcher.summary()), 200
+
+def main():
+    start_dispatching()
+    app.run(host='0.0.0.0', port=5000, threaded=True)
 
 if __name__=='__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    main()
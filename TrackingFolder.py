@@ -1,32 +1,25 @@
 import time
+BOOT_STARTED = time.perf_counter()
 import os
+import sys
+import queue
+import random
+import threading
 import json
 import datetime
-import firebase_admin
-from firebase_admin import credentials, firestore as admin_firestore
-from google.auth.credentials import AnonymousCredentials
-from google.cloud import storage as gcs 
+from concurrent.futures import ThreadPoolExecutor
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+from sync_index import SyncIndex, InFlightHashes, file_digest, link_or_copy, content_blob_path, CONTENT_PREFIX
+from firestore_export import FirestoreJSONEncoder, EXPORT_FORMATS, export_collection
+from firebase_clients import get_db, get_bucket, get_metadata_writer
+import firebase_clients
+import metrics
 #Cài đặt môi trường
 os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:8080"
 os.environ["STORAGE_EMULATOR_HOST"] = "http://localhost:9199"
 
-# Cấp quyền vào đâu
-cred = credentials.Certificate("serviceAccount.json")
-firebase_admin.initialize_app(cred, {"projectId": "itsc"})
-
-# Mở cổng lấy xô
-storage_client = gcs.Client(project="itsc", credentials=AnonymousCredentials())
-bucket = storage_client.bucket("itsc.appspot.com")
-
-# Firestore để mà lưu mấy con url lấy hình ảnh ra để làm việc
-tracking= admin_firestore.client()
-
-
-class FirestoreJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if hasattr(obj, 'isoformat'):
-            return obj.isoformat()
-        return super().default(obj)
+# Storage (xô) và Firestore (lưu url của ảnh) chỉ được kết nối khi dùng lần đầu: get_bucket(), get_db()
 
 
 #Chỗ này là để export dữ liệu ảnh vào một folder
@@ -41,15 +34,16 @@ def export_from_storage(blob, filename):
         local_path = os.path.join(local_folder, blob.name.replace('Photobooth/',''))
     os.makedirs(os.path.dirname(local_path), exist_ok=True)
     blob.download_to_filename(local_path)
+    return local_path
 
-def export_from_firestore(filename):
+def export_from_firestore(filename, formats=("json", "ndjson"), incremental=False):
+    # Đọc và ghi mỗi document đúng một lần; incremental chỉ nối thêm document mới hơn lần trước vào .ndjson
     try:
-        docs=tracking.collection(f'{filename}').stream()
-        data=[]
-        for doc in docs:
-            data.append({ "id": doc.id, **doc.to_dict() })
-            with open(f'images/firestore/{filename}.json', 'w', encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2, cls=FirestoreJSONEncoder)
+        report=export_collection(get_db(), filename, formats, incremental)
+        print(f"💾 Exported {report['docs']} docs from {filename} in {report['seconds']:.2f}s "
+              f"({report['docs_per_sec']:.0f} docs/s, {report['bytes'] / 1024:.0f} KB)"
+              f"{' since last export' if report['incremental'] else ''}")
+        return report
     except Exception as e:
         print(e)
 
@@ -59,14 +53,14 @@ def import_to_storage():
             for file_name in files:
                 local_path=root+'/'+file_name
                 url_file_location=f"Original/{file_name}"
-                blob=bucket.blob(url_file_location)
+                blob=get_bucket().blob(url_file_location)
                 blob.upload_from_filename(local_path)
         
         for root,_,files in os.walk('images/AIService'):
             for file_name in files:
                 local_path=root+'/'+file_name
                 url_file_location=f"AIService/{file_name}"
-                blob=bucket.blob(url_file_location)
+                blob=get_bucket().blob(url_file_location)
                 blob.upload_from_filename(local_path)
 
     except:
@@ -74,87 +68,277 @@ def import_to_storage():
         
 
 #-----------------------------------------------Chỗ này là để bên AI đẩy dữ liệu vào đây---------------------------------------------------
-def update_to_firestore_gallery_collection(blob, folder):
+def gallery_doc_id(storage_path):
+    return storage_path.replace('/','_').replace('.', '_')
+
+def update_to_firestore_gallery_collection(blob, folder, sha256=None, blob_path=None, on_failed=None, landed_at=None):
     try:
         now = datetime.datetime.now()
+        # File trùng nội dung thì trỏ url về object đã có sẵn trong Storage
+        blob_path = blob_path or blob.name
         data={
             'name': blob.name,
-            'url':f"https://localhost:9199/v0/b/{blob.bucket.name}/o/{blob.name.replace('/', '%2F')}?alt=media",
+            'url':f"https://localhost:9199/v0/b/{blob.bucket.name}/o/{blob_path.replace('/', '%2F')}?alt=media",
             'time': now
         } 
-        doc_id=blob.name.replace('/','_').replace('.', '_')
-        if folder=="Original":
-            tracking.collection('Original').document(doc_id).set(data)
-        elif folder=="AIService":
-            tracking.collection('AIService').document(doc_id).set(data)
-        else:
-            tracking.collection('Photobooth').document(doc_id).set(data)
+        if sha256:
+            data['contentHash'] = sha256
+            data['blobPath'] = blob_path
+            data['traceId'] = metrics.trace_id(sha256)
+        if landed_at is not None:
+            # Lúc file xuất hiện trong Undatabase: API đo độ trễ end-to-end khi listener nhận doc này
+            data['landedAt'] = landed_at
+        doc_id=gallery_doc_id(blob.name)
+        if folder not in ("Original", "AIService"):
+            folder = "Photobooth"
+        # Gom lại ghi theo batch thay vì mỗi file một round trip
+        get_metadata_writer().set(get_db().collection(folder).document(doc_id), data, on_failed=on_failed)
 
         #export_from_storage()
     except Exception as e:
         print(f"Skibidi: {e}")
 
-def upload_file_to_storage(file_name, folder):
-    if folder=='Original':
-        url_file_location="Original"+'/'+file_name
-        blob = bucket.blob(url_file_location)
-        blob.upload_from_filename('Undatabase/Original'+'/'+file_name)
-        export_from_storage(blob, 'Original')
-        update_to_firestore_gallery_collection(blob, folder)
-
-    elif folder=='AIService':
-        url_file_location="AIService"+'/'+file_name
-        blob = bucket.blob(url_file_location)
-        blob.upload_from_filename('Undatabase/AIService'+'/'+file_name)
-        export_from_storage(blob, 'AIService')
-        update_to_firestore_gallery_collection(blob, folder)
-    else:
-        url_file_location="Photobooth"+'/'+file_name
-        blob = bucket.blob(url_file_location)
-        blob.upload_from_filename('Undatabase/Photobooth'+'/'+file_name)
-        export_from_storage(blob, 'Photobooth')
-        update_to_firestore_gallery_collection(blob, folder)
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# Upload song song: nhiều transfer cùng lúc, tự thử lại khi lỗi mạng
+
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 8))
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", 3))
+UPLOAD_BACKOFF = float(os.environ.get("UPLOAD_BACKOFF", 0.5))
+PAUSE_POLL_INTERVAL = 0.05
+
+class UploadProgress:
+    """Thread-safe counters for a batch of uploads with a periodic throughput line"""
+
+    def __init__(self, total, label, report_every=2.0):
+        self.total = total
+        self.label = label
+        self.report_every = report_every
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    def record(self, size, success):
+        with self.lock:
+            if success:
+                self.done += 1
+                self.bytes += size
+            else:
+                self.failed += 1
+            now = time.perf_counter()
+            if now - self.last_report >= self.report_every:
+                self.last_report = now
+                print(self.line(now))
+
+    def line(self, now=None):
+        elapsed = max((now or time.perf_counter()) - self.started, 1e-6)
+        return (f"📊 {self.label}: {self.done + self.failed}/{self.total} "
+                f"({self.failed} failed) | {self.done / elapsed:.1f} files/s | "
+                f"{self.bytes / elapsed / 1024 / 1024:.2f} MB/s | {elapsed:.1f}s")
+
+def upload_with_retry(blob, local_path, retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF):
+    """Upload one file, retrying with exponential backoff"""
+    for attempt in range(retries + 1):
+        try:
+            with metrics.stage("storage_upload"):
+                blob.upload_from_filename(local_path)
+            metrics.add_bytes("storage_upload", os.path.getsize(local_path))
+            return
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt) * (1 + random.random() * 0.25)
+            print(f"🔁 Retry {attempt + 1}/{retries} for {blob.name} in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+def upload_files_concurrently(jobs, label, workers=UPLOAD_WORKERS, pause=None):
+    """Upload [(local_path, storage_folder, file_name, size, mtime_ns, sha256)] in parallel.
+
+    sha256 may be None: the file is then hashed by the upload worker, so
+    hashing runs in parallel with the transfers. Each finished transfer writes its Firestore doc and is recorded in the
+    sync index, so an interrupted batch resumes where it stopped. While
+    pause() returns True no new transfer is started.
+    """
+    if not jobs:
+        return
+    progress = UploadProgress(len(jobs), label)
+
+    def upload_one(job):
+        while pause and pause():
+            time.sleep(PAUSE_POLL_INTERVAL)
+        local_path, storage_folder, file_name, size, mtime_ns, sha256 = job
+        url_file_location = f"{storage_folder}/{file_name}"
+        try:
+            if sha256 is None:
+                with metrics.stage("hash"):
+                    sha256 = file_digest(local_path)
+            blob = get_bucket().blob(url_file_location)
+            blob_path, uploaded = upload_unless_known(url_file_location, local_path, sha256)
+            sync_index.mark_synced(url_file_location, size, mtime_ns, sha256, blob_path)
+            update_to_firestore_gallery_collection(blob, storage_folder, sha256, blob_path,
+                                                   on_failed=lambda: forget_failed_doc(url_file_location))
+            progress.record(size if uploaded else 0, True)
+        except Exception as e:
+            print(f"❌ Error syncing {url_file_location}: {e}")
+            progress.record(size, False)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload") as executor:
+        list(executor.map(upload_one, jobs))
+    print(progress.line())
+
+# Lưu theo nội dung: byte được upload một lần vào blobs/<sha256>, mọi doc cùng nội dung trỏ tới đó.
+# Object theo hash không bao giờ bị ghi đè bằng nội dung khác, đổi file cùng tên không ảnh hưởng doc cũ.
+inflight_hashes = InFlightHashes()
+
+def upload_unless_known(storage_path, local_path, sha256):
+    """Upload the bytes to their content-addressed blob unless Storage already holds them.
+
+    Returns (blob_path, uploaded). The hash is recorded in the sync index
+    before the in-flight lock is released, so a worker waiting on the same
+    content finds it instead of uploading it again.
+    """
+    owner = inflight_hashes.acquire(sha256)
+    try:
+        existing = sync_index.find_by_hash(sha256)
+        if existing:
+            print(f"♻️  {storage_path} has the same content as {existing}, skipped upload")
+            return existing, False
+        blob_path = content_blob_path(sha256)
+        upload_with_retry(get_bucket().blob(blob_path), local_path)
+        sync_index.mark_blob(sha256, blob_path)
+        return blob_path, True
+    finally:
+        if owner:
+            inflight_hashes.release(sha256)
+
+def forget_failed_doc(storage_path):
+    """The gallery doc was dropped: forget the file so the next sync pass uploads and writes it again"""
+    print(f"❌ Firestore doc for {storage_path} was dropped, will retry on the next sync")
+    sync_index.forget([storage_path])
+
+def mark_local_copy_synced(storage_path, local_path, sha256, blob_path=None):
+    """Record the images/ copy as already uploaded so the next sync pass skips it"""
+    stat = os.stat(local_path)
+    sync_index.mark_synced(storage_path, stat.st_size, stat.st_mtime_ns, sha256, blob_path)
+
+def upload_file_to_storage(file_name, folder, landed_at=None):
+    """Upload one Undatabase file; landed_at is when the watcher or sweep first saw it (epoch seconds)"""
+    if folder not in ('Original', 'AIService'):
+        folder = 'Photobooth'
+    source_path = f'Undatabase/{folder}/{file_name}'
+    url_file_location = f"{folder}/{file_name}"
+    blob = get_bucket().blob(url_file_location)
+    with metrics.stage("hash"):
+        sha256 = file_digest(source_path)
+    blob_path, _ = upload_unless_known(url_file_location, source_path, sha256)
+    
+    # Bản trong images/ chính là những byte vừa upload: không cần tải lại từ Storage.
+    # Nội dung đã có sẵn ở images/ thì hard-link tới bản đó.
+    local_path = os.path.join('images', folder, file_name)
+    if not (os.path.exists(local_path) and file_digest(local_path) == sha256):
+        same_content = sync_index.local_path_by_hash(sha256)
+        canonical_path = os.path.join('images', *same_content.split('/')) if same_content else None
+        if same_content != url_file_location and canonical_path and os.path.exists(canonical_path) \
+                and file_digest(canonical_path) == sha256:
+            link_or_copy(canonical_path, local_path)
+        else:
+            link_or_copy(source_path, local_path)
+    mark_local_copy_synced(url_file_location, local_path, sha256, blob_path)
+    update_to_firestore_gallery_collection(blob, folder, sha256, blob_path,
+                                           on_failed=lambda: forget_failed_doc(url_file_location), landed_at=landed_at)
+    return sha256
 
 #-------------------------------------------------------------------------------------------------------------------------------------------#
 
-def sync_images_folders_to_storage():
-    """Monitor images/ folders and sync new files to Firebase Storage"""
+# Chỉ list toàn bộ bucket khi cần đối chiếu, mặc định 1 tiếng một lần
+FULL_RECONCILE_INTERVAL = int(os.environ.get("FULL_RECONCILE_INTERVAL", 3600))
+
+sync_index = SyncIndex()
+
+def sync_images_folders_to_storage(full_reconcile=False, workers=UPLOAD_WORKERS, pause=None, label="Auto-sync"):
+    """Monitor images/ folders and sync new or changed files to Firebase Storage.
+
+    Normal passes only stat the local folders against the sync index.
+    With full_reconcile=True the bucket is listed as well, and anything the
+    index thinks is uploaded but Storage doesn't have gets pushed again;
+    gallery docs missing from Firestore are rewritten.
+    """
     folders_to_check = [
         ('images/Original', 'Original'),
         ('images/AIService', 'AIService'), 
         ('images/Photobooth', 'Photobooth')
     ]
     
+    if full_reconcile:
+        # Các file đã dedup trỏ tới blobs/<sha256>: object mất thì mọi file tham chiếu phải upload lại
+        try:
+            blobs = get_bucket().list_blobs(prefix=f"{CONTENT_PREFIX}/")
+            missing = sync_index.reconcile(CONTENT_PREFIX, {blob.name[len(CONTENT_PREFIX) + 1:] for blob in blobs})
+            if missing:
+                print(f"🔁 {len(missing)} files point at content missing from Storage")
+        except Exception as e:
+            print(f"❌ Error checking {CONTENT_PREFIX}/: {e}")
+    
+    jobs = []
     for local_folder, storage_folder in folders_to_check:
         if os.path.exists(local_folder):
             try:
-                # Get list of files in Firebase Storage for this folder
-                blobs = list(bucket.list_blobs(prefix=f"{storage_folder}/"))
-                storage_files = {blob.name.replace(f"{storage_folder}/", "") for blob in blobs}
+                if full_reconcile:
+                    blobs = get_bucket().list_blobs(prefix=f"{storage_folder}/")
+                    storage_files = {blob.name.replace(f"{storage_folder}/", "") for blob in blobs}
+                    missing = sync_index.reconcile(storage_folder, storage_files)
+                    if missing:
+                        print(f"🔁 {len(missing)} files missing from Storage in {storage_folder}")
                 
-                # Get list of files in local folder
-                local_files = [f for f in os.listdir(local_folder) if os.path.isfile(os.path.join(local_folder, f))]
+                    rewritten = rewrite_missing_gallery_docs(storage_folder)
+                    if rewritten:
+                        print(f"📝 Rewrote {rewritten} gallery docs missing from Firestore in {storage_folder}")
                 
-                # Find files that are in local but not in storage
-                new_files = [f for f in local_files if f not in storage_files]
+                new_files = sync_index.changed_files(local_folder, storage_folder)
                 
                 if new_files:
                     print(f"🆕 Found {len(new_files)} new files in {local_folder}")
-                    for file_name in new_files:
-                        try:
-                            local_path = os.path.join(local_folder, file_name)
-                            url_file_location = f"{storage_folder}/{file_name}"
-                            blob = bucket.blob(url_file_location)
-                            blob.upload_from_filename(local_path)
-                            update_to_firestore_gallery_collection(blob, storage_folder)
-                            print(f"✅ Auto-synced {storage_folder}: {file_name}")
-                        except Exception as e:
-                            print(f"❌ Error auto-syncing {storage_folder}/{file_name}: {e}")
+                    jobs.extend((local_path, storage_folder, file_name, size, mtime_ns, sha256)
+                                for file_name, local_path, size, mtime_ns, sha256 in new_files)
                 else:
                     print(f"✅ {local_folder} - All files synced")
                     
             except Exception as e:
                 print(f"❌ Error checking {local_folder}: {e}")
+    
+    upload_files_concurrently(jobs, label, workers, pause)
+
+def rewrite_missing_gallery_docs(storage_folder):
+    """Write the gallery doc again for every synced file whose doc is gone (e.g. a wiped emulator)"""
+    existing = {doc.id for doc in get_db().collection(storage_folder).select([]).stream()}
+    rewritten = 0
+    for storage_path, sha256, blob_path in sync_index.entries_with_prefix(f"{storage_folder}/"):
+        if gallery_doc_id(storage_path) in existing:
+            continue
+        update_to_firestore_gallery_collection(get_bucket().blob(storage_path), storage_folder, sha256, blob_path,
+                                               on_failed=lambda path=storage_path: forget_failed_doc(path))
+        rewritten += 1
+    return rewritten
+
+def backfill_missing_time(collections=("Original", "AIService", "Photobooth")):
+    """Give legacy gallery docs without a `time` field their creation time.
+
+    Pages of /api/collections are ordered by time, and Firestore leaves
+    documents without that field out of such queries, so until this runs
+    they are not listed at all.
+    """
+    writer = get_metadata_writer()
+    filled = 0
+    for name in collections:
+        for doc in get_db().collection(name).select(["time"]).stream():
+            if doc.to_dict().get("time") is None:
+                writer.set(doc.reference, {"time": doc.create_time}, merge=True)
+                filled += 1
+    writer.flush()
+    print(f"🕒 Added a time to {filled} docs")
+    return filled
 
 #-------------------------------------------------------------------------------------------------------------------------------------------#
 
@@ -162,57 +346,270 @@ def sync_existing_files_to_storage():
     """Sync all existing files in images/ folders to Firebase Storage"""
     print("🔄 Syncing existing files to Firebase Storage...")
     
-    # Sync Original folder
-    original_path = 'images/Original'
-    if os.path.exists(original_path):
-        files = [f for f in os.listdir(original_path) if os.path.isfile(os.path.join(original_path, f))]
-        print(f"📂 Found {len(files)} files in {original_path}")
-        for file_name in files:
-            try:
-                local_path = os.path.join(original_path, file_name)
-                url_file_location = f"Original/{file_name}"
-                blob = bucket.blob(url_file_location)
-                blob.upload_from_filename(local_path)
-                update_to_firestore_gallery_collection(blob, 'Original')
-                print(f"✅ Synced Original: {file_name}")
-            except Exception as e:
-                print(f"❌ Error syncing Original/{file_name}: {e}")
+    jobs = []
+    for storage_folder in ('Original', 'AIService', 'Photobooth'):
+        local_folder = f'images/{storage_folder}'
+        if not os.path.exists(local_folder):
+            continue
+        count = 0
+        with os.scandir(local_folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                stat = entry.stat()
+                # Hash tính trong upload worker, song song với việc upload
+                jobs.append((entry.path, storage_folder, entry.name, stat.st_size, stat.st_mtime_ns, None))
+                count += 1
+        print(f"📂 Found {count} files in {local_folder}")
     
-    # Sync AIService folder  
-    aiservice_path = 'images/AIService'
-    if os.path.exists(aiservice_path):
-        files = [f for f in os.listdir(aiservice_path) if os.path.isfile(os.path.join(aiservice_path, f))]
-        print(f"📂 Found {len(files)} files in {aiservice_path}")
-        for file_name in files:
-            try:
-                local_path = os.path.join(aiservice_path, file_name)
-                url_file_location = f"AIService/{file_name}"
-                blob = bucket.blob(url_file_location)
-                blob.upload_from_filename(local_path)
-                update_to_firestore_gallery_collection(blob, 'AIService')
-                print(f"✅ Synced AIService: {file_name}")
-            except Exception as e:
-                print(f"❌ Error syncing AIService/{file_name}: {e}")
-    
-    # Sync Photobooth folder
-    photobooth_path = 'images/Photobooth'
-    if os.path.exists(photobooth_path):
-        files = [f for f in os.listdir(photobooth_path) if os.path.isfile(os.path.join(photobooth_path, f))]
-        print(f"📂 Found {len(files)} files in {photobooth_path}")
-        for file_name in files:
+    upload_files_concurrently(jobs, "Initial sync")
+    print("🎉 Sync completed!")
+
+# Đối chiếu lúc khởi động chạy nền với ít worker và nhường cho file mới trong Undatabase
+BACKGROUND_SYNC_WORKERS = int(os.environ.get("BACKGROUND_SYNC_WORKERS", 2))
+
+def start_background_sync(ingestor):
+    """Full reconcile of images/ against Storage and Firestore on a daemon thread while new files keep flowing.
+
+    Like the blocking startup sync it repairs a wiped emulator: objects
+    missing from the bucket are uploaded again and missing gallery docs are
+    rewritten. Uploads use BACKGROUND_SYNC_WORKERS transfers, and none is
+    started while the ingestor has work in flight.
+    """
+    def run():
+        started = time.perf_counter()
+        try:
+            with metrics.stage("initial_sync"):
+                sync_images_folders_to_storage(full_reconcile=True, workers=BACKGROUND_SYNC_WORKERS,
+                                               pause=ingestor.busy, label="Background sync")
+            print(f"🎉 Background sync completed in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            print(f"❌ Background sync failed: {e}")
+
+    thread = threading.Thread(target=run, name="background-sync", daemon=True)
+    thread.start()
+    return thread
+
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# Nhận file từ Undatabase theo sự kiện (watchdog), quét định kỳ chỉ còn là phương án dự phòng
+
+UNDATABASE_FOLDERS = ['Original', 'AIService', 'Photobooth']
+# File gốc bị xóa sau khi upload: chỉ coi là ghi xong khi size và mtime đứng yên qua nhiều lần đo liên tiếp
+FILE_STABLE_INTERVAL = float(os.environ.get("FILE_STABLE_INTERVAL", 0.5))
+FILE_STABLE_CHECKS = int(os.environ.get("FILE_STABLE_CHECKS", 3))
+FILE_STABLE_TIMEOUT = float(os.environ.get("FILE_STABLE_TIMEOUT", 30))
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", 5))
+# File không ổn định (0 byte, ghi dở mãi) được thử lại thưa dần, rồi chuyển vào quarantine
+UNSTABLE_RETRY_BACKOFF = float(os.environ.get("UNSTABLE_RETRY_BACKOFF", 10))
+UNSTABLE_RETRY_MAX = float(os.environ.get("UNSTABLE_RETRY_MAX", 600))
+UNSTABLE_QUARANTINE_AFTER = int(os.environ.get("UNSTABLE_QUARANTINE_AFTER", 5))
+QUARANTINE_FOLDER = 'Undatabase/.quarantine'
+
+def _open_elsewhere(file_path):
+    """Windows only: True while another process still holds the file open (an unshared open fails)"""
+    import ctypes
+    from ctypes import wintypes
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.CreateFileW.argtypes = (wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, ctypes.c_void_p,
+                                     wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE)
+    kernel32.CreateFileW.restype = wintypes.HANDLE
+    GENERIC_READ, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL = 0x80000000, 3, 0x80
+    handle = kernel32.CreateFileW(os.path.abspath(file_path), GENERIC_READ, 0, None, OPEN_EXISTING,
+                                  FILE_ATTRIBUTE_NORMAL, None)
+    if handle == wintypes.HANDLE(-1).value:
+        return True
+    kernel32.CloseHandle(handle)
+    return False
+
+def wait_until_stable(file_path, interval=FILE_STABLE_INTERVAL, checks=FILE_STABLE_CHECKS, timeout=FILE_STABLE_TIMEOUT):
+    """Return True once size and mtime stay unchanged for `checks` re-reads `interval` apart.
+
+    The source is deleted after upload, so a writer that merely pauses
+    must not look finished: the readings span checks * interval seconds,
+    and on Windows the file must also open without sharing.
+    """
+    deadline = time.monotonic() + timeout
+    last, same = None, 0
+    while time.monotonic() < deadline:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        current = (stat.st_size, stat.st_mtime_ns)
+        same = same + 1 if current == last and stat.st_size > 0 else 0
+        last = current
+        if same >= checks and not (os.name == 'nt' and _open_elsewhere(file_path)):
+            return True
+        time.sleep(interval)
+    return False
+
+class UndatabaseIngestor:
+    """Single queue that both the watchdog events and the fallback sweep feed into.
+
+    A file that never settles is not re-queued by every sweep: it backs off
+    exponentially, and after UNSTABLE_QUARANTINE_AFTER attempts without its
+    size changing it is moved to QUARANTINE_FOLDER.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.in_flight = set()
+        self.unstable = {}  # path -> (số lần thử không tiến triển, size lần cuối, thời điểm được thử lại)
+        # Lúc event/sweep thấy file lần đầu: mtime không dùng được vì move/copy giữ nguyên mtime cũ
+        self.first_seen = {}
+        self.lock = threading.Lock()
+        metrics.track_queue("undatabase_ingest", self.jobs.qsize)
+
+    def start(self, workers=UPLOAD_WORKERS):
+        for index in range(workers):
+            threading.Thread(target=self._worker, name=f"undatabase-ingest-{index}", daemon=True).start()
+
+    def submit(self, file_path, folder):
+        file_path = os.path.normpath(file_path)
+        with self.lock:
+            self.first_seen.setdefault(file_path, time.time())
+            if file_path in self.in_flight:
+                return False
+            entry = self.unstable.get(file_path)
+            if entry and time.monotonic() < entry[2]:
+                return False
+            self.in_flight.add(file_path)
+        self.jobs.put((file_path, folder))
+        return True
+
+    def busy(self):
+        with self.lock:
+            return bool(self.in_flight)
+
+    def _worker(self):
+        while True:
+            file_path, folder = self.jobs.get()
             try:
-                local_path = os.path.join(photobooth_path, file_name)
-                url_file_location = f"Photobooth/{file_name}"
-                blob = bucket.blob(url_file_location)
-                blob.upload_from_filename(local_path)
-                update_to_firestore_gallery_collection(blob, 'Photobooth')
-                print(f"✅ Synced Photobooth: {file_name}")
+                self._ingest(file_path, folder)
             except Exception as e:
-                print(f"❌ Error syncing Photobooth/{file_name}: {e}")
-    
-    print("🎉 Sync completed!")
+                print(f"❌ Error ingesting {file_path}: {e}")
+            finally:
+                with self.lock:
+                    self.in_flight.discard(file_path)
+                self.jobs.task_done()
+
+    def _ingest(self, file_path, folder):
+        with metrics.stage("ingest_settle"):
+            stable = wait_until_stable(file_path)
+        if not stable:
+            self._unstable(file_path, folder)
+            return
+        with self.lock:
+            self.unstable.pop(file_path, None)
+            landed_at = self.first_seen.get(file_path)
+        file_name = os.path.basename(file_path)
+        started = time.perf_counter()
+        print(f"📤 Uploading: {file_path}")
+        sha256 = upload_file_to_storage(file_name, folder, landed_at)
+        os.remove(file_path)
+        with self.lock:
+            self.first_seen.pop(file_path, None)
+        seconds = time.perf_counter() - started
+        metrics.observe_stage("ingest", seconds)
+        print(f"✅ [{metrics.trace_id(sha256)}] Processed: {file_name} ({seconds:.2f}s)")
+
+    def _unstable(self, file_path, folder):
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            with self.lock:
+                self.unstable.pop(file_path, None)
+                self.first_seen.pop(file_path, None)
+            return
+        with self.lock:
+            failures, last_size, _ = self.unstable.get(file_path, (0, None, 0))
+            # File vẫn đang lớn dần thì không tính là kẹt
+            failures = failures + 1 if size == last_size else 1
+            delay = min(UNSTABLE_RETRY_BACKOFF * 2 ** (failures - 1), UNSTABLE_RETRY_MAX)
+            self.unstable[file_path] = (failures, size, time.monotonic() + delay)
+        metrics.count("undatabase_unstable")
+        if failures < UNSTABLE_QUARANTINE_AFTER:
+            print(f"⚠️  {file_path} is not stable yet ({size} bytes), retrying in {delay:.0f}s")
+            return
+        target_dir = os.path.join(QUARANTINE_FOLDER, folder)
+        os.makedirs(target_dir, exist_ok=True)
+        try:
+            os.replace(file_path, os.path.join(target_dir, os.path.basename(file_path)))
+        except OSError as e:
+            print(f"❌ Could not quarantine {file_path}: {e}")
+            return
+        with self.lock:
+            self.unstable.pop(file_path, None)
+            self.first_seen.pop(file_path, None)
+        metrics.count("undatabase_quarantined")
+        print(f"🚫 {file_path} stayed at {size} bytes for {failures} attempts, moved to {target_dir}")
+
+class UndatabaseWatcher(FileSystemEventHandler):
+    def __init__(self, ingestor, folder):
+        self.ingestor = ingestor
+        self.folder = folder
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.ingestor.submit(event.src_path, self.folder)
+
+    def on_moved(self, event):
+        # File được copy xong rồi rename vào thư mục cũng phải bắt được
+        if not event.is_directory:
+            self.ingestor.submit(event.dest_path, self.folder)
+
+def start_undatabase_observer(ingestor):
+    observer = Observer()
+    for folder in UNDATABASE_FOLDERS:
+        path = f'Undatabase/{folder}'
+        os.makedirs(path, exist_ok=True)
+        observer.schedule(UndatabaseWatcher(ingestor, folder), path, recursive=False)
+    observer.start()
+    return observer
+
+def sweep_undatabase_folders(ingestor):
+    """Queue every file still sitting in Undatabase (fallback for missed events)"""
+    queued = 0
+    for folder in UNDATABASE_FOLDERS:
+        path = f'Undatabase/{folder}'
+        if not os.path.exists(path):
+            print(f"📂 Creating {path}...")
+            os.makedirs(path, exist_ok=True)
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file() and ingestor.submit(entry.path, folder):
+                    queued += 1
+    if queued:
+        print(f"📂 Sweep queued {queued} files from Undatabase")
+
+metrics.startup("TrackingFolder", "imported", BOOT_STARTED)
 
 if __name__=="__main__":
+    if "--export" in sys.argv:
+        # Sao lưu các collection rồi thoát: --export [--incremental] [--columnar]
+        formats=EXPORT_FORMATS if "--columnar" in sys.argv else ("json", "ndjson")
+        for name in ("Original", "AIService", "Photobooth"):
+            export_from_firestore(name, formats, incremental="--incremental" in sys.argv)
+        sys.exit(0)
+    
+    if "--backfill-time" in sys.argv:
+        # Doc cũ không có trường time không hiện trong API phân trang: lấy thời điểm tạo doc làm time
+        backfill_missing_time()
+        firebase_clients.close()
+        sys.exit(0)
+    
+    if "--reconcile" in sys.argv:
+        # Đối chiếu toàn bộ với Storage theo yêu cầu rồi thoát
+        print("🔁 Full reconcile against Firebase Storage...")
+        sync_images_folders_to_storage(full_reconcile=True)
+        sys.exit(0)
+    
+    # --poll: chỉ dùng vòng quét như cũ, không dùng watchdog
+    polling_only = "--poll" in sys.argv
+    # --sync-first: đồng bộ hết images/ rồi mới bắt đầu theo dõi, như trước đây
+    sync_first = "--sync-first" in sys.argv
+    
     print("🚀 TrackingFolder Started!")
     print("👀 Monitoring Undatabase folders...")
     print("📁 Original: Undatabase/Original → images/Original → Firebase Storage")  
@@ -220,80 +617,53 @@ if __name__=="__main__":
     print("📸 Photobooth: Undatabase/Photobooth → images/Photobooth → Firebase Storage")
     print("=" * 50)
     
-    # First, sync all existing files to Firebase Storage
-    sync_existing_files_to_storage()
-    print("=" * 50)
-    print("👀 Starting continuous monitoring...")
+    if sync_first:
+        with metrics.stage("initial_sync"):
+            sync_existing_files_to_storage()
+        print("=" * 50)
     
-    while True:
-        try:
-            print("🔍 Checking Undatabase folders...")
-            
-            # Check Original folder
-            folder='Undatabase/Original'
-            if os.path.exists(folder):
-                files=os.listdir(folder)
-                if files:
-                    print(f"📂 Processing {len(files)} files in {folder}")
-                    for root, __, files in os.walk(folder):
-                        for file_name in files:
-                            file_path = root+'/'+file_name
-                            print(f"📤 Uploading: {file_path}")
-                            upload_file_to_storage(file_name, 'Original')
-                            os.remove(file_path)
-                            print(f"✅ Processed: {file_name}")
-                else:
-                    print(f"📂 {folder} is empty")
-            else:
-                print(f"📂 Creating {folder}...")
-                os.makedirs(folder, exist_ok=True)
-            
-            # Check AIService folder
-            folder='Undatabase/AIService'
-            if os.path.exists(folder):
-                files=os.listdir(folder)
-                if files:
-                    print(f"📂 Processing {len(files)} files in {folder}")
-                    for root, __, files in os.walk(folder):
-                        for file_name in files:
-                            file_path = root+'/'+file_name
-                            print(f"📤 Uploading: {file_path}")
-                            upload_file_to_storage(file_name, 'AIService')
-                            os.remove(file_path)
-                            print(f"✅ Processed: {file_name}")
-                else:
-                    print(f"📂 {folder} is empty")
-            else:
-                print(f"📂 Creating {folder}...")
-                os.makedirs(folder, exist_ok=True)
-            
-            # Check Photobooth folder
-            folder='Undatabase/Photobooth'
-            if os.path.exists(folder):
-                files=os.listdir(folder)
-                if files:
-                    print(f"📂 Processing {len(files)} files in {folder}")
-                    for root, __, files in os.walk(folder):
-                        for file_name in files:
-                            file_path=root+'/'+file_name
-                            print(f"📤 Uploading: {file_path}")
-                            upload_file_to_storage(file_name, 'Photobooth')
-                            os.remove(file_path)
-                            print(f"✅ Processed: {file_name}")
-                else:
-                    print(f"📂 {folder} is empty")
-            else:
-                print(f"📂 Creating {folder}...")
-                os.makedirs(folder, exist_ok=True)
-
-            print("🔍 Checking images/ folders for new files...")
-            # Also check images/ folders for new files
-            sync_images_folders_to_storage()
-
-            print("💤 Sleeping for 5 seconds...")
-            time.sleep(5)
-        except Exception as e:
-            print(f"❌ Error: {e}")
-            import traceback
-            traceback.print_exc()
-            time.sleep(5)
\ No newline at end of file
+    ingestor = UndatabaseIngestor()
+    ingestor.start()
+    metrics.start_stats_dump("TrackingFolder")
+    observer = None
+    if polling_only:
+        print(f"👀 Starting polling monitor (every {SWEEP_INTERVAL:g}s)...")
+    else:
+        observer = start_undatabase_observer(ingestor)
+        print(f"👀 Watching Undatabase folders (fallback sweep every {SWEEP_INTERVAL:g}s)...")
+    metrics.startup("TrackingFolder", "watching", BOOT_STARTED)
+    # Kết nối Storage/Firestore trong lúc chờ file đầu tiên
+    firebase_clients.prefetch(get_bucket, get_metadata_writer)
+    background_sync = None if sync_first else start_background_sync(ingestor)
+    last_reconcile = time.monotonic()
+    
+    try:
+        while True:
+            try:
+                with metrics.stage("sweep"):
+                    sweep_undatabase_folders(ingestor)
+                
+                # Also check images/ folders for new files (lượt nền đầu tiên đang làm việc này thì bỏ qua)
+                if background_sync and background_sync.is_alive():
+                    time.sleep(SWEEP_INTERVAL)
+                    continue
+                full_reconcile = time.monotonic() - last_reconcile >= FULL_RECONCILE_INTERVAL
+                if full_reconcile:
+                    print("🔁 Full reconcile against Firebase Storage...")
+                    last_reconcile = time.monotonic()
+                with metrics.stage("reconcile" if full_reconcile else "poll"):
+                    sync_images_folders_to_storage(full_reconcile=full_reconcile)
+                
+                time.sleep(SWEEP_INTERVAL)
+            except Exception as e:
+                print(f"❌ Error: {e}")
+                import traceback
+                traceback.print_exc()
+                time.sleep(SWEEP_INTERVAL)
+    except KeyboardInterrupt:
+        print("\n🛑 TrackingFolder stopping...")
+        if observer:
+            observer.stop()
+            observer.join()
+        firebase_clients.close()
+        print(metrics.format_stats(metrics.dump_stats("TrackingFolder")))
@@ -1,54 +1,121 @@
-import os
 import time
+BOOT_STARTED = time.perf_counter()
+import os
+import sys
+import queue
 import asyncio
-import requests
+import threading
+from collections import deque
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image
-import firebase_admin
-from firebase_admin import credentials, firestore as admin_firestore
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from sync_index import InFlightHashes, file_digest
+from generation_cache import GenerationCache
+from job_queue import JobQueue, worker_id
+import http_client
+import inference
+import metrics
+import firebase_clients
 
 print("🚀 AI Model Server Starting...")
 
-# Firebase setup
+# Firebase setup - client chỉ được tạo khi cần (xem firebase_clients), process con của pool không phải khởi tạo
 os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:8080"
 os.environ["STORAGE_EMULATOR_HOST"] = "http://localhost:9199"
 
-try:
-    if not firebase_admin._apps:
-        cred = credentials.Certificate("serviceAccount.json")
-        firebase_admin.initialize_app(cred, {"projectId": "itsc"})
-    
-    db = admin_firestore.client()
-    print("✅ Firebase initialized")
-except Exception as e:
-    print(f"⚠️  Firebase init error: {e}")
-    db = None
+def get_metadata_writer():
+    """The batched Firestore writer, created on first use; None while Firebase cannot be initialised"""
+    try:
+        return firebase_clients.get_metadata_writer()
+    except Exception as e:
+        print(f"⚠️  Firebase init error: {e}")
+        return None
+
+# Cấu hình pool xử lý ảnh (có thể đổi qua biến môi trường)
+AI_WORKERS = int(os.environ.get("AI_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+AI_QUEUE_SIZE = int(os.environ.get("AI_QUEUE_SIZE", 64))
+FILE_SETTLE_SECONDS = float(os.environ.get("AI_FILE_SETTLE_SECONDS", 0.5))
+FILE_SETTLE_TIMEOUT = float(os.environ.get("AI_FILE_SETTLE_TIMEOUT", 10))
+# Thông tin của model hiện tại - là một phần của key trong generation cache
+AI_BACKEND = os.environ.get("AI_BACKEND", "simulator")
+AI_STYLE = os.environ.get("AI_STYLE", "anime")
+AI_MODEL_VERSION = os.environ.get("AI_MODEL_VERSION", inference.BACKENDS[AI_BACKEND].version)
+AI_OUTPUT_SIZE = int(os.environ.get("AI_OUTPUT_SIZE", 1024))
+# Chế độ micro-batch (bật bằng --batch)
+AI_MAX_BATCH = int(os.environ.get("AI_MAX_BATCH", 8))
+AI_MAX_BATCH_WAIT = float(os.environ.get("AI_MAX_BATCH_WAIT", 0.15))
+# Job được lưu trong hàng đợi SQLite, lease hết hạn thì job được chạy lại
+GENERATE_QUEUE = "generate"
+BROADCAST_URL = os.environ.get("BROADCAST_URL", "http://localhost:8000/api/broadcast")
+AI_JOB_LEASE = float(os.environ.get("AI_JOB_LEASE", 600))
+# 1 (hoặc --wait-for-model): chỉ bắt đầu theo dõi images/Original khi model đã nạp và warm xong.
+# Mặc định watcher chạy ngay, ảnh tới sớm chờ trong hàng đợi tới khi model sẵn sàng
+AI_WAIT_FOR_MODEL = os.environ.get("AI_WAIT_FOR_MODEL", "0") == "1"
+
+def wait_for_file_ready(file_path: str, settle: float = FILE_SETTLE_SECONDS, timeout: float = FILE_SETTLE_TIMEOUT):
+    """Wait until the file size stops changing instead of sleeping a fixed time"""
+    deadline = time.monotonic() + timeout
+    last_size = -1
+    while time.monotonic() < deadline:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = -1
+        if size > 0 and size == last_size:
+            return True
+        last_size = size
+        time.sleep(settle)
+    return last_size > 0
+
+def _init_worker(backend_name: str, size: int):
+    """Initializer of each pool process: load and warm the model once, reuse it for every image"""
+    global _worker_info
+    _worker_info = inference.load_backend(backend_name, size)
+
+_worker_info = None
+
+def _worker_ready():
+    return _worker_info
+
+def _generate_in_worker(input_path: str, output_path: str):
+    """Chạy trong process con của pool - decode, resize, encode (CPU-bound)"""
+    started = time.perf_counter()
+    success = ImageProcessor().simulate_anime_generation(input_path, output_path)
+    return success, time.perf_counter() - started
+
+def _generate_batch_in_worker(input_paths, output_paths):
+    """Chạy trong process con: tiền xử lý cả batch thành một mảng NumPy và gọi model một lần"""
+    return inference.run_batch(input_paths, output_paths, AI_OUTPUT_SIZE)
+
+def _log_broadcast(response, error):
+    if error is not None:
+        print(f"⚠️  WebSocket notification failed: {error}")
+    else:
+        print(f"📡 WebSocket notification sent")
 
 class ImageProcessor:
     def __init__(self):
-        self.processing_queue = []
+        self._name_lock = threading.Lock()
+        self._last_timestamp = 0
         
     def simulate_anime_generation(self, input_path: str, output_path: str):
         """Simulate AI anime generation - Tạm thời copy + thêm effect đơn giản"""
         try:
             print(f"🎨 Processing: {input_path} → {output_path}")
             
-            # Mở ảnh gốc
-            image = Image.open(input_path)
+            # Giải mã ngay ở gần kích thước cần dùng (JPEG draft/reduce), đổi màu bằng NumPy,
+            # ghi thẳng vào buffer dùng lại của thread này thay vì decode full ảnh rồi thumbnail
+            with metrics.stage("decode"):
+                frames = inference.frame_buffer(AI_OUTPUT_SIZE).frames(1)
+                width, height = inference.load_into(input_path, AI_OUTPUT_SIZE, frames[0])
             
-            # Resize if too large
-            if image.width > 1024 or image.height > 1024:
-                image.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
-            
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Simulate processing time
+            # Chạy model đã nạp sẵn của process này (simulator: chờ 2 giây như trước)
             print("⏳ AI processing...")
-            time.sleep(2)  # Giả lập AI processing
+            model = inference.ensure_backend(AI_BACKEND, AI_OUTPUT_SIZE)
+            image = Image.fromarray(model.generate_batch(frames[:, :height, :width])[0])
             
             # Save processed image
             image.save(output_path, 'PNG', quality=95)
@@ -59,75 +126,514 @@ class ImageProcessor:
             print(f"❌ Error processing {input_path}: {e}")
             return False
     
+    def prepare_output(self, filename: str):
+        """Pick a unique AIService output path for a new job"""
+        output_dir = Path("images/AIService")
+        output_dir.mkdir(exist_ok=True)
+        
+        # Nhiều worker chạy song song nên timestamp phải tăng dần, không được trùng
+        with self._name_lock:
+            timestamp = max(int(time.time() * 1000), self._last_timestamp + 1)
+            self._last_timestamp = timestamp
+        ai_filename = f"ai-processed-{timestamp}.png"
+        return ai_filename, output_dir / ai_filename
+    
     def process_new_image(self, original_path: str, filename: str):
         """Process new image from Original to AIService - Synchronous version"""
         try:
-            # Create output path
-            output_dir = Path("images/AIService")
-            output_dir.mkdir(exist_ok=True)
-            
-            # Generate AI filename
-            timestamp = int(time.time() * 1000)
-            name_without_ext = Path(filename).stem
-            ai_filename = f"ai-processed-{timestamp}.png"
-            output_path = output_dir / ai_filename
+            ai_filename, output_path = self.prepare_output(filename)
             
             print(f"🤖 Processing {filename} → {ai_filename}...")
             
             # Simulate AI generation
             success = self.simulate_anime_generation(original_path, str(output_path))
-            
-            if success and db:
+            return self.publish_result(original_path, filename, ai_filename, success)
+        
+        except Exception as e:
+            print(f"❌ Error in AI processing: {e}")
+            return False
+    
+    def publish_result(self, original_path: str, filename: str, ai_filename: str, success: bool,
+                       content_hash: str = None, landed_at: float = None):
+        """Write the Firestore doc and notify WebSocket clients for a generated image.
+
+        landed_at is when the watcher first saw the original (epoch seconds).
+        """
+        try:
+            metadata_writer = get_metadata_writer() if success else None
+            if metadata_writer:
                 # Add to Firestore AIService collection
                 doc_data = {
                     "filename": ai_filename,
                     "originalName": filename,
                     "originalPath": original_path,
-                    "generatedTime": admin_firestore.SERVER_TIMESTAMP,
-                    "style": "anime",
+                    "generatedTime": firebase_clients.server_timestamp(),
+                    "time": firebase_clients.server_timestamp(),
+                    "style": AI_STYLE,
+                    "modelVersion": AI_MODEL_VERSION,
                     "status": "completed",
                     "path": f"images/AIService/{ai_filename}",
                     "url": f"http://localhost:8000/static/AIService/{ai_filename}"
                 }
+                if content_hash:
+                    doc_data["contentHash"] = content_hash
+                    doc_data["traceId"] = metrics.trace_id(content_hash)
                 
                 try:
-                    doc_ref = db.collection("AIService").document()
-                    doc_ref.set(doc_data)
-                    print(f"📄 Added to Firestore: {doc_ref.id}")
+                    # ID được sinh phía client; chờ batch commit xong mới broadcast, batch bị bỏ thì job được thử lại
+                    doc_ref = firebase_clients.get_db().collection("AIService").document()
+                    metadata_writer.write(doc_ref, doc_data)
+                    print(f"📄 Firestore document written: {doc_ref.id}")
                     
                     # Send WebSocket notification
-                    import requests
-                    import json
                     websocket_data = {
                         "type": "image_generated",
                         "collection": "AIService", 
                         "filename": ai_filename,
                         "originalName": filename,
                         "image_url": f"http://localhost:8000/static/AIService/{ai_filename}",
-                        "firestore_id": doc_ref.id
+                        "firestore_id": doc_ref.id,
+                        "traceId": doc_data.get("traceId"),
                     }
+                    # Lúc watcher thấy ảnh gốc lần đầu (không dùng mtime: file hard-link/copy giữ mtime cũ),
+                    # API dùng để đo độ trễ end-to-end
+                    if landed_at is not None:
+                        websocket_data["landedAt"] = landed_at
                     
-                    # Broadcast to WebSocket clients
-                    try:
-                        requests.post("http://localhost:8000/api/broadcast", 
-                                    json=websocket_data, timeout=1)
-                        print(f"📡 WebSocket notification sent")
-                    except Exception as ws_error:
-                        print(f"⚠️  WebSocket notification failed: {ws_error}")
+                    # Broadcast to WebSocket clients qua kết nối keep-alive, không chờ trên thread xử lý
+                    http_client.post_in_background(BROADCAST_URL, callback=_log_broadcast,
+                                                   json=websocket_data, timeout=1)
                         
                 except Exception as e:
                     print(f"⚠️  Firestore error: {e}")
+                    return False
                 
                 return True
+            return success
         
         except Exception as e:
             print(f"❌ Error in AI processing: {e}")
             return False
 
+class ProcessingPool:
+    """Bounded job queue fed by the watcher and drained by a process pool.
+
+    Every job is also recorded in the durable JobQueue: it is leased when a
+    dispatcher picks it up and completed once its result is published, so
+    a restart resumes exactly the jobs that had not finished.
+    """
+    
+    def __init__(self, processor: ImageProcessor, workers: int = AI_WORKERS, queue_size: int = AI_QUEUE_SIZE):
+        self.processor = processor
+        self.workers = workers
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(AI_BACKEND, AI_OUTPUT_SIZE))
+        self.cache = GenerationCache()
+        self.inflight_keys = InFlightHashes()
+        self.store = JobQueue()
+        self.owner = worker_id()
+        self.dispatchers = []
+        self.stats_lock = threading.Lock()
+        self.stats = {"done": 0, "failed": 0, "reused": 0, "wait_total": 0.0, "generate_total": 0.0, "job_max": 0.0}
+        # Nạp model lỗi thì service dừng hẳn, không báo "watching" rồi làm hỏng từng job.
+        # Dispatcher và resume chỉ lease job sau khi model_ready được set
+        self.model_ready = threading.Event()
+        self.model_failed = threading.Event()
+        self.model_error = None
+        # Job thử lại khi hàng đợi đầy: chờ ở đây, mỗi khi dispatcher làm xong một job thì đưa lại vào hàng đợi
+        self.deferred = deque()
+        metrics.track_queue("ai_jobs", self.jobs.qsize)
+        metrics.track_queue("ai_jobs_deferred", lambda: len(self.deferred))
+        metrics.track_queue("ai_job_store", lambda: self.store.counts(GENERATE_QUEUE)["queued"])
+    
+    def warm_up(self):
+        """Start the pool processes and report the model load of those that answer.
+
+        Every process loads and warms its model in _init_worker before it
+        takes any job; the calls here only make the pool start its processes
+        now. Several calls can land on the same process, so fewer workers
+        than self.workers may report.
+        """
+        started = time.perf_counter()
+        futures = [self.executor.submit(_worker_ready) for _ in range(self.workers)]
+        infos = {info["pid"]: info for info in (future.result() for future in futures)}
+        for info in infos.values():
+            print(f"🧠 Worker {info['pid']}: {info['backend']} ({info['version']}) "
+                  f"load {info['load_seconds'] * 1000:.0f} ms, warmup {info['warmup_seconds'] * 1000:.0f} ms, "
+                  f"weights {info['memory_bytes'] / 1024 / 1024:.1f} MB")
+        print(f"🔥 Model ready ({len(infos)} of {self.workers} workers reported) after {time.perf_counter() - started:.2f}s")
+        metrics.startup("ai_model_server", "model warm", BOOT_STARTED)
+    
+    def _warm_up_or_fail(self):
+        try:
+            self.warm_up()
+        except Exception as e:
+            self._model_lost(e)
+            return
+        self.model_ready.set()
+        # Job của lần chạy trước chỉ được lease khi chắc chắn có model để chạy
+        self.resume()
+    
+    def _model_lost(self, error):
+        """The pool cannot run jobs (model load failed or a worker died): stop the service"""
+        if self.model_failed.is_set():
+            return
+        if self.model_ready.is_set():
+            print(f"❌ Worker pool broke: {error}")
+            metrics.count("ai_pool_broken")
+        else:
+            print(f"❌ Model failed to load: {error}")
+            metrics.count("ai_model_load_failed")
+        self.model_error = error
+        self.model_failed.set()
+    
+    def _wait_for_model(self) -> bool:
+        """Block a dispatcher until the model is warm; False if it never will be"""
+        while not self.model_ready.wait(1):
+            if self.model_failed.is_set():
+                return False
+        return not self.model_failed.is_set()
+    
+    def _requeue(self, job, error):
+        """Give the job back uncharged: a broken pool is not the job's fault, the next run picks it up"""
+        self.store.requeue(job["id"], str(error) or type(error).__name__)
+        print(f"↩️  Left {job['filename']} queued for the next run ({type(error).__name__})")
+    
+    def start(self):
+        # Nạp model ở nền ngay từ đầu: watcher chạy luôn, ảnh tới sớm chỉ chờ trong hàng đợi
+        # (chưa lease) tới khi model sẵn sàng, rồi job cũ được resume
+        threading.Thread(target=self._warm_up_or_fail, name="ai-warmup", daemon=True).start()
+        # Mỗi dispatcher giữ đúng một job trong process pool tại một thời điểm
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._dispatch_loop, name=f"ai-dispatch-{index}", daemon=True)
+            thread.start()
+            self.dispatchers.append(thread)
+        print(f"🧵 Processing pool: {self.workers} workers, queue size {self.jobs.maxsize}")
+    
+    def resume(self):
+        """Re-queue the jobs a previous run left unfinished"""
+        jobs = self.store.recover(GENERATE_QUEUE)
+        if jobs:
+            print(f"♻️  Resuming {len(jobs)} unfinished job(s)")
+        for job in jobs:
+            # created_at: lúc job được ghi lần đầu, tức lúc watcher thấy file
+            self.submit(job["path"], os.path.basename(job["path"]), job_id=job["id"], landed_at=job["created_at"])
+    
+    def submit(self, original_path: str, filename: str, timeout: float = None, job_id: str = None,
+               landed_at: float = None):
+        """Queue a job; blocks while the queue is full (backpressure)"""
+        if job_id is None:
+            landed_at = landed_at or time.time()
+            job_id, created = self.store.enqueue(GENERATE_QUEUE, original_path)
+            if not created:
+                print(f"⏭️  {filename} is already queued")
+                return True
+        job = {"id": job_id, "path": original_path, "filename": filename, "queued_at": time.perf_counter(),
+               "landed_at": landed_at}
+        try:
+            self.jobs.put(job, timeout=timeout)
+        except queue.Full:
+            # Job vẫn nằm trong hàng đợi trên đĩa, lần khởi động sau sẽ chạy
+            print(f"⚠️  Queue full, deferred {filename} to the next restart")
+            return False
+        print(f"📥 Queued {filename} (pending: {self.jobs.qsize()})")
+        return True
+    
+    def _retry(self, job, error: str):
+        """Put a failed job back in the queue until it runs out of attempts"""
+        state = self.store.retry(job["id"], error)
+        if state == "queued":
+            retry_job = dict(job, queued_at=time.perf_counter())
+            try:
+                self.jobs.put_nowait(retry_job)
+                print(f"🔁 Retrying {job['filename']} ({error})")
+            except queue.Full:
+                # Không chặn ở đây: _retry chạy trên chính thread dispatcher đang rút hàng đợi
+                self.deferred.append(retry_job)
+                print(f"🔁 Retrying {job['filename']} once the queue has room ({error})")
+        elif state == "failed":
+            print(f"❌ Giving up on {job['filename']} ({error})")
+    
+    def _dispatch_loop(self):
+        if not self._wait_for_model():
+            return
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                self._run_job(job)
+            except BrokenProcessPool as e:
+                self._requeue(job, e)
+                self._model_lost(e)
+            except Exception as e:
+                print(f"❌ Error in AI processing: {e}")
+                self._retry(job, str(e))
+            finally:
+                self.jobs.task_done()
+                self._refill()
+    
+    def _refill(self):
+        """Move deferred retries back into the job queue while it has room"""
+        while self.deferred:
+            try:
+                job = self.deferred.popleft()
+            except IndexError:
+                return
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                self.deferred.appendleft(job)
+                return
+    
+    def _start_job(self, job, blocking: bool = True):
+        """Wait for the file, try the cache; returns a context for a job that still needs generating.
+
+        Returns None when the job is finished (cache hit or unreadable file).
+        With blocking=False a job whose cache key another worker is already
+        generating returns "busy" instead of waiting for it.
+        """
+        original_path, filename = job["path"], job["filename"]
+        wait_seconds = time.perf_counter() - job["queued_at"]
+        metrics.observe_stage("queue_wait", wait_seconds)
+        # Job đã xong (kết quả trùng) hoặc đang do process khác giữ thì bỏ qua
+        if not self.store.lease_job(job["id"], self.owner, AI_JOB_LEASE):
+            return None
+        
+        # Đợi file ghi xong trên thread này, không chặn thread của watchdog
+        with metrics.stage("watcher_settle"):
+            ready = wait_for_file_ready(original_path)
+        if not ready:
+            print(f"⚠️  File not ready, skipped: {filename}")
+            self._record(False, wait_seconds, 0.0, 0.0)
+            self._retry(job, "file not ready")
+            return None
+        
+        # Ảnh giống hệt (cùng hash, cùng style/model/size) đã xử lý rồi thì lấy từ cache, không chạy AI lần nữa
+        with metrics.stage("hash"):
+            content_hash = file_digest(original_path)
+        metrics.add_bytes("ai_input", os.path.getsize(original_path))
+        cache_key = GenerationCache.key(content_hash, AI_STYLE, AI_MODEL_VERSION, AI_OUTPUT_SIZE)
+        if blocking:
+            owner = self.inflight_keys.acquire(cache_key)
+        else:
+            owner = self.inflight_keys.try_acquire(cache_key)
+            if not owner:
+                return "busy"
+        ai_filename, output_path = self.processor.prepare_output(filename)
+        context = {"job": job, "wait": wait_seconds, "hash": content_hash, "key": cache_key, "owner": owner,
+                   "ai_filename": ai_filename, "output_path": str(output_path), "trace": metrics.trace_id(content_hash)}
+        try:
+            with metrics.stage("cache_fetch"):
+                hit = self.cache.fetch(cache_key, context["output_path"])
+        except Exception:
+            self._release(context)
+            raise
+        if hit:
+            self._release(context)
+            print(f"⚡ Cache hit for {filename} → {ai_filename}")
+            with metrics.stage("publish"):
+                success = self.processor.publish_result(original_path, filename, ai_filename, True, content_hash,
+                                                        job.get("landed_at"))
+            self._settle(job, success)
+            total_seconds = time.perf_counter() - job["queued_at"]
+            self._record(success, wait_seconds, 0.0, total_seconds, reused=True)
+            print(f"⏱️  [{context['trace']}] {filename}: wait {wait_seconds:.2f}s, cached, total {total_seconds:.3f}s")
+            return None
+        return context
+    
+    def _settle(self, job, success: bool):
+        if success:
+            self.store.complete(job["id"])
+        else:
+            self._retry(job, "generation or publish failed")
+    
+    def _release(self, context):
+        if context["owner"]:
+            context["owner"] = False
+            self.inflight_keys.release(context["key"])
+    
+    def _finish_job(self, context, success: bool, generate_seconds: float):
+        job = context["job"]
+        metrics.observe_stage("generate", generate_seconds)
+        try:
+            if success:
+                metrics.add_bytes("ai_output", os.path.getsize(context["output_path"]))
+                self.cache.store(context["key"], context["output_path"], generate_seconds)
+        finally:
+            self._release(context)
+        with metrics.stage("publish"):
+            success = self.processor.publish_result(job["path"], job["filename"], context["ai_filename"],
+                                                    success, context["hash"], job.get("landed_at"))
+        self._settle(job, success)
+        
+        total_seconds = time.perf_counter() - job["queued_at"]
+        self._record(success, context["wait"], generate_seconds, total_seconds)
+        print(f"⏱️  [{context['trace']}] {job['filename']}: wait {context['wait']:.2f}s, "
+              f"generate {generate_seconds:.2f}s, total {total_seconds:.2f}s")
+    
+    def _run_job(self, job):
+        context = self._start_job(job)
+        if context is None:
+            return
+        print(f"🤖 Processing {job['filename']} → {context['ai_filename']}...")
+        try:
+            future = self.executor.submit(_generate_in_worker, job["path"], context["output_path"])
+            success, generate_seconds = future.result()
+        except Exception:
+            self._release(context)
+            raise
+        self._finish_job(context, success, generate_seconds)
+    
+    def _record(self, success, wait_seconds, generate_seconds, total_seconds, reused=False):
+        metrics.observe_stage("job_total", total_seconds)
+        metrics.count("ai_reused" if reused else "ai_done" if success else "ai_failed")
+        with self.stats_lock:
+            self.stats["done" if success else "failed"] += 1
+            if reused:
+                self.stats["reused"] += 1
+            self.stats["wait_total"] += wait_seconds
+            self.stats["generate_total"] += generate_seconds
+            self.stats["job_max"] = max(self.stats["job_max"], total_seconds)
+    
+    def summary(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        count = stats["done"] + stats["failed"]
+        if not count:
+            return "📊 No jobs processed"
+        cache = self.cache.stats()
+        return (f"📊 Jobs: {stats['done']} done ({stats['reused']} from cache), {stats['failed']} failed | "
+                f"avg wait {stats['wait_total'] / count:.2f}s | "
+                f"avg generate {stats['generate_total'] / count:.2f}s | "
+                f"max job {stats['job_max']:.2f}s | pending {self.jobs.qsize()}\n"
+                f"💾 Job queue: {self.store.counts(GENERATE_QUEUE)}\n"
+                f"⚡ Cache: {cache['hits']} hits / {cache['misses']} misses ({cache['hit_rate']:.0%}) | "
+                f"{cache['entries']} entries, {cache['bytes'] / 1024 / 1024:.1f} MB | "
+                f"~{cache['saved_seconds']:.1f}s inference saved")
+    
+    def shutdown(self, drain: bool = True):
+        """Stop the dispatchers; with drain=True finish every queued job first"""
+        if not drain:
+            # Bỏ các job chưa chạy
+            try:
+                while True:
+                    self.jobs.get_nowait()
+                    self.jobs.task_done()
+            except queue.Empty:
+                pass
+        else:
+            print(f"⏳ Draining {self.jobs.qsize()} pending jobs...")
+        for _ in self.dispatchers:
+            self.jobs.put(None)
+        for thread in self.dispatchers:
+            thread.join()
+        self.executor.shutdown(wait=True)
+        print(self.summary())
+
+class BatchScheduler(ProcessingPool):
+    """Micro-batching mode: collect up to AI_MAX_BATCH images or AI_MAX_BATCH_WAIT seconds,
+    then run one generate_batch call of the loaded backend for all of them in the process pool."""
+    
+    def __init__(self, processor: ImageProcessor, workers: int = AI_WORKERS, queue_size: int = AI_QUEUE_SIZE,
+                 max_batch: int = AI_MAX_BATCH, max_wait: float = AI_MAX_BATCH_WAIT):
+        super().__init__(processor, workers, queue_size)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats["batches"] = 0
+    
+    def start(self):
+        super().start()
+        print(f"📦 Micro-batching: up to {self.max_batch} images or {self.max_wait * 1000:.0f} ms per batch")
+    
+    def _dispatch_loop(self):
+        if not self._wait_for_model():
+            return
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            batch = [job]
+            stop = False
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self.jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.task_done()
+                    stop = True
+                    break
+                batch.append(job)
+            try:
+                self._run_batch(batch)
+            except BrokenProcessPool as e:
+                for job in batch:
+                    self._requeue(job, e)
+                self._model_lost(e)
+            except Exception as e:
+                print(f"❌ Error in AI batch: {e}")
+                # Job nào đã xong thì retry không có tác dụng (không còn lease)
+                for job in batch:
+                    self._retry(job, str(e))
+            finally:
+                for _ in batch:
+                    self.jobs.task_done()
+                self._refill()
+            if stop:
+                return
+    
+    def _run_batch(self, batch):
+        contexts, deferred = [], []
+        for job in batch:
+            try:
+                # Hai ảnh giống nhau trong cùng một batch: ảnh sau chạy sau, sẽ trúng cache
+                context = self._start_job(job, blocking=False)
+            except Exception as e:
+                print(f"❌ Error in AI processing: {e}")
+                self._retry(job, str(e))
+                continue
+            if context == "busy":
+                deferred.append(job)
+            elif context is not None:
+                contexts.append(context)
+        
+        if contexts:
+            print(f"📦 Generating batch of {len(contexts)}...")
+            try:
+                future = self.executor.submit(_generate_batch_in_worker,
+                                              [context["job"]["path"] for context in contexts],
+                                              [context["output_path"] for context in contexts])
+                results, batch_seconds = future.result()
+            except Exception:
+                for context in contexts:
+                    self._release(context)
+                raise
+            with self.stats_lock:
+                self.stats["batches"] += 1
+            per_image = batch_seconds / len(contexts)
+            for context, success in zip(contexts, results):
+                self._finish_job(context, success, per_image)
+        
+        for job in deferred:
+            self._run_job(job)
+    
+    def summary(self):
+        with self.stats_lock:
+            batches = self.stats["batches"]
+            generated = self.stats["done"] + self.stats["failed"] - self.stats["reused"]
+        average = generated / batches if batches else 0.0
+        return super().summary() + f"\n📦 Batches: {batches}, avg size {average:.1f}"
+
 class OriginalFolderWatcher(FileSystemEventHandler):
-    def __init__(self, processor: ImageProcessor):
+    def __init__(self, processor: ProcessingPool):
         self.processor = processor
-        self.processed_files = set()  # Track processed files to avoid duplicates
     
     def on_created(self, event):
         if event.is_directory:
@@ -140,24 +646,33 @@ class OriginalFolderWatcher(FileSystemEventHandler):
         if not filename.lower().endswith(('.png', '.jpg', '.jpeg')):
             return
             
-        # Avoid duplicate processing
-        if file_path in self.processed_files:
-            return
-            
-        self.processed_files.add(file_path)
-        
         print(f"🔍 New image detected: {filename}")
         
-        # Wait a moment for file to be fully written
-        time.sleep(1)
-        
-        # Process synchronously
-        self.processor.process_new_image(file_path, filename)
+        # Đẩy vào hàng đợi, pool sẽ xử lý - watchdog được rảnh để bắt file tiếp theo.
+        # Sự kiện trùng cho file đang chờ/đang xử lý bị job queue bỏ qua
+        self.processor.submit(file_path, filename)
+
+def start_watching(batching: bool = False, wait_for_model: bool = AI_WAIT_FOR_MODEL):
+    """Start watching Original folder for new images.
 
-def start_watching():
-    """Start watching Original folder for new images"""
+    With wait_for_model the watcher only starts once every pool process
+    has loaded and warmed the model, so the first photo never pays the
+    cold start; otherwise photos that arrive earlier wait in the queue.
+    """
     processor = ImageProcessor()
-    event_handler = OriginalFolderWatcher(processor)
+    pool = BatchScheduler(processor) if batching else ProcessingPool(processor)
+    pool.start()
+    if wait_for_model:
+        print("⏳ Waiting for the model before watching...")
+        if not pool._wait_for_model():
+            # Không bao giờ báo "watching" khi không có model để chạy; job trên đĩa giữ cho lần sau
+            pool.shutdown(drain=False)
+            print("🛑 AI Model Server stopped: no model to run")
+            sys.exit(1)
+    # Firestore client tạo ở nền để kết quả đầu tiên không phải chờ
+    firebase_clients.prefetch(firebase_clients.get_metadata_writer)
+    metrics.start_stats_dump("ai_model_server")
+    event_handler = OriginalFolderWatcher(pool)
     observer = Observer()
     
     # Watch Original folder
@@ -171,35 +686,50 @@ def start_watching():
     
     print("🤖 AI Model Server Started!")
     print(f"👀 Watching: {watch_path}")
-    print(f"🎨 Auto-generating anime style images...")
+    print(f"🎨 Auto-generating {AI_STYLE} style images with the {AI_BACKEND} backend...")
     print(f"📁 Output: images/AIService/")
     print(f"🔥 Firestore: AIService collection")
     print("=" * 50)
     print("💡 Upload an image to images/Original/ to test!")
+    metrics.startup("ai_model_server", "watching", BOOT_STARTED)
     
     try:
-        while True:
-            time.sleep(1)
+        while not pool.model_failed.wait(1):
+            pass
+        observer.stop()
+        print("\n🛑 AI Model Server stopping: no model to run")
     except KeyboardInterrupt:
         observer.stop()
-        print("\n🛑 AI Model Server stopped")
+        print("\n🛑 AI Model Server stopping...")
     
     observer.join()
+    # Model lỗi thì job còn chờ vẫn nằm trong job queue trên đĩa, lần chạy sau xử lý tiếp
+    pool.shutdown(drain=not pool.model_failed.is_set())
+    firebase_clients.close()
+    print(metrics.format_stats(metrics.dump_stats("ai_model_server")))
+    print("🛑 AI Model Server stopped")
+    if pool.model_error is not None:
+        sys.exit(1)
 
-if __name__ == "__main__":
-    print("🚀 Starting AI Model Server...")
-    
-    # Check if Firebase emulators are running
+def check_emulators():
+    """Check if Firebase emulators are running (only prints, never blocks startup)"""
     try:
         print("🔍 Checking Firebase emulators...")
-        response = requests.get("http://localhost:8080", timeout=2)
+        http_client.get("http://localhost:8080", timeout=2)
         print("✅ Firebase emulators detected")
     except Exception as e:
         print(f"⚠️  Firebase emulators check: {e}")
         print("🔧 Make sure Firebase emulators are running")
+
+metrics.startup("ai_model_server", "imported", BOOT_STARTED)
+
+if __name__ == "__main__":
+    print("🚀 Starting AI Model Server...")
+    threading.Thread(target=check_emulators, name="emulator-check", daemon=True).start()
     
     try:
-        start_watching()
+        start_watching(batching="--batch" in sys.argv,
+                       wait_for_model=AI_WAIT_FOR_MODEL or "--wait-for-model" in sys.argv)
     except Exception as e:
         print(f"💥 Error starting AI server: {e}")
         import traceback
@@ -0,0 +1,619 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import asyncio
+import datetime
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Benchmark chạy hoàn toàn offline: Firestore, Storage và máy AI đều là bản giả trong process.
+# python benchmark.py [scenario ...] [--quick] [--compare [baseline.json]]
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_RESULTS_DIR = os.path.abspath(os.environ.get("BENCH_RESULTS_DIR", os.path.join(ROOT, "bench_results")))
+# Chậm đi hơn mức này (p95 tăng hoặc ops/s giảm) thì tính là regression
+BENCH_TOLERANCE = float(os.environ.get("BENCH_TOLERANCE", 0.2))
+# Độ trễ giả lập của từng dịch vụ, gần với emulator chạy trên cùng máy
+FAKE_FIRESTORE_LATENCY = float(os.environ.get("BENCH_FIRESTORE_LATENCY", 0.005))
+FAKE_STORAGE_LATENCY = float(os.environ.get("BENCH_STORAGE_LATENCY", 0.01))
+FAKE_STORAGE_BANDWIDTH = float(os.environ.get("BENCH_STORAGE_BANDWIDTH", 100 * 1024 * 1024))
+
+#--------------------------------------------------Bản giả của Firestore / Storage------------------------------------------------------------
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+class FakeDocument:
+    def __init__(self, collection, doc_id):
+        self.collection = collection
+        self.id = doc_id
+
+    def set(self, data, merge=False):
+        time.sleep(self.collection.db.latency)
+        self.collection.store(self.id, data, merge)
+
+class FakeWatch:
+    def unsubscribe(self):
+        pass
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id=None):
+        return FakeDocument(self, doc_id or uuid.uuid4().hex[:20])
+
+    def store(self, doc_id, data, merge=False):
+        with self.db.lock:
+            docs = self.db.data.setdefault(self.name, {})
+            docs[doc_id] = {**docs.get(doc_id, {}), **data} if merge else dict(data)
+
+    def stream(self):
+        time.sleep(self.db.latency)
+        with self.db.lock:
+            return [FakeSnapshot(doc_id, data) for doc_id, data in self.db.data.get(self.name, {}).items()]
+
+    def limit(self, count):
+        return self
+
+    def select(self, fields):
+        return self
+
+    def on_snapshot(self, callback):
+        # Chỉ gửi snapshot đầu tiên, giống listener lúc vừa đăng ký
+        threading.Thread(target=callback, args=(self.stream(), [], datetime.datetime.now(datetime.timezone.utc)),
+                         daemon=True).start()
+        return FakeWatch()
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes.append((doc_ref, data, merge))
+
+    def commit(self):
+        time.sleep(self.db.latency)
+        for doc_ref, data, merge in self.writes:
+            doc_ref.collection.store(doc_ref.id, data, merge)
+        with self.db.lock:
+            self.db.commits += 1
+
+class FakeFirestore:
+    """The part of the Firestore client the services use: collections, documents, batches, listeners"""
+
+    def __init__(self, latency=FAKE_FIRESTORE_LATENCY):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.data = {}
+        self.commits = 0
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def count(self, name):
+        with self.lock:
+            return len(self.data.get(name, {}))
+
+class FakeBlob:
+    def __init__(self, bucket, name, size=0):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+
+    def upload_from_filename(self, filename):
+        started = time.perf_counter()
+        with open(filename, "rb") as f:
+            size = len(f.read())
+        time.sleep(self.bucket.latency + size / self.bucket.bandwidth)
+        self.size = size
+        with self.bucket.lock:
+            self.bucket.blobs[self.name] = size
+            self.bucket.uploads.append(time.perf_counter() - started)
+
+class FakeBucket:
+    """An in-memory GCS bucket: uploads cost latency + size / bandwidth"""
+
+    def __init__(self, name="itsc.appspot.com", latency=FAKE_STORAGE_LATENCY, bandwidth=FAKE_STORAGE_BANDWIDTH):
+        self.name = name
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.uploads = []
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        time.sleep(self.latency)
+        with self.lock:
+            return [FakeBlob(self, name, size) for name, size in self.blobs.items() if name.startswith(prefix)]
+
+class FakeStorageClient:
+    def __init__(self, project=None, credentials=None):
+        pass
+
+    def bucket(self, name):
+        return fake_bucket
+
+fake_db = FakeFirestore()
+fake_bucket = FakeBucket()
+
+_fakes_installed = False
+
+def install_fakes():
+    """Point the Firebase SDK entry points at the fakes; call before importing a service module"""
+    global _fakes_installed
+    if _fakes_installed:
+        return
+    _fakes_installed = True
+    import firebase_admin
+    from firebase_admin import credentials, firestore as admin_firestore, storage
+    from google.cloud import storage as gcs
+
+    credentials.Certificate = lambda path: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    admin_firestore.client = lambda *args, **kwargs: fake_db
+    storage.bucket = lambda *args, **kwargs: fake_bucket
+    gcs.Client = FakeStorageClient
+
+#--------------------------------------------------Máy AI giả và endpoint nhận broadcast------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@contextmanager
+def stub_endpoint():
+    """A keep-alive HTTP server that answers every POST with 200 (broadcast target, node heartbeats)"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Stub(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    class StubServer(ThreadingHTTPServer):
+        request_queue_size = 256
+        daemon_threads = True
+
+    server = StubServer(("127.0.0.1", 0), Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+
+def start_fake_ai_nodes(hub_url, count=2, seconds=0.05, capacity=2):
+    """Run dispatcher stand-in nodes on threads of this process; returns their addresses"""
+    import dispatcher
+    addresses = []
+    for _ in range(count):
+        port = free_port()
+        threading.Thread(target=dispatcher.run_standin_node, args=(port, hub_url, seconds, capacity),
+                         daemon=True).start()
+        addresses.append(f"127.0.0.1:{port}")
+    for address in addresses:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", int(address.rsplit(":", 1)[1])), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+    return addresses
+
+#--------------------------------------------------Môi trường chạy: thư mục tạm + API--------------------------------------------------------
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+
+def make_workspace(root):
+    """Project-shaped folder: images/, Undatabase/ and routes/ (the API resolves ../images from routes/)"""
+    for folder in ("Original", "AIService", "Photobooth"):
+        os.makedirs(os.path.join(root, "images", folder), exist_ok=True)
+        os.makedirs(os.path.join(root, "Undatabase", folder), exist_ok=True)
+    os.makedirs(os.path.join(root, "routes"), exist_ok=True)
+    return root
+
+_api = None
+
+def api_module(workspace):
+    global _api
+    if _api is None:
+        install_fakes()
+        sys.path.insert(0, os.path.join(ROOT, "routes"))
+        with working_directory(os.path.join(workspace, "routes")):
+            import APIcalling
+        _api = APIcalling
+    return _api
+
+@contextmanager
+def serve_api(workspace):
+    """Run the FastAPI app with uvicorn on a thread; yields its base URL"""
+    import uvicorn
+
+    class Server(uvicorn.Server):
+        def install_signal_handlers(self):
+            # Chạy trên thread phụ, không đăng ký signal được
+            pass
+
+    app = api_module(workspace).app
+    port = free_port()
+    server = Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    with working_directory(os.path.join(workspace, "routes")):
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.02)
+        try:
+            yield f"127.0.0.1:{port}"
+        finally:
+            server.should_exit = True
+            thread.join(timeout=10)
+
+def http_session(pool_size):
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    return session
+
+def write_images(folder, count, size, prefix="bench", fmt="JPEG"):
+    """count distinct size x size images (random noise, so no two share a hash)"""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, f"{prefix}-{index}.{fmt.lower().replace('jpeg', 'jpg')}")
+        Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(path, fmt)
+        paths.append(path)
+    return paths
+
+def summarize(samples, seconds, ops=None, **params):
+    """p50/p95/p99 in ms of the per-operation samples (seconds) and ops/sec over the wall time"""
+    ordered = sorted(samples)
+    ops = len(ordered) if ops is None else ops
+
+    def percentile(fraction):
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+
+    return {"ops": ops, "seconds": round(seconds, 4), "ops_per_sec": round(ops / seconds, 2) if seconds else None,
+            "p50_ms": percentile(0.50), "p95_ms": percentile(0.95), "p99_ms": percentile(0.99), "params": params}
+
+#--------------------------------------------------------------Kịch bản-------------------------------------------------------------------------
+
+def bench_upload_burst(workspace, uploads=200, concurrency=16, size=256 * 1024):
+    """N concurrent POST /upload/{collection}: request latency and uploads/sec"""
+    import firebase_clients
+    payload = os.urandom(size)
+    with serve_api(workspace) as address:
+        session = http_session(concurrency)
+
+        def upload(index):
+            started = time.perf_counter()
+            response = session.post(f"http://{address}/upload/Original",
+                                     files={"image": (f"burst-{index}.jpg", payload, "image/jpeg")}, timeout=30)
+            response.raise_for_status()
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(upload, range(uploads)))
+        seconds = time.perf_counter() - started
+        firebase_clients.get_metadata_writer().flush(timeout=30)
+    return summarize(latencies, seconds, uploads=uploads, concurrency=concurrency, bytes=size)
+
+def bench_websocket_fanout(workspace, subscribers=200, messages=100):
+    """M WebSocket subscribers of one collection, K broadcasts via /api/broadcast: delivery latency"""
+    import websockets
+
+    async def run(address):
+        clients = [await websockets.connect(f"ws://{address}/ws/Original", max_queue=None)
+                   for _ in range(subscribers)]
+        for client in clients:
+            await client.recv()  # hello
+        latencies = []
+
+        async def receive(client):
+            received = 0
+            while received < messages:
+                message = json.loads(await client.recv())
+                if message.get("type") == "bench":
+                    latencies.append(time.time() - message["sentAt"])
+                    received += 1
+
+        session = http_session(1)
+        loop = asyncio.get_running_loop()
+        readers = [asyncio.ensure_future(receive(client)) for client in clients]
+        started = time.perf_counter()
+        for seq in range(messages):
+            body = {"type": "bench", "collection": "Original", "seq": seq, "sentAt": time.time()}
+            await loop.run_in_executor(None, lambda: session.post(f"http://{address}/api/broadcast", json=body,
+                                                                  timeout=10).raise_for_status())
+        # Client chậm có thể bị bỏ tin (drop_oldest): chỉ tính những tin đã tới
+        await asyncio.wait(readers, timeout=60)
+        seconds = time.perf_counter() - started
+        for reader in readers:
+            reader.cancel()
+        for client in clients:
+            await client.close()
+        return latencies, seconds
+
+    with serve_api(workspace) as address:
+        latencies, seconds = asyncio.run(run(address))
+    return summarize(latencies, seconds, subscribers=subscribers, messages=messages,
+                     delivered=len(latencies), expected=subscribers * messages)
+
+def bench_cold_sync(workspace, files=500, size=64 * 1024):
+    """sync_existing_files_to_storage over K new files with an empty sync index: files/sec, upload latency"""
+    install_fakes()
+    import TrackingFolder
+    import firebase_clients
+    from sync_index import SyncIndex
+
+    folder = os.path.join(workspace, f"sync-{files}")
+    make_workspace(folder)
+    with working_directory(folder):
+        for index in range(files):
+            collection = ("Original", "AIService", "Photobooth")[index % 3]
+            with open(os.path.join("images", collection, f"cold-{index}.jpg"), "wb") as f:
+                f.write(os.urandom(size))
+        TrackingFolder.sync_index = SyncIndex()
+        uploads_before = len(fake_bucket.uploads)
+        started = time.perf_counter()
+        TrackingFolder.sync_existing_files_to_storage()
+        firebase_clients.get_metadata_writer().flush(timeout=60)
+        seconds = time.perf_counter() - started
+    return summarize(fake_bucket.uploads[uploads_before:], seconds, ops=files, files=files, bytes=size,
+                     workers=TrackingFolder.UPLOAD_WORKERS, storage_latency_ms=fake_bucket.latency * 1000)
+
+def bench_image_processor(workspace, images=20, size=1600):
+    """ImageProcessor.simulate_anime_generation one image at a time: decode, resize, model, encode"""
+    install_fakes()
+    import ai_model_server
+
+    folder = os.path.join(workspace, f"processor-{size}")
+    os.makedirs(folder, exist_ok=True)
+    paths = write_images(folder, images, size)
+    processor = ai_model_server.ImageProcessor()
+    latencies = []
+    started = time.perf_counter()
+    for path in paths:
+        began = time.perf_counter()
+        if not processor.simulate_anime_generation(path, path + ".out.png"):
+            raise RuntimeError(f"Generation failed for {path}")
+        latencies.append(time.perf_counter() - began)
+    seconds = time.perf_counter() - started
+    return summarize(latencies, seconds, images=images, size=size, backend=ai_model_server.AI_BACKEND)
+
+def bench_processing_pool(workspace, images=40, size=1024):
+    """ProcessingPool end to end (file → cache miss → worker → Firestore + broadcast): jobs/sec, job latency"""
+    install_fakes()
+    import ai_model_server
+
+    class TimedPool(ai_model_server.ProcessingPool):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.latencies = []
+
+        def _record(self, success, wait_seconds, generate_seconds, total_seconds, reused=False):
+            super()._record(success, wait_seconds, generate_seconds, total_seconds, reused)
+            self.latencies.append(total_seconds)
+
+    with working_directory(workspace):
+        paths = write_images(os.path.join("images", "Original"), images, size, prefix=f"pool-{size}")
+        pool = TimedPool(ai_model_server.ImageProcessor())
+        pool.start()
+        started = time.perf_counter()
+        for path in paths:
+            pool.submit(path, os.path.basename(path))
+        pool.jobs.join()
+        seconds = time.perf_counter() - started
+        pool.shutdown(drain=True)
+    return summarize(pool.latencies, seconds, ops=images, images=images, size=size, workers=pool.workers,
+                     backend=ai_model_server.AI_BACKEND)
+
+def bench_ai_nodes(workspace, jobs=100, nodes=2, seconds_per_image=0.05, capacity=2):
+    """Dispatcher streaming jobs to fake AI nodes over worker_protocol: jobs/sec, submit → result latency"""
+    import worker_protocol
+    from dispatcher import Dispatcher
+
+    folder = os.path.join(workspace, "dispatch")
+    os.makedirs(folder, exist_ok=True)
+    latencies = []
+    with stub_endpoint() as hub_url:
+        addresses = start_fake_ai_nodes(hub_url, nodes, seconds_per_image, capacity)
+
+        def send_batch(address, batch):
+            def on_result(job, header, payload):
+                latencies.append(time.monotonic() - job["submitted"])
+                dispatcher.complete(job["id"], address, header.get("status") == "done")
+
+            for job in worker_protocol.deliver_stream(address, batch, on_result, timeout=30):
+                dispatcher.complete(job["id"], address, success=False)
+
+        dispatcher = Dispatcher(send_batch=send_batch, job_timeout=30)
+        for address in addresses:
+            dispatcher.register(address, capacity)
+        dispatcher.start()
+        started = time.perf_counter()
+        for index in range(jobs):
+            path = os.path.join(folder, f"request-{index}.png")
+            with open(path, "wb") as f:
+                f.write(os.urandom(64 * 1024))
+            dispatcher.submit(path)
+        dispatcher.wait_idle(timeout=120)
+        seconds = time.perf_counter() - started
+        dispatcher.stop()
+    return summarize(latencies, seconds, ops=jobs, jobs=jobs, nodes=nodes, capacity=capacity,
+                     seconds_per_image=seconds_per_image)
+
+SCENARIOS = {
+    "upload_burst": bench_upload_burst,
+    "websocket_fanout": bench_websocket_fanout,
+    "cold_sync": bench_cold_sync,
+    "image_processor": bench_image_processor,
+    "processing_pool": bench_processing_pool,
+    "ai_nodes": bench_ai_nodes,
+}
+
+# --quick: cỡ nhỏ để kiểm tra nhanh, không dùng để so sánh với kết quả đầy đủ
+QUICK_PARAMS = {
+    "upload_burst": {"uploads": 40, "concurrency": 8},
+    "websocket_fanout": {"subscribers": 20, "messages": 20},
+    "cold_sync": {"files": 60},
+    "image_processor": {"images": 4},
+    "processing_pool": {"images": 8},
+    "ai_nodes": {"jobs": 20},
+}
+
+#--------------------------------------------------------Lưu và so sánh kết quả---------------------------------------------------------------
+
+def git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def save_results(results, directory=BENCH_RESULTS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(directory, f"bench-{stamp}-{results['version'] or 'unknown'}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+def latest_results(directory=BENCH_RESULTS_DIR, exclude=None):
+    if not os.path.isdir(directory):
+        return None
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.startswith("bench-") and name.endswith(".json"))
+    paths = [path for path in paths if path != exclude]
+    return paths[-1] if paths else None
+
+def compare(current, baseline, tolerance=BENCH_TOLERANCE):
+    """Regressions of current against baseline: p95 up or ops/sec down by more than tolerance.
+
+    A scenario of this run that errors, or has no result, where the
+    baseline succeeded is a regression too.
+    """
+    regressions = []
+    for name in current.get("requested", current["scenarios"]):
+        before = baseline.get("scenarios", {}).get(name)
+        result = current["scenarios"].get(name)
+        if not before or "error" in before:
+            continue
+        if result is None or "error" in result:
+            regressions.append(f"{name}: {result['error'] if result else 'no result'} (baseline succeeded)")
+            continue
+        if before.get("params") != result.get("params"):
+            print(f"⚠️  {name}: parameters differ from the baseline, not compared")
+            continue
+        if before.get("p95_ms") and result.get("p95_ms") and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']} → {result['p95_ms']} ms")
+        if before.get("ops_per_sec") and result.get("ops_per_sec") \
+                and result["ops_per_sec"] < before["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {before['ops_per_sec']} → {result['ops_per_sec']} ops/s")
+    return regressions
+
+def run(names, quick=False):
+    """Run the scenarios in a throw-away workspace and return the results document"""
+    # Máy AI giả nhận broadcast; backend numpy vì simulator chỉ ngủ 2 giây mỗi ảnh
+    os.environ.setdefault("AI_BACKEND", "numpy")
+    workspace = make_workspace(tempfile.mkdtemp(prefix="itsc-bench-"))
+    sys.path.insert(0, ROOT)
+    results = {"version": git_version(), "time": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": sys.version.split()[0], "quick": quick, "requested": list(names), "scenarios": {}}
+    try:
+        with stub_endpoint() as broadcast_url, working_directory(workspace):
+            os.environ.setdefault("BROADCAST_URL", f"{broadcast_url}/api/broadcast")
+            for name in names:
+                print(f"🏁 {name}...")
+                try:
+                    result = SCENARIOS[name](workspace, **(QUICK_PARAMS[name] if quick else {}))
+                except Exception as e:
+                    print(f"❌ {name} failed: {e}")
+                    result = {"error": str(e)}
+                results["scenarios"][name] = result
+                if "error" not in result:
+                    print(f"📊 {name:<18} {result['ops_per_sec']:>9} ops/s | p50 {result['p50_ms']} ms | "
+                          f"p95 {result['p95_ms']} ms | p99 {result['p99_ms']} ms")
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+    return results
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    names = [arg for arg in args if arg in SCENARIOS] or list(SCENARIOS)
+    unknown = [arg for arg in args if not arg.startswith("--") and arg not in SCENARIOS and not arg.endswith(".json")]
+    if unknown:
+        print(f"Unknown scenario(s) {unknown}, choose from {list(SCENARIOS)}")
+        sys.exit(2)
+    results = run(names, quick="--quick" in args)
+    path = save_results(results)
+    print(f"💾 Results saved to {path}")
+    # Kịch bản lỗi luôn làm lần chạy thất bại, kể cả khi không so sánh
+    errors = [name for name, result in results["scenarios"].items() if "error" in result]
+    if errors:
+        print(f"❌ {len(errors)} scenario(s) failed: {', '.join(errors)}")
+
+    if "--compare" in args:
+        # --compare baseline.json, hoặc so với lần chạy gần nhất trước đó
+        explicit = [arg for arg in args if arg.endswith(".json")]
+        baseline_path = explicit[0] if explicit else latest_results(exclude=path)
+        if baseline_path is None:
+            print("⚠️  No earlier results to compare with")
+            sys.exit(1 if errors else 0)
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        print(f"🔍 Compared with {os.path.basename(baseline_path)} (version {baseline.get('version')})")
+        for line in regressions:
+            print(f"🐢 Regression: {line}")
+        if regressions:
+            sys.exit(1)
+        print("✅ No regressions")
+    if errors:
+        sys.exit(1)
@@ -0,0 +1,565 @@
+import os
+import sys
+import time
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Điều phối ảnh tới các máy AI: mỗi máy có số slot riêng, job quá hạn được giao lại cho máy khác
+JOB_TIMEOUT = float(os.environ.get("AI_JOB_TIMEOUT", 120))
+HEARTBEAT_INTERVAL = float(os.environ.get("AI_HEARTBEAT_INTERVAL", 5))
+HEARTBEAT_TIMEOUT = float(os.environ.get("AI_HEARTBEAT_TIMEOUT", 3 * HEARTBEAT_INTERVAL))
+MAX_ATTEMPTS = int(os.environ.get("AI_MAX_ATTEMPTS", 3))
+DISPATCH_POLICY = os.environ.get("AI_DISPATCH_POLICY", "latency")  # "latency" hoặc "least_loaded"
+LATENCY_SMOOTHING = 0.3
+# Gửi tới một máy thất bại thì tạm nghỉ máy đó, lần lỗi sau nghỉ lâu gấp đôi
+NODE_BACKOFF = float(os.environ.get("AI_NODE_BACKOFF", 2))
+NODE_BACKOFF_MAX = float(os.environ.get("AI_NODE_BACKOFF_MAX", 60))
+
+class Node:
+    """One AI machine: how many images it may hold at once and how fast it has been"""
+
+    def __init__(self, address, capacity=1):
+        self.address = address
+        self.capacity = max(1, int(capacity))
+        self.in_flight = set()
+        self.latency = None  # trung bình trượt số giây cho một job
+        self.last_seen = time.monotonic()
+        self.beats = False  # máy chưa từng gửi heartbeat chỉ bị loại khi job quá hạn
+        self.alive = True
+        self.completed = 0
+        self.failed = 0
+        self.send_failures = 0  # lỗi gửi liên tiếp, về 0 khi gửi được
+        self.retry_at = 0.0
+
+    def available(self, now=None):
+        """Alive and not backing off after failed sends"""
+        return self.alive and (now or time.monotonic()) >= self.retry_at
+
+    def free_slots(self):
+        return self.capacity - len(self.in_flight) if self.available() else 0
+
+    def back_off(self):
+        self.send_failures += 1
+        delay = min(NODE_BACKOFF * 2 ** (self.send_failures - 1), NODE_BACKOFF_MAX)
+        self.retry_at = time.monotonic() + delay
+        return delay
+
+    def info(self):
+        return {"address": self.address, "capacity": self.capacity, "in_flight": len(self.in_flight),
+                "alive": self.alive, "latency": self.latency, "completed": self.completed,
+                "failed": self.failed, "last_seen": round(time.monotonic() - self.last_seen, 1),
+                "backoff": round(max(self.retry_at - time.monotonic(), 0), 1)}
+
+class Dispatcher:
+    """Hands queued jobs to registered AI nodes and tracks them until they come back.
+
+    send(address, job) delivers one job and returns True once the node has
+    accepted it; the result arrives later through complete(job_id). With
+    send_batch(address, jobs) instead, every free slot of the chosen node
+    is filled in one call, which completes jobs as their results stream
+    back and returns when the node has answered them all. A job
+    that is not completed within job_timeout, or whose node stops sending
+    heartbeats, goes back to the front of the queue, up to max_attempts
+    deliveries, and is handed to a different node when one is available.
+    A node that fails a send is skipped for an exponentially growing
+    backoff. Nodes join with register()/heartbeat() at any time.
+
+    With a JobQueue as store every state change is written to disk first,
+    so recover() after a restart resumes exactly the unfinished jobs.
+    """
+
+    def __init__(self, send=None, job_timeout=JOB_TIMEOUT, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS, policy=DISPATCH_POLICY, on_done=None, on_failed=None,
+                 store=None, queue_name="ai", send_batch=None):
+        if policy not in ("latency", "least_loaded"):
+            raise ValueError(f"Unknown dispatch policy '{policy}'")
+        if (send is None) == (send_batch is None):
+            raise ValueError("Pass exactly one of send or send_batch")
+        self.send = send
+        self.send_batch = send_batch
+        self.job_timeout = job_timeout
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.policy = policy
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.store = store
+        self.queue_name = queue_name
+        self.cond = threading.Condition()
+        self.nodes = {}
+        self.pending = deque()
+        self.jobs = {}
+        self.paths = {}
+        self.running = False
+        self.threads = []
+        self.senders = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ai-send")
+        self.stats = {"submitted": 0, "delivered": 0, "completed": 0, "duplicates": 0,
+                      "redelivered": 0, "timeouts": 0, "failed": 0}
+
+    # --- Danh sách máy AI ---
+
+    def register(self, address, capacity=1):
+        """Add a node, or update the capacity of a known one and mark it alive"""
+        with self.cond:
+            node = self.nodes.get(address)
+            if node is None:
+                node = self.nodes[address] = Node(address, capacity)
+                print(f"🖥️  AI node {address} joined with {node.capacity} slot(s)")
+            else:
+                node.capacity = max(1, int(capacity))
+                if not node.alive:
+                    print(f"🖥️  AI node {address} is back")
+                node.alive = True
+            node.last_seen = time.monotonic()
+            self.cond.notify_all()
+        return node
+
+    def heartbeat(self, address, capacity=None):
+        with self.cond:
+            node = self.nodes.get(address)
+            if node is None or not node.alive or (capacity and int(capacity) != node.capacity):
+                node = self.register(address, capacity or (node.capacity if node else 1))
+            node.beats = True
+            node.last_seen = time.monotonic()
+            return node
+
+    def remove(self, address):
+        """Take a node out of rotation; its in-flight jobs are redelivered"""
+        with self.cond:
+            node = self.nodes.get(address)
+            if node is not None:
+                self._mark_dead(node, "removed")
+
+    def _mark_dead(self, node, reason):
+        node.alive = False
+        print(f"💀 AI node {node.address} {reason}, redelivering {len(node.in_flight)} job(s)")
+        for job_id in list(node.in_flight):
+            self._requeue(self.jobs[job_id], reason)
+        node.in_flight.clear()
+
+    # --- Job ---
+
+    def submit(self, path, job_id=None, attempts=0):
+        """Queue an image; a path that is already queued or in flight keeps its job id"""
+        with self.cond:
+            if path in self.paths:
+                return self.paths[path]
+            if self.store is not None and job_id is None:
+                job_id, _ = self.store.enqueue(self.queue_name, path, max_attempts=self.max_attempts)
+            job_id = job_id or uuid.uuid4().hex
+            job = {"id": job_id, "path": path, "attempts": attempts, "node": None, "avoid": None,
+                   "deadline": None, "sent_at": None, "submitted": time.monotonic()}
+            self.jobs[job_id] = job
+            self.paths[path] = job_id
+            self.pending.append(job)
+            self.stats["submitted"] += 1
+            self.cond.notify_all()
+        return job_id
+
+    def complete(self, job_id, address=None, success=True):
+        """Record a result; True the first time, False for unknown or repeated job ids"""
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if address is not None and address in self.nodes:
+                self.nodes[address].last_seen = time.monotonic()
+            if job is None:
+                # Kết quả của một job giao trước khi khởi động lại vẫn được ghi nhận một lần
+                row = self.store.get(job_id) if self.store is not None else None
+                if row is None or not self.store.complete(job_id):
+                    self.stats["duplicates"] += 1
+                    return False
+                self.stats["completed"] += 1
+                job = {"id": job_id, "path": row["path"]}
+            else:
+                holder = job["node"]
+                node = self.nodes.get(address or holder)
+                self._release(job)
+                if not success:
+                    self._requeue(job, f"failed on {address or 'its node'}", avoid=address or holder)
+                    return True
+                # Kết quả muộn từ máy cũ sau khi job đã giao lại: sent_at là của lần giao mới, không tính độ trễ
+                if node is not None and node.address == holder and job["sent_at"] is not None:
+                    seconds = time.monotonic() - job["sent_at"]
+                    node.latency = seconds if node.latency is None else \
+                        LATENCY_SMOOTHING * seconds + (1 - LATENCY_SMOOTHING) * node.latency
+                if node is not None:
+                    node.completed += 1
+                del self.jobs[job_id]
+                self.paths.pop(job["path"], None)
+                if self.store is not None:
+                    self.store.complete(job_id)
+                self.stats["completed"] += 1
+                self.cond.notify_all()
+        if self.on_done:
+            self.on_done(job)
+        return True
+
+    def _release(self, job):
+        node = self.nodes.get(job["node"])
+        if node is not None:
+            node.in_flight.discard(job["id"])
+        job["node"] = None
+        job["deadline"] = None
+        self.cond.notify_all()
+
+    def _requeue(self, job, reason, avoid=None):
+        """Put a job back at the front of the queue, or give up after max_attempts (lock held).
+
+        The next delivery avoids the node it just failed on, if another one is up.
+        """
+        job["avoid"] = avoid or job["node"]
+        job["node"] = None
+        job["deadline"] = None
+        if job["attempts"] >= self.max_attempts:
+            print(f"❌ Giving up on {job['path']} after {job['attempts']} attempts ({reason})")
+            if self.store is not None:
+                self.store.fail(job["id"], reason)
+            del self.jobs[job["id"]]
+            self.paths.pop(job["path"], None)
+            self.stats["failed"] += 1
+            if self.on_failed:
+                threading.Thread(target=self.on_failed, args=(job,), daemon=True).start()
+            return
+        print(f"🔁 Redelivering {os.path.basename(job['path'])} ({reason})")
+        if self.store is not None:
+            self.store.release(job["id"], reason)
+        self.pending.appendleft(job)
+        self.stats["redelivered"] += 1
+        self.cond.notify_all()
+
+    def _allowed(self, node, job):
+        """False while the job should wait for another node than the one it failed on"""
+        if job.get("avoid") != node.address:
+            return True
+        now = time.monotonic()
+        return not any(other.available(now) for other in self.nodes.values() if other is not node)
+
+    def _pick_node(self, job=None):
+        """Node expected to finish the next job soonest, or None when every slot is taken"""
+        candidates = [node for node in self.nodes.values()
+                      if node.free_slots() > 0 and (job is None or self._allowed(node, job))]
+        if not candidates:
+            return None
+        if self.policy == "least_loaded":
+            return min(candidates, key=lambda node: len(node.in_flight) / node.capacity)
+        known = [node.latency for node in self.nodes.values() if node.latency]
+        default = sum(known) / len(known) if known else 1.0
+        # Thời gian chờ dự kiến: số job đang giữ cộng job mới, chia cho số slot, nhân độ trễ của máy
+        return min(candidates, key=lambda node: (len(node.in_flight) + 1) / node.capacity * (node.latency or default))
+
+    def _next_node(self):
+        """Node for the oldest job that can be sent right now, or None"""
+        picked = {}
+        for job in self.pending:
+            avoid = job.get("avoid")
+            if avoid not in picked:
+                picked[avoid] = self._pick_node(job)
+            if picked[avoid] is not None:
+                return picked[avoid]
+        return None
+
+    def _backoff_wait(self):
+        """Seconds until the next backing-off node is usable again, or None"""
+        now = time.monotonic()
+        waits = [node.retry_at - now for node in self.nodes.values() if node.alive and node.retry_at > now]
+        return min(waits) if waits else None
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                while self.running and not (self.pending and self._next_node()):
+                    self.cond.wait(self._backoff_wait())
+                if not self.running:
+                    return
+                node = self._next_node()
+                # Giao thức stream: gửi một lần đủ job cho mọi slot còn trống của máy
+                count = node.free_slots() if self.send_batch else 1
+                batch = []
+                skipped = []
+                while self.pending and len(batch) < count:
+                    job = self.pending.popleft()
+                    if not self._allowed(node, job):
+                        skipped.append(job)
+                        continue
+                    if self.store is not None and not self.store.lease_job(job["id"], node.address, self.job_timeout):
+                        # Job đã xong hoặc thất bại trên đĩa (kết quả đến muộn), bỏ khỏi bộ nhớ
+                        self.jobs.pop(job["id"], None)
+                        self.paths.pop(job["path"], None)
+                        continue
+                    job["attempts"] += 1
+                    job["node"] = node.address
+                    job["sent_at"] = time.monotonic()
+                    job["deadline"] = job["sent_at"] + self.job_timeout
+                    node.in_flight.add(job["id"])
+                    batch.append((job, job["attempts"]))
+                self.pending.extendleft(reversed(skipped))
+            if batch:
+                self.senders.submit(self._deliver, node, batch)
+
+    def _deliver(self, node, batch):
+        jobs = [job for job, _ in batch]
+        names = ", ".join(os.path.basename(job["path"]) for job in jobs)
+        try:
+            if self.send_batch:
+                # Kết quả về trong lúc gửi; job nào node không trả lời được đưa lại hàng đợi
+                self.send_batch(node.address, jobs)
+                accepted = True
+            else:
+                accepted = self.send(node.address, jobs[0])
+        except Exception as e:
+            print(f"⚠️  Could not send {names} to {node.address}: {e}")
+            accepted = False
+        with self.cond:
+            if accepted:
+                self.stats["delivered"] += len(jobs)
+                node.last_seen = time.monotonic()
+                node.send_failures = 0
+                return
+            node.failed += 1
+            # Kể cả máy chưa từng gửi heartbeat (AI_NODES) cũng ra khỏi vòng chọn một thời gian
+            delay = node.back_off()
+            print(f"⏸️  AI node {node.address} skipped for {delay:.1f}s after {node.send_failures} failed send(s)")
+            for job, attempt in batch:
+                # Job có thể đã được hoàn thành hoặc giao lại trong lúc gửi
+                if self.jobs.get(job["id"]) is job and job["node"] == node.address and job["attempts"] == attempt:
+                    node.in_flight.discard(job["id"])
+                    self._requeue(job, f"send to {node.address} failed")
+
+    def _reaper_loop(self):
+        while self.running:
+            time.sleep(min(1.0, self.heartbeat_timeout / 3))
+            now = time.monotonic()
+            with self.cond:
+                for node in self.nodes.values():
+                    if node.alive and node.beats and now - node.last_seen > self.heartbeat_timeout:
+                        self._mark_dead(node, "missed its heartbeats")
+                for job in list(self.jobs.values()):
+                    if job["deadline"] is not None and now > job["deadline"]:
+                        node = self.nodes.get(job["node"])
+                        if node is not None:
+                            node.in_flight.discard(job["id"])
+                        self.stats["timeouts"] += 1
+                        self._requeue(job, f"timed out on {job['node']}")
+
+    def recover(self):
+        """Reload the unfinished jobs of the store; leases of the previous run count as attempts"""
+        if self.store is None:
+            return 0
+        jobs = self.store.recover(self.queue_name)
+        for job in jobs:
+            self.submit(job["path"], job["id"], job["attempts"])
+        if jobs:
+            print(f"♻️  Resumed {len(jobs)} unfinished AI job(s)")
+        return len(jobs)
+
+    def start(self):
+        self.running = True
+        for target, name in ((self._dispatch_loop, "ai-dispatch"), (self._reaper_loop, "ai-reaper")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.senders.shutdown(wait=True)
+
+    def wait_idle(self, timeout=None):
+        """Block until no job is queued or in flight"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.jobs, timeout)
+
+    def summary(self):
+        with self.cond:
+            return {**self.stats, "queued": len(self.pending),
+                    "in_flight": sum(len(node.in_flight) for node in self.nodes.values()),
+                    "nodes": [node.info() for node in self.nodes.values()]}
+
+# --- Máy AI giả lập để chạy thử điều phối trên một máy ---
+
+def run_standin_node(port, hub_url, seconds=0.5, capacity=1, host="127.0.0.1"):
+    """Local stand-in for an AI machine.
+
+    Accepts POST /image/post like a real node, waits `seconds` per image
+    (up to `capacity` at a time), then posts the image back to
+    {hub_url}/upload with its address and the job id. POST /image/stream
+    speaks worker_protocol instead: it starts each image as soon as its
+    frame arrives and streams results back as they finish. Sends a
+    heartbeat to {hub_url}/nodes/heartbeat every HEARTBEAT_INTERVAL.
+    """
+    import io
+    import email
+    import queue
+    import requests
+    import http_client
+    import worker_protocol
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    address = f"{host}:{port}"
+    slots = threading.Semaphore(capacity)
+
+    def process(job_id, filename, content):
+        with slots:
+            time.sleep(seconds)
+            http_client.post(f"{hub_url}/upload", data={"IP": address, "job_id": job_id},
+                             files={"file": (filename, content)}, timeout=10)
+
+    workers = ThreadPoolExecutor(max_workers=capacity)
+
+    def generate(header, payload, results):
+        time.sleep(seconds)
+        results.put(worker_protocol.encode_frame(
+            {"job_id": header["job_id"], "status": "done", "filename": f"ai-{header['filename']}"}, payload))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path == worker_protocol.STREAM_PATH:
+                return self.stream()
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            message = email.message_from_bytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+            job_id = fields["job_id"].get_payload(decode=True).decode()
+            threading.Thread(target=process, daemon=True,
+                             args=(job_id, fields["file"].get_filename(), fields["file"].get_payload(decode=True))).start()
+            reply = b'{"accepted": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def stream(self):
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                body = io.BufferedReader(worker_protocol.ChunkedReader(self.rfile))
+            else:
+                body = io.BytesIO(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            results = queue.Queue()
+            # Bắt đầu xử lý từng ảnh ngay khi đọc xong frame của nó
+            futures = [workers.submit(generate, header, payload, results)
+                       for header, payload in worker_protocol.read_frames(body)]
+            self.send_response(200)
+            self.send_header("Content-Type", worker_protocol.FRAME_CONTENT_TYPE)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for _ in futures:
+                worker_protocol.write_chunk(self.wfile, results.get())
+            worker_protocol.write_chunk(self.wfile, b"")
+
+        def log_message(self, *args):
+            pass
+
+    def beat():
+        while True:
+            try:
+                http_client.post(f"{hub_url}/nodes/heartbeat", json={"address": address, "capacity": capacity}, timeout=2)
+            except requests.RequestException:
+                pass
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    threading.Thread(target=beat, daemon=True).start()
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+def demo(jobs=30, hub_port=5055, stream=False):
+    """Dispatch `jobs` images to three stand-in nodes of different speed and kill one halfway"""
+    import json
+    import worker_protocol
+    import shutil
+    import tempfile
+    from job_queue import JobQueue
+    import multiprocessing
+    import http_client
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    global HEARTBEAT_INTERVAL
+    HEARTBEAT_INTERVAL = 0.5
+    hub_url = f"http://127.0.0.1:{hub_port}"
+
+    def send(address, job):
+        with open(job["path"], "rb") as f:
+            response = http_client.post(f"http://{address}/image/post", data={"job_id": job["id"]},
+                                     files={"file": f}, timeout=5)
+        return response.status_code == 200
+
+    def on_result(job, header, payload):
+        dispatcher.complete(job["id"], header.get("address"), header.get("status") == "done")
+
+    def send_batch(address, batch):
+        for job in worker_protocol.deliver_stream(address, batch, on_result, timeout=5):
+            dispatcher.complete(job["id"], address, success=False)
+
+    folder = tempfile.mkdtemp()
+    store = JobQueue(os.path.join(folder, "jobs.sqlite"))
+    senders = {"send_batch": send_batch} if stream else {"send": send}
+    dispatcher = Dispatcher(job_timeout=5, heartbeat_timeout=2, store=store, **senders)
+
+    class Hub(BaseHTTPRequestHandler):
+        # Phiên bản tối giản của /upload và /nodes/heartbeat trong ServerForAI.py
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/nodes/heartbeat":
+                data = json.loads(body)
+                dispatcher.heartbeat(data["address"], data.get("capacity"))
+            else:
+                import email
+                message = email.message_from_bytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+                fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                          for part in message.get_payload()}
+                dispatcher.complete(fields["job_id"].decode(), fields["IP"].decode())
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    hub = ThreadingHTTPServer(("127.0.0.1", hub_port), Hub)
+    threading.Thread(target=hub.serve_forever, daemon=True).start()
+
+    # (port, giây mỗi ảnh, số slot): một máy nhanh 2 slot, một máy vừa, một máy chậm sẽ bị tắt
+    specs = [(5061, 0.2, 2), (5062, 0.5, 1), (5063, 1.0, 1)]
+    nodes = []
+    for port, seconds, capacity in specs:
+        process = multiprocessing.Process(target=run_standin_node, args=(port, hub_url, seconds, capacity), daemon=True)
+        process.start()
+        nodes.append(process)
+    dispatcher.start()
+    deadline = time.monotonic() + 10
+    while len([n for n in dispatcher.nodes.values() if n.alive]) < len(specs) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    started = time.perf_counter()
+    for index in range(jobs):
+        path = os.path.join(folder, f"request-{index}.png")
+        with open(path, "wb") as f:
+            f.write(os.urandom(2048))
+        dispatcher.submit(path)
+    time.sleep(1.5)
+    nodes[-1].terminate()
+    print("🔌 Stopped the slow node")
+    dispatcher.wait_idle(timeout=60)
+    elapsed = time.perf_counter() - started
+    print(f"💾 Job queue: {store.counts(dispatcher.queue_name)}")
+    shutil.rmtree(folder, ignore_errors=True)
+
+    summary = dispatcher.summary()
+    dispatcher.stop()
+    hub.shutdown()
+    print(f"📊 {summary['completed']}/{jobs} jobs in {elapsed:.2f}s ({summary['completed'] / elapsed:.1f} jobs/s), "
+          f"redelivered {summary['redelivered']}, duplicates {summary['duplicates']}, failed {summary['failed']}")
+    for node in summary["nodes"]:
+        latency = f"{node['latency']:.2f}s" if node["latency"] else "-"
+        print(f"   {node['address']}: {node['completed']} done, latency {latency}, alive={node['alive']}")
+
+if __name__ == "__main__":
+    # python dispatcher.py [jobs] [--stream]
+    demo(*(int(arg) for arg in sys.argv[1:] if arg.isdigit()), stream="--stream" in sys.argv)
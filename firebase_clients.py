@@ -0,0 +1,74 @@
+import os
+import time
+import threading
+
+# Client Firebase được tạo khi dùng lần đầu chứ không phải lúc import:
+# service mở cổng / theo dõi thư mục ngay, không phải chờ SDK và emulator
+FIREBASE_CREDENTIALS = os.environ.get("FIREBASE_CREDENTIALS", "serviceAccount.json")
+FIREBASE_PROJECT = os.environ.get("FIREBASE_PROJECT", "itsc")
+STORAGE_BUCKET = os.environ.get("STORAGE_BUCKET", "itsc.appspot.com")
+
+_lock = threading.RLock()
+_clients = {}
+
+def _once(name, create):
+    with _lock:
+        if name not in _clients:
+            started = time.perf_counter()
+            _clients[name] = create()
+            print(f"🔌 {name} ready in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return _clients[name]
+
+def _initialize_app():
+    import firebase_admin
+    from firebase_admin import credentials
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(FIREBASE_CREDENTIALS),
+                                      {"projectId": FIREBASE_PROJECT, "storageBucket": STORAGE_BUCKET})
+    return True
+
+def get_db():
+    """The Firestore client of this process"""
+    def create():
+        _once("Firebase app", _initialize_app)
+        from firebase_admin import firestore as admin_firestore
+        return admin_firestore.client()
+    return _once("Firestore client", create)
+
+def get_bucket():
+    """The Storage bucket, through an anonymous client (the emulator needs no credentials)"""
+    def create():
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import storage as gcs
+        return gcs.Client(project=FIREBASE_PROJECT, credentials=AnonymousCredentials()).bucket(STORAGE_BUCKET)
+    return _once("Storage bucket", create)
+
+def get_metadata_writer():
+    """The shared batched Firestore writer of this process"""
+    def create():
+        from firestore_writer import MetadataWriter
+        return MetadataWriter(get_db())
+    return _once("Firestore writer", create)
+
+def server_timestamp():
+    from firebase_admin import firestore as admin_firestore
+    return admin_firestore.SERVER_TIMESTAMP
+
+def prefetch(*getters):
+    """Create clients on a background thread so the first request does not pay for it"""
+    def run():
+        for getter in getters:
+            try:
+                getter()
+            except Exception as e:
+                print(f"⚠️  Firebase init error: {e}")
+
+    thread = threading.Thread(target=run, name="firebase-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+def close():
+    """Commit what the metadata writer still buffers, if one was created"""
+    writer = _clients.get("Firestore writer")
+    if writer is not None:
+        writer.close()
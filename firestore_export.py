@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+
+# Bản sao lưu Firestore ra đĩa: ghi từng document một lần khi đọc, không ghi lại cả file
+EXPORT_DIR = os.environ.get("FIRESTORE_EXPORT_DIR", "images/firestore")
+EXPORT_FORMATS = ("json", "ndjson", "columnar")
+# Số byte cuối của .ndjson được băm vào watermark để nhận ra file đúng là file mình đã ghi
+WATERMARK_TAIL_BYTES = 64 * 1024
+
+class FirestoreJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if hasattr(obj, 'isoformat'):
+            return obj.isoformat()
+        return super().default(obj)
+
+class _JsonArrayWriter:
+    """The legacy images/firestore/{name}.json: one indented array, written element by element"""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        f.write("[")
+
+    def write(self, record):
+        self.f.write(",\n  " if self.count else "\n  ")
+        text = json.dumps(record, ensure_ascii=False, indent=2, cls=FirestoreJSONEncoder)
+        self.f.write(text.replace("\n", "\n  "))
+        self.count += 1
+
+    def close(self):
+        self.f.write("\n]" if self.count else "]")
+
+class _NdjsonWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":"), cls=FirestoreJSONEncoder))
+        self.f.write("\n")
+
+    def close(self):
+        pass
+
+class _ColumnarWriter:
+    """Compact column-oriented JSON: {"rows": n, "columns": {field: [value per row]}}.
+
+    Field names are stored once instead of once per document; a field a
+    document lacks is null in that row.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.columns = {}
+        self.rows = 0
+
+    def write(self, record):
+        for field, value in record.items():
+            column = self.columns.get(field)
+            if column is None:
+                column = self.columns[field] = [None] * self.rows
+            column.append(value)
+        self.rows += 1
+        for column in self.columns.values():
+            if len(column) < self.rows:
+                column.append(None)
+
+    def close(self):
+        json.dump({"rows": self.rows, "columns": self.columns}, self.f,
+                  ensure_ascii=False, separators=(",", ":"), cls=FirestoreJSONEncoder)
+
+WRITERS = {
+    "json": (".json", _JsonArrayWriter),
+    "ndjson": (".ndjson", _NdjsonWriter),
+    "columnar": (".columns.json", _ColumnarWriter),
+}
+
+def _watermark_path(export_dir, name):
+    return os.path.join(export_dir, f".{name}.watermark.json")
+
+def _tail_digest(path, size):
+    """sha256 of the WATERMARK_TAIL_BYTES bytes that end at `size`"""
+    start = max(0, size - WATERMARK_TAIL_BYTES)
+    with open(path, "rb") as f:
+        f.seek(start)
+        return hashlib.sha256(f.read(size - start)).hexdigest()
+
+def load_watermark(name, export_dir=EXPORT_DIR):
+    """Last exported `time` of a collection, the ids exported at exactly that time and what the NDJSON looked like then"""
+    try:
+        with open(_watermark_path(export_dir, name), encoding="utf-8") as f:
+            state = json.load(f)
+        state["time"] = datetime.datetime.fromisoformat(state["time"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return state
+
+def _save_watermark(name, export_dir, last_time, ids_at_time, ndjson_path):
+    stat = os.stat(ndjson_path)
+    path = _watermark_path(export_dir, name)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"time": last_time.isoformat(), "ids": sorted(ids_at_time), "bytes": stat.st_size,
+                   "mtime_ns": stat.st_mtime_ns, "tail": _tail_digest(ndjson_path, stat.st_size)}, f)
+    os.replace(path + ".tmp", path)
+
+def _drop_watermark(name, export_dir):
+    try:
+        os.remove(_watermark_path(export_dir, name))
+    except FileNotFoundError:
+        pass
+
+def _resume_point(ndjson_path, watermark):
+    """Whether `ndjson_path` is the file the watermark describes, truncating a half-written append.
+
+    The same size and mtime means nobody touched the file since the
+    watermark was saved. A larger file whose first `bytes` bytes still end
+    with the saved tail is the same file with an interrupted append after
+    it, which is cut off. Anything else (a full export that forgot the
+    watermark, a hand-edited or replaced file) is not ours to truncate.
+    """
+    if watermark is None or "tail" not in watermark:
+        return False
+    try:
+        stat = os.stat(ndjson_path)
+    except FileNotFoundError:
+        return False
+    size = watermark["bytes"]
+    if stat.st_size == size and stat.st_mtime_ns == watermark.get("mtime_ns"):
+        return True
+    if stat.st_size < size or _tail_digest(ndjson_path, size) != watermark["tail"]:
+        return False
+    with open(ndjson_path, "r+b") as f:
+        f.truncate(size)
+    return True
+
+def export_collection(client, name, formats=("json", "ndjson"), incremental=False, export_dir=EXPORT_DIR):
+    """Export one collection in a single pass over its documents.
+
+    Full mode writes every requested format to a temporary file and swaps
+    it in at the end; when that includes {name}.ndjson the watermark is
+    rewritten to match it. Incremental mode only appends documents whose
+    `time` is newer than the saved watermark to {name}.ndjson (documents
+    without a `time` field are only covered by full exports). If there is
+    no watermark, or the file on disk is not the one it describes, the
+    NDJSON is rewritten in full instead. Returns a report with the
+    document count, bytes written and docs/sec.
+    """
+    unknown = set(formats) - set(WRITERS)
+    if unknown:
+        raise ValueError(f"Unknown export format(s) {sorted(unknown)}, choose from {list(WRITERS)}")
+    os.makedirs(export_dir, exist_ok=True)
+    started = time.perf_counter()
+    collection = client.collection(name)
+    ndjson_path = os.path.join(export_dir, f"{name}.ndjson")
+    watermark = load_watermark(name, export_dir) if incremental else None
+    if incremental and not _resume_point(ndjson_path, watermark):
+        # Không chắc .ndjson là file của watermark: ghi lại toàn bộ thay vì cắt file của người khác
+        print(f"⚠️ {ndjson_path} {'does not match its watermark' if watermark else 'has no watermark'}, rewriting it in full")
+        incremental, formats, watermark = False, ("ndjson",), None
+    last_time = watermark["time"] if watermark else None
+    ids_at_time = set(watermark["ids"]) if watermark else set()
+
+    if incremental:
+        query = collection.where("time", ">=", last_time).order_by("time")
+        targets = {"ndjson": (ndjson_path, ndjson_path, "a")}
+    else:
+        query = collection
+        targets = {}
+        for fmt in formats:
+            path = os.path.join(export_dir, name + WRITERS[fmt][0])
+            targets[fmt] = (path, path + ".tmp", "w")
+
+    appended_from = os.path.getsize(targets["ndjson"][0]) if incremental and os.path.exists(targets["ndjson"][0]) else 0
+    files = {fmt: open(tmp, mode, encoding="utf-8") for fmt, (_, tmp, mode) in targets.items()}
+    writers = {fmt: WRITERS[fmt][1](f) for fmt, f in files.items()}
+    count = 0
+    try:
+        for doc in query.stream():
+            data = doc.to_dict()
+            doc_time = data.get("time")
+            if isinstance(doc_time, datetime.datetime):
+                if incremental and doc_time == last_time and doc.id in ids_at_time:
+                    continue
+                # Toàn bộ không theo thứ thời gian: chỉ giữ mốc lớn nhất và các id đúng ở mốc đó
+                if last_time is None or doc_time > last_time:
+                    last_time, ids_at_time = doc_time, {doc.id}
+                elif doc_time == last_time:
+                    ids_at_time.add(doc.id)
+            record = {"id": doc.id, **data}
+            for writer in writers.values():
+                writer.write(record)
+            count += 1
+        for writer in writers.values():
+            writer.close()
+    finally:
+        for f in files.values():
+            f.close()
+
+    written = 0
+    for fmt, (path, tmp, _) in targets.items():
+        if tmp != path:
+            os.replace(tmp, path)
+        written += os.path.getsize(path)
+    written -= appended_from
+    if "ndjson" in targets:
+        if last_time is not None:
+            _save_watermark(name, export_dir, last_time, ids_at_time, ndjson_path)
+        else:
+            _drop_watermark(name, export_dir)
+
+    seconds = time.perf_counter() - started
+    return {"collection": name, "docs": count, "seconds": seconds,
+            "docs_per_sec": count / seconds if seconds else 0.0, "bytes": written,
+            "files": [path for path, _, _ in targets.values()], "incremental": incremental}
@@ -0,0 +1,157 @@
+import time
+import atexit
+import threading
+import metrics
+
+# Firestore giới hạn 500 thao tác cho một batched write
+MAX_BATCH_SIZE = 500
+FLUSH_DEADLINE = 0.2
+WRITE_TIMEOUT = 30
+
+class WriteFailed(RuntimeError):
+    """The batch holding this document was dropped after all retries"""
+
+class MetadataWriter:
+    """Buffers gallery document writes and commits them as Firestore batched writes.
+
+    A batch is committed when it reaches MAX_BATCH_SIZE documents or when the
+    oldest buffered document has waited FLUSH_DEADLINE seconds, so a single
+    upload still shows up quickly while a bulk resync needs one round trip
+    per 500 documents instead of one per file.
+
+    A dropped batch is never silent: set() takes an on_failed callback and
+    returns a ticket for wait_for(), which raises WriteFailed. Request paths
+    that report success to a client use write(), which commits right away
+    and waits.
+    """
+
+    def __init__(self, client, flush_deadline=FLUSH_DEADLINE, max_batch_size=MAX_BATCH_SIZE):
+        self.client = client
+        self.flush_deadline = flush_deadline
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.oldest = None
+        self.queued = 0
+        self.committed = 0
+        self.stats = {"batches": 0, "documents": 0, "failed": 0}
+        self.failed_tickets = set()
+        self.closed = False
+        self.cond = threading.Condition()
+        metrics.track_queue("firestore_pending", lambda: len(self.pending))
+        self.thread = threading.Thread(target=self._run, name="firestore-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def set(self, doc_ref, data, merge=False, on_failed=None, urgent=False):
+        """Queue doc_ref.set(data); returns the number to pass to wait_for().
+
+        on_failed() runs on the writer thread if the batch is dropped.
+        urgent=True commits without waiting for the flush deadline.
+        """
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("MetadataWriter is closed")
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.queued += 1
+            self.pending.append((doc_ref, data, merge, self.queued, on_failed))
+            if urgent:
+                self.oldest = 0
+            self.cond.notify_all()
+            return self.queued
+
+    def wait_for(self, ticket, timeout=None):
+        """Block until the write numbered ticket is committed: True, or False on timeout.
+
+        Raises WriteFailed when its batch was dropped.
+        """
+        with self.cond:
+            done = self.cond.wait_for(lambda: self.committed >= ticket, timeout)
+            if done and ticket in self.failed_tickets:
+                self.failed_tickets.discard(ticket)
+                raise WriteFailed(f"Firestore write {ticket} was dropped")
+            return done
+
+    def write(self, doc_ref, data, merge=False, timeout=WRITE_TIMEOUT):
+        """Commit one document now and wait for it; raises WriteFailed or TimeoutError"""
+        ticket = self.set(doc_ref, data, merge, urgent=True)
+        if not self.wait_for(ticket, timeout):
+            raise TimeoutError(f"Firestore write {ticket} not committed after {timeout}s")
+
+    def flush(self, timeout=None):
+        """Commit everything queued so far and wait for it"""
+        with self.cond:
+            ticket = self.queued
+            self.oldest = 0
+            self.cond.notify_all()
+        return self.wait_for(ticket, timeout)
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.oldest = 0
+            self.cond.notify_all()
+        self.thread.join()
+
+    def _ready(self):
+        if not self.pending:
+            return False
+        if self.closed or len(self.pending) >= self.max_batch_size:
+            return True
+        return time.monotonic() - self.oldest >= self.flush_deadline
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self._ready():
+                    if self.closed and not self.pending:
+                        return
+                    timeout = None
+                    if self.pending:
+                        timeout = max(self.flush_deadline - (time.monotonic() - self.oldest), 0)
+                    self.cond.wait(timeout)
+                items = self.pending[:self.max_batch_size]
+                del self.pending[:self.max_batch_size]
+                # flush()/close() đặt oldest = 0, khi đó không biết doc đã chờ bao lâu
+                queued_at = self.oldest
+                self.oldest = time.monotonic() if self.pending else None
+
+            started = time.monotonic()
+            ok = self._commit(items)
+            finished = time.monotonic()
+            metrics.observe_stage("firestore_commit", finished - started)
+            if queued_at:
+                metrics.observe_stage("firestore_set", finished - queued_at)
+            metrics.count("firestore_documents" if ok else "firestore_dropped", len(items))
+            with self.cond:
+                self.committed += len(items)
+                if ok:
+                    self.stats["batches"] += 1
+                    self.stats["documents"] += len(items)
+                else:
+                    self.stats["failed"] += len(items)
+                    self.failed_tickets.update(ticket for _, _, _, ticket, _ in items)
+                self.cond.notify_all()
+            if not ok:
+                for _, _, _, _, on_failed in items:
+                    if on_failed:
+                        try:
+                            on_failed()
+                        except Exception as e:
+                            print(f"⚠️  on_failed callback error: {e}")
+
+    def _commit(self, items):
+        for attempt in range(3):
+            try:
+                batch = self.client.batch()
+                for doc_ref, data, merge, _, _ in items:
+                    batch.set(doc_ref, data, merge=merge)
+                batch.commit()
+                return True
+            except Exception as e:
+                print(f"⚠️  Firestore batch of {len(items)} failed (attempt {attempt + 1}): {e}")
+                time.sleep(0.5 * (2 ** attempt))
+        print(f"❌ Dropped Firestore batch of {len(items)} documents")
+        return False
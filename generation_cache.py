@@ -0,0 +1,117 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from sync_index import link_or_copy
+
+# Kết quả AI được lưu theo (hash ảnh gốc, style, model, kích thước), xóa cái ít dùng nhất khi đầy
+GENERATION_CACHE_DIR = os.environ.get("GENERATION_CACHE_DIR", "images/.cache/generated")
+GENERATION_CACHE_MAX_BYTES = int(os.environ.get("GENERATION_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+
+class GenerationCache:
+    """On-disk cache of generated images with size-based LRU eviction.
+
+    A hit turns a multi-second generation into a file link. Counters track
+    hits, misses and the generation time the hits saved. Recency lives in
+    a small SQLite index next to the files, not in their mtime: a cached
+    file is hard-linked to the published output, and touching the shared
+    inode would make the sync index rehash that output on every hit.
+    """
+
+    def __init__(self, cache_dir=GENERATION_CACHE_DIR, max_bytes=GENERATION_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.generate_seconds = 0.0
+        self.index = sqlite3.connect(os.path.join(cache_dir, ".recency.sqlite"), check_same_thread=False)
+        # Chỉ là gợi ý thứ tự xóa: mất vài lần ghi cuối khi crash cũng không sao, không cần fsync mỗi hit
+        self.index.execute("PRAGMA synchronous=OFF")
+        self.index.execute("CREATE TABLE IF NOT EXISTS recency (name TEXT PRIMARY KEY, used_at REAL NOT NULL)")
+        used = dict(self.index.execute("SELECT name, used_at FROM recency"))
+        # Nạp lại cache cũ theo thời gian dùng gần nhất; file chưa có trong index thì lấy mtime
+        names = [name for name in os.listdir(cache_dir) if name.endswith(".png")]
+        for name in sorted(names, key=lambda n: used.get(n) or os.path.getmtime(os.path.join(cache_dir, n))):
+            size = os.path.getsize(os.path.join(cache_dir, name))
+            self.entries[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(content_hash, style, model_version, output_size):
+        return hashlib.sha256(f"{content_hash}|{style}|{model_version}|{output_size}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def fetch(self, key, output_path):
+        """Put the cached result at output_path; False on a miss"""
+        name = f"{key}.png"
+        with self.lock:
+            if name not in self.entries:
+                self.misses += 1
+                return False
+            self.entries.move_to_end(name)
+            self.hits += 1
+            self._touch(name)
+        cached_path = self._path(key)
+        try:
+            link_or_copy(cached_path, output_path)
+            return True
+        except OSError:
+            # File cache bị xóa ngoài ý muốn: coi như miss
+            with self.lock:
+                self.hits -= 1
+                self.misses += 1
+                self.total_bytes -= self.entries.pop(name, 0)
+            return False
+
+    def store(self, key, output_path, generate_seconds):
+        """Add a freshly generated result"""
+        name = f"{key}.png"
+        link_or_copy(output_path, self._path(key))
+        size = os.path.getsize(self._path(key))
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.stores += 1
+            self.generate_seconds += generate_seconds
+            self._touch(name)
+            self._evict()
+
+    def _touch(self, name):
+        """Record a use of name (caller holds self.lock)"""
+        self.index.execute("INSERT OR REPLACE INTO recency (name, used_at) VALUES (?, ?)", (name, time.time()))
+        self.index.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.index.execute("DELETE FROM recency WHERE name = ?", (name,))
+            self.index.commit()
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            stored = len(self.entries)
+            lookups = self.hits + self.misses
+            average = self.generate_seconds / self.stores if self.stores else 0.0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": stored,
+                "bytes": self.total_bytes,
+                "saved_seconds": self.hits * average,
+            }
@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+# Một Session dùng chung cho mỗi process: giữ kết nối keep-alive thay vì mở TCP mới cho mỗi ảnh
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 16))
+HTTP_MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", 8))
+HTTP_TIMEOUT = (float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3)), float(os.environ.get("HTTP_READ_TIMEOUT", 30)))
+HTTP_BACKGROUND_WORKERS = int(os.environ.get("HTTP_BACKGROUND_WORKERS", 4))
+
+_lock = threading.Lock()
+_session = None
+_host_slots = {}
+_background = None
+
+def get_session():
+    """The shared pooled Session of this process.
+
+    Connection errors are retried with backoff for every method (nothing
+    was sent yet). 502/503/504 answers are retried only for idempotent
+    methods: a POST the server has read and answered is never sent twice.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            # allowed_methods không có POST: /api/broadcast, job gửi cho máy AI không bị lặp
+            retry = Retry(total=3, connect=3, read=0, status=2, backoff_factor=0.2,
+                          status_forcelist=(502, 503, 504), allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+def _slots_for(url):
+    host = urlsplit(url).netloc
+    with _lock:
+        slots = _host_slots.get(host)
+        if slots is None:
+            slots = _host_slots[host] = threading.BoundedSemaphore(HTTP_MAX_PER_HOST)
+        return slots
+
+def request(method, url, **kwargs):
+    """Session request with a default timeout and at most HTTP_MAX_PER_HOST concurrent calls per host"""
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    # Tính cả thời gian chờ slot của host, đó cũng là độ trễ caller phải chịu
+    with metrics.stage("http", endpoint=urlsplit(url).path):
+        with _slots_for(url):
+            return get_session().request(method, url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post_in_background(url, callback=None, **kwargs):
+    """Send a POST on a small background pool; returns a Future.
+
+    callback(response, error) runs on the pool thread when the call ends,
+    so the caller never waits for the network.
+    """
+    global _background
+    with _lock:
+        if _background is None:
+            _background = ThreadPoolExecutor(max_workers=HTTP_BACKGROUND_WORKERS, thread_name_prefix="http-bg")
+        executor = _background
+
+    def call():
+        try:
+            response = post(url, **kwargs)
+        except Exception as e:
+            if callback:
+                callback(None, e)
+            raise
+        if callback:
+            callback(response, None)
+        return response
+
+    return executor.submit(call)
+
+def benchmark(count=300, workers=8):
+    """Requests/sec against a local keep-alive stub: fresh connections vs the pooled Session"""
+    import socket
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Stub(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            # Header và body được ghi riêng; tắt Nagle để không dính delayed-ACK 40 ms
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"ok": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class StubServer(ThreadingHTTPServer):
+        request_queue_size = 256
+        daemon_threads = True
+
+    server = StubServer(("127.0.0.1", 0), Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/broadcast"
+    payload = {"type": "image_generated", "collection": "AIService", "filename": "ai-processed-0.png"}
+
+    def run(label, send, parallel):
+        started = time.perf_counter()
+        if parallel:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda _: send(), range(count)))
+        else:
+            for _ in range(count):
+                send()
+        elapsed = time.perf_counter() - started
+        print(f"📊 {label:<34} {count / elapsed:7.0f} req/s ({elapsed / count * 1000:.2f} ms/req)")
+
+    run("requests.post (new connection)", lambda: requests.post(url, json=payload, timeout=1), False)
+    run("pooled session", lambda: post(url, json=payload), False)
+    run(f"requests.post x{workers} threads", lambda: requests.post(url, json=payload, timeout=1), True)
+    run(f"pooled session x{workers} threads", lambda: post(url, json=payload), True)
+    started = time.perf_counter()
+    futures = [post_in_background(url, json=payload) for _ in range(count)]
+    queued = time.perf_counter() - started
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started
+    print(f"📊 {'post_in_background':<34} {count / elapsed:7.0f} req/s, caller blocked {queued / count * 1e6:.0f} µs/req")
+    server.shutdown()
+
+if __name__ == "__main__":
+    # python http_client.py [count] [threads]
+    benchmark(*(int(arg) for arg in sys.argv[1:3]))
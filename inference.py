@@ -0,0 +1,320 @@
+import io
+import os
+import sys
+import time
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+from PIL import Image
+
+# Các hàm cho chế độ micro-batch: gom nhiều ảnh thành một mảng NumPy, gọi model một lần
+
+# Bộ lọc cho bước resize cuối; sau draft/reduce ảnh chỉ còn lớn hơn đích dưới 2 lần nên bilinear là đủ
+AI_RESIZE_FILTER = Image.Resampling[os.environ.get("AI_RESIZE_FILTER", "bilinear").upper()]
+
+# Các mode đổi sang RGB được bằng NumPy (cắt kênh hoặc lặp kênh xám)
+NUMPY_MODES = ("RGB", "RGBA", "RGBX", "L", "LA")
+
+def fit_within(width: int, height: int, size: int):
+    """Size of the image scaled down (never up) to fit inside size x size, keeping the aspect ratio"""
+    scale = min(size / width, size / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def decode_scaled(image: Image.Image, size: int) -> Image.Image:
+    """Decode an opened image at (close to) the size it will be used at.
+
+    JPEGs are decoded by libjpeg at 1/2, 1/4 or 1/8 scale (DCT scaling),
+    picking the smallest scale that is still at least the target size, so
+    a 24 MP photo is never fully decoded. Other formats are shrunk by an
+    integer box reduce first; AI_RESIZE_FILTER only covers the last < 2x step.
+    """
+    target = fit_within(image.width, image.height, size)
+    if image.format == "JPEG" and target != image.size:
+        image.draft("RGB", target)
+    # Palette, CMYK, 16-bit...: không reduce/resize được đúng nghĩa, đổi sang RGB trước
+    if image.mode not in NUMPY_MODES:
+        image = image.convert("RGB")
+    factor = min(image.width // target[0], image.height // target[1])
+    if factor >= 2:
+        image = image.reduce(factor)
+    if image.size != target:
+        image = image.resize(target, AI_RESIZE_FILTER)
+    return image
+
+def load_into(input_path: str, size: int, out: np.ndarray):
+    """Decode into out (a size x size x 3 uint8 buffer), pad with black; returns (width, height)"""
+    with Image.open(input_path) as image:
+        image = decode_scaled(image, size)
+        width, height = image.size
+        # Đổi màu bằng NumPy ghi thẳng vào buffer: bỏ kênh alpha, xám thì lặp ra 3 kênh
+        pixels = np.asarray(image)
+        if image.mode in ("L", "LA"):
+            out[:height, :width] = (pixels if pixels.ndim == 2 else pixels[..., 0])[..., None]
+        else:
+            out[:height, :width] = pixels[..., :3]
+    out[height:] = 0
+    out[:height, width:] = 0
+    return width, height
+
+def load_for_batch(input_path: str, size: int):
+    """Decode one image, fit it inside size x size and pad it to exactly that shape"""
+    canvas = np.empty((size, size, 3), dtype=np.uint8)
+    return canvas, load_into(input_path, size, canvas)
+
+class FrameBuffer:
+    """Preallocated (N, size, size, 3) uint8 model input, reused from batch to batch"""
+
+    def __init__(self, size: int, capacity: int = 1):
+        self.size = size
+        self.pixels = np.empty((capacity, size, size, 3), dtype=np.uint8)
+
+    def frames(self, count: int) -> np.ndarray:
+        if count > len(self.pixels):
+            self.pixels = np.empty((count, self.size, self.size, 3), dtype=np.uint8)
+        return self.pixels[:count]
+
+_buffers = threading.local()
+
+def frame_buffer(size: int) -> FrameBuffer:
+    """The FrameBuffer of this thread for the given size"""
+    buffers = getattr(_buffers, "by_size", None)
+    if buffers is None:
+        buffers = _buffers.by_size = {}
+    if size not in buffers:
+        buffers[size] = FrameBuffer(size)
+    return buffers[size]
+
+def normalize(batch: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """uint8 (N, H, W, 3) → float32 0..1, written into out (a backend's reusable scratch) when the shape matches"""
+    if out is None or out.shape != batch.shape:
+        out = np.empty(batch.shape, dtype=np.float32)
+    return np.multiply(batch, np.float32(1.0 / 255.0), out=out)
+
+class ModelBackend(ABC):
+    """Interface of a model backend: load once, warm up, then process batches.
+
+    generate_batch takes and returns a uint8 array of shape (N, H, W, 3).
+    One instance is loaded per worker process and reused for every image.
+    A backend without generate_batch fails when it is instantiated.
+    """
+    name = "base"
+    version = "base-0"
+
+    def load(self):
+        pass
+
+    def warmup(self, size: int):
+        self.generate_batch(np.zeros((1, size, size, 3), dtype=np.uint8))
+
+    def memory_footprint(self) -> int:
+        """Bytes held by the loaded weights"""
+        return 0
+
+    @abstractmethod
+    def generate_batch(self, batch: np.ndarray) -> np.ndarray:
+        ...
+
+class SimulatorBackend(ModelBackend):
+    """The original placeholder: returns the input after a fixed 'inference' delay per call"""
+    name = "simulator"
+    version = "simulator-1"
+    delay = float(os.environ.get("AI_SIMULATED_SECONDS", 2))
+
+    def warmup(self, size: int):
+        # Không chờ 2 giây giả lập, nhưng làm trước mọi việc chỉ cần làm một lần: cấp phát buffer
+        # đầu vào của thread này, nạp plugin PIL và encoder PNG mà ảnh thật sẽ dùng
+        Image.init()
+        frames = frame_buffer(size).frames(1)
+        frames.fill(0)
+        Image.fromarray(self.generate_batch(frames, delay=0)[0]).save(io.BytesIO(), "PNG")
+
+    def generate_batch(self, batch: np.ndarray, delay: float = None) -> np.ndarray:
+        time.sleep(self.delay if delay is None else delay)
+        return batch
+
+class NumpyBackend(ModelBackend):
+    """CPU stand-in shaped like an exported ONNX model: fixed weights, vectorised ops"""
+    name = "numpy"
+    version = "numpy-standin-1"
+
+    def __init__(self):
+        self.weights = None
+        self.scratch = None
+
+    def load(self):
+        # "Trọng số": ma trận màu 3x3 và kernel làm mịn 3x3
+        self.weights = {
+            "color": np.array([[1.15, -0.10, -0.05],
+                               [-0.05, 1.10, -0.05],
+                               [-0.05, -0.10, 1.15]], dtype=np.float32),
+            "smooth": np.full((3, 3), 1.0 / 9.0, dtype=np.float32),
+        }
+
+    def memory_footprint(self) -> int:
+        return sum(weight.nbytes for weight in (self.weights or {}).values())
+
+    def generate_batch(self, batch: np.ndarray) -> np.ndarray:
+        self.scratch = x = normalize(batch, self.scratch)
+        x = np.clip(x @ self.weights["color"].T, 0.0, 1.0)
+        # Tích chập 3x3 bằng cách cộng các lát cắt đã dịch, không lặp từng pixel
+        padded = np.pad(x, ((0, 0), (1, 1), (1, 1), (0, 0)), mode="edge")
+        height, width = x.shape[1:3]
+        smooth = np.zeros_like(x)
+        for dy in range(3):
+            for dx in range(3):
+                smooth += self.weights["smooth"][dy, dx] * padded[:, dy:dy + height, dx:dx + width]
+        return cpu_standin_generate_batch((smooth * 255.0).astype(np.uint8))
+
+BACKENDS = {backend.name: backend for backend in (SimulatorBackend, NumpyBackend)}
+
+_backend = None
+
+def load_backend(name: str, size: int):
+    """Create, load and warm up the backend for this process; returns timing info"""
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown AI backend '{name}', choose one of {sorted(BACKENDS)}")
+    started = time.perf_counter()
+    backend = BACKENDS[name]()
+    backend.load()
+    loaded = time.perf_counter()
+    backend.warmup(size)
+    warmed = time.perf_counter()
+    _backend = backend
+    return {"pid": os.getpid(), "backend": name, "version": backend.version,
+            "load_seconds": loaded - started, "warmup_seconds": warmed - loaded,
+            "memory_bytes": backend.memory_footprint()}
+
+def get_backend() -> ModelBackend:
+    if _backend is None:
+        raise RuntimeError("No AI backend loaded in this process")
+    return _backend
+
+def ensure_backend(name: str, size: int) -> ModelBackend:
+    """The backend of this process, loading it on first use"""
+    if _backend is None:
+        load_backend(name, size)
+    return _backend
+
+def cpu_standin_generate_batch(batch: np.ndarray) -> np.ndarray:
+    """CPU stand-in for a real model: posterise colours and draw dark edges.
+
+    Takes and returns a uint8 array of shape (N, H, W, 3); every operation
+    runs over the whole batch at once, like a real batched forward pass.
+    """
+    x = batch.astype(np.float32) / 255.0
+    levels = 6
+    poster = np.round(x * (levels - 1)) / (levels - 1)
+    luminance = x @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    grad_y = np.abs(np.diff(luminance, axis=1, prepend=luminance[:, :1]))
+    grad_x = np.abs(np.diff(luminance, axis=2, prepend=luminance[:, :, :1]))
+    edges = np.clip((grad_x + grad_y) * 4.0, 0.0, 1.0)[..., None]
+    return (poster * (1.0 - edges) * 255.0).astype(np.uint8)
+
+def run_batch(input_paths, output_paths, size: int, generate_batch=None):
+    """Preprocess, run one generate_batch call and write every output.
+
+    Returns (list of per-image success flags, seconds spent). Images that
+    fail to decode are left out of the batch instead of failing it.
+    """
+    started = time.perf_counter()
+    results = [False] * len(input_paths)
+    # Giải mã thẳng vào buffer dùng lại của thread này, không np.stack bản sao
+    frames = frame_buffer(size).frames(len(input_paths))
+    shapes, indexes = [], []
+    for index, input_path in enumerate(input_paths):
+        try:
+            shape = load_into(input_path, size, frames[len(indexes)])
+        except Exception as e:
+            print(f"❌ Error loading {input_path}: {e}")
+            continue
+        shapes.append(shape)
+        indexes.append(index)
+    if indexes:
+        outputs = (generate_batch or get_backend().generate_batch)(frames[:len(indexes)])
+        for output, (width, height), index in zip(outputs, shapes, indexes):
+            try:
+                Image.fromarray(output[:height, :width]).save(output_paths[index], "PNG")
+                results[index] = True
+            except Exception as e:
+                print(f"❌ Error writing {output_paths[index]}: {e}")
+    return results, time.perf_counter() - started
+
+def benchmark(count: int = 32, size: int = 512, batch_sizes=(1, 4, 8)):
+    """Images/sec of run_batch with the NumPy backend for several batch sizes"""
+    info = load_backend("numpy", size)
+    print(f"🧠 numpy backend: load {info['load_seconds'] * 1000:.1f} ms, warmup {info['warmup_seconds'] * 1000:.1f} ms")
+    generate_batch = get_backend().generate_batch
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        inputs = []
+        for index in range(count):
+            path = os.path.join(folder, f"in-{index}.png")
+            Image.fromarray(rng.integers(0, 255, (size, size, 3), dtype=np.uint8)).save(path)
+            inputs.append(path)
+        outputs = [os.path.join(folder, f"out-{index}.png") for index in range(count)]
+        # Chạy nháp một lần để numpy/PIL nạp xong
+        run_batch(inputs[:1], outputs[:1], size, generate_batch)
+        for batch_size in batch_sizes:
+            started = time.perf_counter()
+            for start in range(0, count, batch_size):
+                run_batch(inputs[start:start + batch_size], outputs[start:start + batch_size], size, generate_batch)
+            elapsed = time.perf_counter() - started
+            print(f"📊 batch={batch_size:>2}: {count / elapsed:6.1f} images/s ({elapsed / count * 1000:.1f} ms/image)")
+
+def _decode_full(input_path: str, size: int):
+    """The previous preprocessing, kept for the before/after comparison: full decode, thumbnail, convert"""
+    image = Image.open(input_path)
+    if image.width > size or image.height > size:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)[None].astype(np.float32) / 255.0
+
+def benchmark_decode(paths=None, size: int = 1024, repeat: int = 3):
+    """ms/image of decode + resize + normalise, before and after decode-time downscaling.
+
+    Uses the given photos (e.g. images/Photobooth/*.jpg); without any,
+    synthetic 12 MP and 24 MP camera-like JPEGs are generated.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        if not paths:
+            paths = []
+            rng = np.random.default_rng(0)
+            for width, height in ((4000, 3000), (6000, 4000)):
+                # Gradient + nhiễu nhẹ: nén giống ảnh chụp hơn là nhiễu trắng
+                y, x = np.mgrid[0:height, 0:width]
+                pixels = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+                pixels = (pixels + rng.integers(0, 24, pixels.shape)).clip(0, 255).astype(np.uint8)
+                path = os.path.join(folder, f"camera-{width}x{height}.jpg")
+                Image.fromarray(pixels).save(path, "JPEG", quality=90)
+                paths.append(path)
+        scratch = None
+
+        def after(path):
+            nonlocal scratch
+            frames = frame_buffer(size).frames(1)
+            width, height = load_into(path, size, frames[0])
+            scratch = normalize(frames[:, :height, :width], scratch)
+
+        for path in paths:
+            with Image.open(path) as image:
+                label = f"{os.path.basename(path)} ({image.width}x{image.height} {image.format})"
+            timings = {}
+            for name, run in (("before", lambda: _decode_full(path, size)), ("after", lambda: after(path))):
+                run()
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    run()
+                timings[name] = (time.perf_counter() - started) / repeat * 1000
+            print(f"📊 {label}: before {timings['before']:.1f} ms, after {timings['after']:.1f} ms "
+                  f"({timings['before'] / timings['after']:.1f}x)")
+
+if __name__ == "__main__":
+    if "--decode" in sys.argv:
+        # python inference.py --decode [photo ...]
+        benchmark_decode([arg for arg in sys.argv[1:] if not arg.startswith("--")])
+    else:
+        # python inference.py [count] [size]
+        benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,183 @@
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+
+# Hàng đợi job lưu trên đĩa: crash giữa chừng không mất job, khởi động lại chỉ chạy tiếp job chưa xong
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "images/.job_queue.sqlite")
+DEFAULT_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+DONE_RETENTION = 7 * 24 * 3600
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+def worker_id():
+    """Lease owner name of this process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class JobQueue:
+    """Durable job queue in SQLite with at-least-once delivery.
+
+    A job moves queued -> leased -> done, or back to queued when its lease
+    expires or is released, until it has been leased max_attempts times
+    and ends up failed. enqueue() ignores a key that is already queued or
+    leased, and complete() only succeeds once per job, so redelivered or
+    duplicated results are harmless.
+    """
+
+    def __init__(self, db_path=JOB_QUEUE_PATH):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " queue TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " max_attempts INTEGER NOT NULL,"
+            " lease_owner TEXT,"
+            " lease_expires REAL,"
+            " error TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        # Một key chỉ có một job đang chờ/đang chạy; job đã xong không chặn lần enqueue sau
+        self.conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_key ON jobs (queue, key) WHERE state IN ('queued', 'leased')"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (queue, state, created_at)")
+        self.conn.commit()
+
+    def enqueue(self, queue, path, key=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Add a job; returns (job_id, created). An active job with the same key is returned as is."""
+        key = key or path
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO jobs (id, queue, key, path, state, max_attempts, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (uuid.uuid4().hex, queue, key, path, QUEUED, max_attempts, now, now),
+            )
+            self.conn.commit()
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE queue = ? AND key = ? AND state IN (?, ?)", (queue, key, QUEUED, LEASED)
+            ).fetchone()
+        return row["id"], cursor.rowcount == 1
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def lease_job(self, job_id, owner, seconds):
+        """Lease one specific job; None if it is done, failed or leased by someone else.
+
+        Re-leasing a job the owner already holds extends the lease without
+        counting another attempt.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET attempts = attempts + (state != ? OR lease_owner != ?),"
+                " state = ?, lease_owner = ?, lease_expires = ?, updated_at = ?"
+                " WHERE id = ? AND (state = ? OR (state = ? AND (lease_owner = ? OR lease_expires < ?)))",
+                (LEASED, owner, LEASED, owner, now + seconds, now, job_id, QUEUED, LEASED, owner, now),
+            )
+            self.conn.commit()
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone() if cursor.rowcount else None
+        return dict(row) if row else None
+
+    def lease(self, queue, owner, seconds, limit=1):
+        """Lease the oldest queued jobs of a queue"""
+        self.expire(queue)
+        with self.lock:
+            ids = [row["id"] for row in self.conn.execute(
+                "SELECT id FROM jobs WHERE queue = ? AND state = ? ORDER BY created_at LIMIT ?", (queue, QUEUED, limit))]
+        return [job for job in (self.lease_job(job_id, owner, seconds) for job_id in ids) if job]
+
+    def complete(self, job_id):
+        """Mark a job done; False if it already was (or is unknown/failed)"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, error = NULL, updated_at = ?"
+                " WHERE id = ? AND state IN (?, ?)", (DONE, time.time(), job_id, QUEUED, LEASED))
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+    def release(self, job_id, error=None):
+        """Give a leased job back to the queue; the attempt stays counted"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, error = ?, updated_at = ?"
+                " WHERE id = ? AND state = ?", (QUEUED, error, time.time(), job_id, LEASED))
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+    def requeue(self, job_id, error=None):
+        """Give a leased job back without counting the attempt: the failure was not the job's (e.g. a dead worker pool)"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), lease_owner = NULL, lease_expires = NULL,"
+                " error = ?, updated_at = ? WHERE id = ? AND state = ?", (QUEUED, error, time.time(), job_id, LEASED))
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, error=None):
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, error = ?, updated_at = ?"
+                " WHERE id = ? AND state IN (?, ?)", (FAILED, error, time.time(), job_id, QUEUED, LEASED))
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+    def retry(self, job_id, error=None):
+        """Release a leased job, or fail it once it has used its attempts; returns the new state or None"""
+        job = self.get(job_id)
+        if job is None or job["state"] != LEASED:
+            return None
+        if job["attempts"] >= job["max_attempts"]:
+            return FAILED if self.fail(job_id, error) else None
+        return QUEUED if self.release(job_id, error) else None
+
+    def expire(self, queue):
+        """Requeue (or fail) leased jobs whose lease ran out"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END,"
+                " lease_owner = NULL, lease_expires = NULL, error = 'lease expired', updated_at = ?"
+                " WHERE queue = ? AND state = ? AND lease_expires < ?", (FAILED, QUEUED, now, queue, LEASED, now))
+            self.conn.commit()
+
+    def recover(self, queue):
+        """After a restart: every lease of this queue belonged to the dead process, expire them now.
+
+        Returns the jobs left to run, oldest first.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET lease_expires = 0 WHERE queue = ? AND state = ?", (queue, LEASED))
+            self.conn.execute(
+                "DELETE FROM jobs WHERE queue = ? AND state = ? AND updated_at < ?",
+                (queue, DONE, time.time() - DONE_RETENTION))
+            self.conn.commit()
+        self.expire(queue)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM jobs WHERE queue = ? AND state = ? ORDER BY created_at", (queue, QUEUED)).fetchall()
+        return [dict(row) for row in rows]
+
+    def counts(self, queue):
+        with self.lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM jobs WHERE queue = ? GROUP BY state", (queue,))
+            counts = {state: 0 for state in (QUEUED, LEASED, DONE, FAILED)}
+            counts.update({state: count for state, count in rows})
+        return counts
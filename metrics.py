@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import uuid
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Đo thời gian từng bước của pipeline: histogram theo bucket cố định, đủ rẻ để luôn bật
+STATS_DUMP_DIR = os.environ.get("STATS_DUMP_DIR", "images/.stats")
+STATS_DUMP_INTERVAL = float(os.environ.get("STATS_DUMP_INTERVAL", 60))
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def trace_id(content_hash: str = None) -> str:
+    """ID that follows one image through every service.
+
+    Derived from the content hash when it is known, so TrackingFolder, the
+    API and the AI server all tag the same picture with the same ID.
+    """
+    return content_hash[:16] if content_hash else uuid.uuid4().hex[:16]
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def snapshot(self):
+        with self.lock:
+            return {_format_labels(key) or "total": value for key, value in self.values.items()}
+
+class Gauge(Counter):
+    """A value that is set, or read from a callback at scrape time (queue depths)"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+    def set_function(self, function, **labels):
+        with self.lock:
+            self.functions[_label_key(labels)] = function
+
+    def _read(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                pass
+        return values
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self._read().items()]
+
+    def snapshot(self):
+        return {_format_labels(key) or "value": value for key, value in self._read().items()}
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _quantile(self, counts, total, q):
+        """Estimate from the buckets, interpolating linearly inside the bucket"""
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        with self.lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self.series.items()}
+        samples = []
+        for key, (counts, total, count) in series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + "_bucket", key, cumulative, (("le", repr(bound)),)))
+            samples.append((self.name + "_bucket", key, count, (("le", "+Inf"),)))
+            samples.append((self.name + "_sum", key, total))
+            samples.append((self.name + "_count", key, count))
+        return samples
+
+    def snapshot(self):
+        with self.lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self.series.items()}
+        return {_format_labels(key) or "all": {
+                    "count": count, "mean": total / count if count else 0.0,
+                    "p50": self._quantile(counts, count, 0.50), "p95": self._quantile(counts, count, 0.95),
+                    "p99": self._quantile(counts, count, 0.99)}
+                for key, (counts, total, count) in series.items()}
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, help_text, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, *args)
+            return metric
+
+    def counter(self, name, help_text):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text):
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets)
+
+    def render(self):
+        """Prometheus text exposition format 0.0.4"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample in metric.samples():
+                name, key, value = sample[:3]
+                extra = sample[3] if len(sample) > 3 else ()
+                lines.append(f"{name}{_format_labels(key, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+registry = Registry()
+
+# Các metric dùng chung cho cả ba service
+STAGE_SECONDS = registry.histogram("itsc_stage_seconds", "Seconds spent in one pipeline stage")
+END_TO_END_SECONDS = registry.histogram("itsc_end_to_end_seconds",
+                                        "Seconds from a file landing on disk to its WebSocket broadcast")
+BYTES = registry.counter("itsc_bytes_total", "Bytes moved, by direction")
+EVENTS = registry.counter("itsc_events_total", "Pipeline events, by kind")
+QUEUE_DEPTH = registry.gauge("itsc_queue_depth", "Items waiting in an internal queue")
+STARTUP_SECONDS = registry.gauge("itsc_startup_seconds", "Seconds from the start of the service import to a startup milestone")
+
+def observe_stage(stage, seconds, **labels):
+    STAGE_SECONDS.observe(seconds, stage=stage, **labels)
+
+def stage(name, **labels):
+    """with stage("hash"): ... records the block's duration under itsc_stage_seconds{stage="hash"}"""
+    return STAGE_SECONDS.time(stage=name, **labels)
+
+def add_bytes(direction, amount):
+    BYTES.inc(amount, direction=direction)
+
+def count(kind, amount=1):
+    EVENTS.inc(amount, kind=kind)
+
+def track_queue(name, function):
+    QUEUE_DEPTH.set_function(function, queue=name)
+
+def startup(service, milestone, started):
+    """Print and record how long after started (a perf_counter value) a startup milestone was reached"""
+    seconds = time.perf_counter() - started
+    STARTUP_SECONDS.set(seconds, milestone=milestone)
+    print(f"⚡ {service}: {milestone} after {seconds * 1000:.0f} ms")
+    return seconds
+
+def dump_stats(service, directory=STATS_DUMP_DIR):
+    """Write the current metrics of this process to {directory}/{service}.json and return them"""
+    stats = {"service": service, "pid": os.getpid(), "time": time.time(), "metrics": registry.snapshot()}
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{service}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return stats
+
+def format_stats(stats):
+    """Short human summary of the stage histograms for the shutdown log"""
+    lines = [f"📈 {stats['service']} stage timings (p50 / p95 / p99):"]
+    for labels, summary in sorted(stats["metrics"].get(STAGE_SECONDS.name, {}).items()):
+        lines.append(f"   {labels:<40} n={summary['count']:<6} {summary['p50'] * 1000:8.1f} / "
+                     f"{summary['p95'] * 1000:8.1f} / {summary['p99'] * 1000:8.1f} ms")
+    return "\n".join(lines)
+
+def start_stats_dump(service, interval=STATS_DUMP_INTERVAL):
+    """Dump the stats every interval seconds from a daemon thread"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                dump_stats(service)
+            except OSError as e:
+                print(f"⚠️  Stats dump failed: {e}")
+
+    thread = threading.Thread(target=loop, name="stats-dump", daemon=True)
+    thread.start()
+    return thread
@@ -1,18 +1,29 @@
+import time
+BOOT_STARTED = time.perf_counter()
 import os
+import sys
 import json
-import firebase_admin
-from firebase_admin import credentials, firestore as admin_firestore, storage
-from fastapi import FastAPI, HTTPException, WebSocket, UploadFile, File
-from fastapi.responses import JSONResponse, FileResponse
+import hashlib
+import uuid
+from fastapi import FastAPI, HTTPException, WebSocket, UploadFile, File, Header
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.websockets import WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from typing import List
-from google.cloud.firestore import Query
 import threading
 import asyncio
-import time
+from collections import deque
 from pathlib import Path
 
+# Các module dùng chung (firestore_writer, ...) nằm ở thư mục gốc của project
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from firebase_clients import get_db, get_metadata_writer, server_timestamp
+import firebase_clients
+import metrics
+from image_cache import DerivativeCache
+from collection_view import CollectionView
+
 os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:8080"
 os.environ["STORAGE_EMULATOR_HOST"] = "http://localhost:9199"
 
@@ -25,16 +36,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
-cred = credentials.Certificate("serviceAccount.json")
-firebase_admin.initialize_app(cred, {
-    "projectId": "itsc",
-    "storageBucket": "itsc.appspot.com"
-})
-
-tracking = admin_firestore.client()
-bucket = storage.bucket()
+# Firestore chỉ được kết nối khi dùng lần đầu (get_db), server mở cổng ngay không phải chờ
 
 class FirestoreJSONEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -49,105 +54,540 @@ class FirestoreJSONEncoder(json.JSONEncoder):
             return str(obj)
         return super().default(obj)
 
+# Mỗi client có hàng đợi gửi riêng; client chậm không làm chậm người khác
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 256))
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", 5))
+# "drop_oldest": bỏ tin cũ nhất khi hàng đợi đầy, "disconnect": ngắt client đó
+WS_SLOW_CLIENT_POLICY = os.environ.get("WS_SLOW_CLIENT_POLICY", "drop_oldest")
+
+class ClientConnection:
+    """One WebSocket with a bounded send queue drained by its own writer task"""
+
+    def __init__(self, websocket: WebSocket, collection_name: str, manager: "ConnectionManager"):
+        self.websocket = websocket
+        self.collection_name = collection_name
+        self.manager = manager
+        self.queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.dropped = 0
+        self.task = asyncio.get_running_loop().create_task(self.writer())
+
+    def enqueue(self, message: str) -> bool:
+        """Queue a message without waiting; False means the client should be dropped"""
+        item = (message, time.perf_counter())
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            if WS_SLOW_CLIENT_POLICY == "disconnect":
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(item)
+            self.dropped += 1
+            self.manager.stats_for(self.collection_name)["dropped"] += 1
+            return True
+
+    async def writer(self):
+        try:
+            while True:
+                message, queued_at = await self.queue.get()
+                started = time.perf_counter()
+                await asyncio.wait_for(self.websocket.send_text(message), WS_SEND_TIMEOUT)
+                self.manager.record_send(self.collection_name, started - queued_at, time.perf_counter() - started)
+                metrics.add_bytes("ws_sent", len(message))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Gửi lỗi hoặc quá thời gian: bỏ client này và đóng socket để kiosk tự kết nối lại rồi resync
+            self.manager.disconnect(self)
+            code = 1013 if isinstance(e, asyncio.TimeoutError) else 1011
+            try:
+                await asyncio.wait_for(self.websocket.close(code=code), WS_SEND_TIMEOUT)
+            except Exception:
+                pass
+
+    async def close(self, code: int = 1000):
+        self.task.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: List[ClientConnection] = []
         self.collection_connections = {}
+        self.stats = {}
 
-    async def connect(self, websocket: WebSocket, collection_name: str = None):
+    async def connect(self, websocket: WebSocket, collection_name: str = None) -> ClientConnection:
+        """Accept the socket and start its writer; call register() to receive broadcasts"""
         await websocket.accept()
-        self.active_connections.append(websocket)
-        if collection_name:
-            if collection_name not in self.collection_connections:
-                self.collection_connections[collection_name] = []
-            self.collection_connections[collection_name].append(websocket)
-        print(f"New connection to {collection_name}. Total: {len(self.active_connections)}")
-
-    def disconnect(self, websocket: WebSocket, collection_name: str = None):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if collection_name and collection_name in self.collection_connections:
-            if websocket in self.collection_connections[collection_name]:
-                self.collection_connections[collection_name].remove(websocket)
+        return ClientConnection(websocket, collection_name, self)
+
+    def register(self, connection: ClientConnection):
+        self.active_connections.append(connection)
+        if connection.collection_name:
+            self.collection_connections.setdefault(connection.collection_name, []).append(connection)
+        print(f"New connection to {connection.collection_name}. Total: {len(self.active_connections)}")
+
+    def disconnect(self, connection: ClientConnection):
+        if connection in self.active_connections:
+            self.active_connections.remove(connection)
+        connections = self.collection_connections.get(connection.collection_name)
+        if connections and connection in connections:
+            connections.remove(connection)
+        if not connection.task.done() and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+
+    def stats_for(self, collection_name: str):
+        key = collection_name or "*"
+        if key not in self.stats:
+            self.stats[key] = {"messages": 0, "sent": 0, "dropped": 0, "slow_disconnects": 0,
+                               "queue_wait": deque(maxlen=1024), "send_latency": deque(maxlen=1024)}
+        return self.stats[key]
+
+    def record_send(self, collection_name: str, queue_wait: float, send_latency: float):
+        stats = self.stats_for(collection_name)
+        stats["sent"] += 1
+        stats["queue_wait"].append(queue_wait)
+        stats["send_latency"].append(send_latency)
+        metrics.observe_stage("ws_queue_wait", queue_wait)
+        metrics.observe_stage("ws_send", send_latency)
+
+    def _fan_out(self, message: str, connections: List[ClientConnection], collection_name: str = None):
+        # Payload đã là str, tất cả hàng đợi dùng chung một object, không serialise lại
+        self.stats_for(collection_name)["messages"] += 1
+        laggards = [connection for connection in connections if not connection.enqueue(message)]
+        for connection in laggards:
+            self.stats_for(connection.collection_name)["slow_disconnects"] += 1
+            self.disconnect(connection)
+            asyncio.get_running_loop().create_task(connection.close(code=1013))
 
     async def broadcast_to_collection(self, message: str, collection_name: str):
-        if collection_name in self.collection_connections:
-            for connection in self.collection_connections[collection_name].copy():
-                try:
-                    await connection.send_text(message)
-                except:
-                    self.collection_connections[collection_name].remove(connection)
-                    if connection in self.active_connections:
-                        self.active_connections.remove(connection)
+        self._fan_out(message, list(self.collection_connections.get(collection_name, ())), collection_name)
 
     async def broadcast_all(self, message: str):
-        for connection in self.active_connections.copy():
-            try:
-                await connection.send_text(message)
-            except:
-                self.active_connections.remove(connection)
+        self._fan_out(message, list(self.active_connections))
+
+    def metrics(self):
+        """Queue depth and send latency per collection"""
+        def percentile(samples, fraction):
+            if not samples:
+                return None
+            ordered = sorted(samples)
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+
+        result = {}
+        for key, stats in self.stats.items():
+            connections = self.active_connections if key == "*" else self.collection_connections.get(key, [])
+            depths = [connection.queue.qsize() for connection in connections]
+            result[key] = {
+                "connections": len(connections),
+                "messages": stats["messages"],
+                "sent": stats["sent"],
+                "dropped": stats["dropped"],
+                "slow_disconnects": stats["slow_disconnects"],
+                "queue_depth_total": sum(depths),
+                "queue_depth_max": max(depths, default=0),
+                "queue_wait_ms_p95": percentile(stats["queue_wait"], 0.95),
+                "send_latency_ms_p50": percentile(stats["send_latency"], 0.5),
+                "send_latency_ms_p95": percentile(stats["send_latency"], 0.95),
+                "send_latency_ms_max": percentile(stats["send_latency"], 1.0),
+            }
+        return result
 
 manager = ConnectionManager()
+metrics.registry.gauge("itsc_websocket_connections", "Open WebSocket connections").set_function(
+    lambda: len(manager.active_connections))
+metrics.track_queue("ws_send", lambda: sum(connection.queue.qsize() for connection in manager.active_connections))
+
+class BroadcastBridge:
+    """Hands broadcasts from any thread to one dispatcher task on the server loop.
+
+    Firestore listener callbacks run on the watch threads; they must not touch
+    the WebSockets themselves. They call publish_threadsafe(), which queues
+    the message on uvicorn's loop, and dispatch() does every send in order.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.task = self.loop.create_task(self.dispatch())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def publish(self, message: str, collection_name: str = None):
+        """Queue a broadcast from code already running on the server loop"""
+        self.queue.put_nowait((collection_name, message))
+
+    def publish_threadsafe(self, message: str, collection_name: str = None):
+        """Queue a broadcast from another thread (Firestore listeners)"""
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (collection_name, message))
+
+    async def dispatch(self):
+        while True:
+            collection_name, message = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                if collection_name:
+                    await manager.broadcast_to_collection(message, collection_name)
+                else:
+                    await manager.broadcast_all(message)
+            except Exception as e:
+                print(f"Broadcast error: {e}")
+            metrics.observe_stage("ws_fan_out", time.perf_counter() - started)
+
+bridge = BroadcastBridge()
+metrics.track_queue("broadcast_bridge", lambda: bridge.queue.qsize() if bridge.queue else 0)
+
+REPLAY_BUFFER_SIZE = 1000
+
+class ChangeLog:
+    """Numbers every delta per collection and keeps the last few for replay.
+
+    seq restarts at 0 with the process, so every ChangeLog has its own
+    epoch; a seq is only meaningful together with the epoch it came from.
+    """
+
+    def __init__(self, maxlen: int = REPLAY_BUFFER_SIZE):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.maxlen = maxlen
+        self.seq = {}
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def current(self, collection_name: str) -> int:
+        with self.lock:
+            return self.seq.get(collection_name, 0)
+
+    def append(self, collection_name: str, added, modified, removed) -> str:
+        with self.lock:
+            seq = self.seq.get(collection_name, 0) + 1
+            self.seq[collection_name] = seq
+            message = json.dumps({
+                "type": "changes",
+                "collection": collection_name,
+                "seq": seq,
+                "added": added,
+                "modified": modified,
+                "removed": removed,
+            }, cls=FirestoreJSONEncoder)
+            buffer = self.buffers.setdefault(collection_name, deque(maxlen=self.maxlen))
+            buffer.append((seq, message))
+            return message
+
+    def since(self, collection_name: str, seq: int):
+        """Messages after seq, or None when the buffer no longer reaches back that far"""
+        with self.lock:
+            current = self.seq.get(collection_name, 0)
+            if seq > current:
+                return None
+            buffer = self.buffers.get(collection_name, ())
+            if seq < current and (not buffer or buffer[0][0] > seq + 1):
+                return None
+            return [message for message_seq, message in buffer if message_seq > seq]
+
+change_log = ChangeLog()
 
 @app.websocket("/ws/{collection_name}")
-async def websocket_endpoint(websocket: WebSocket, collection_name: str):
-    await manager.connect(websocket, collection_name)
+async def websocket_endpoint(websocket: WebSocket, collection_name: str, since: int = None, epoch: str = None):
+    """Live deltas for a collection.
+
+    The first message is {"type": "hello", "epoch": e, "seq": n}. Reconnect
+    with ?since=<last seq seen>&epoch=<epoch of the hello> to get only the
+    missed deltas; if they are no longer buffered, or the server restarted
+    since (other epoch), a {"type": "resync"} message tells the client to
+    reload the page from /api/collections. Clients drop messages with
+    seq <= the last one they applied.
+    """
+    connection = await manager.connect(websocket, collection_name)
+    # hello + replay được xếp hàng trước khi đăng ký nhận broadcast, không có await ở giữa
+    # nên không thể lọt mất delta nào giữa replay và broadcast trực tiếp
+    connection.enqueue(json.dumps({"type": "hello", "collection": collection_name, "epoch": change_log.epoch,
+                                   "seq": change_log.current(collection_name)}))
+    if since is not None:
+        # seq của process trước (hoặc client cũ không gửi epoch) không so được với seq hiện tại
+        missed = change_log.since(collection_name, since) if epoch == change_log.epoch else None
+        if missed is None or len(missed) >= WS_SEND_QUEUE_SIZE:
+            connection.enqueue(json.dumps({"type": "resync", "collection": collection_name, "epoch": change_log.epoch,
+                                           "seq": change_log.current(collection_name)}))
+        else:
+            for message in missed:
+                connection.enqueue(message)
+    manager.register(connection)
     try:
         while True:
             await websocket.receive_text()
-    except WebSocketDisconnect:
-        manager.disconnect(websocket, collection_name)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: writer đã đóng socket vì gửi lỗi hoặc quá chậm
+        pass
+    finally:
+        manager.disconnect(connection)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+GALLERY_COLLECTIONS = ("Original", "AIService", "Photobooth")
+
+# Chỉ mục theo thời gian của từng collection, listener giữ cho luôn mới
+collection_views = {name: CollectionView(name) for name in GALLERY_COLLECTIONS}
+
+# read_time của snapshot gần nhất cho mỗi collection, dùng làm ETag
+collection_versions = {}
+
+def collection_etag(collection_name, *params):
+    version = collection_versions.get(collection_name)
+    if version is None:
+        return None
+    key = "|".join([collection_name, str(version)] + [str(p) for p in params])
+    return '"' + hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + '"'
+
+def stream_json_array(items, chunk_size=64 * 1024):
+    """Serialise a list of dicts into a JSON array, yielding ~64KB chunks"""
+    buffer = ["["]
+    size = 1
+    for index, item in enumerate(items):
+        part = ("," if index else "") + json.dumps(item, cls=FirestoreJSONEncoder)
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    buffer.append("]")
+    yield "".join(buffer)
+
+def query_page(collection_name, limit, cursor, descending, field_list):
+    """The page straight from Firestore (views not loaded yet, or outside the newest-N window)"""
+    from google.cloud.firestore import Query, FieldPath
+    tracking = get_db()
+    direction = Query.DESCENDING if descending else Query.ASCENDING
+    query = tracking.collection(collection_name).order_by("time", direction=direction) \
+        .order_by(FieldPath.document_id(), direction=direction)
+    if field_list:
+        query = query.select(field_list)
+    if cursor:
+        cursor_doc = tracking.collection(collection_name).document(cursor).get()
+        if not cursor_doc.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(cursor_doc)
+    
+    data = []
+    for doc in query.limit(limit).stream():
+        doc_data = doc.to_dict()
+        doc_data['id'] = doc.id
+        data.append(doc_data)
+    return data
+
+def fetch_collection(collection_name, max_docs):
+    """Cold load of a view: the whole collection, or its newest max_docs documents"""
+    from google.cloud.firestore import Query
+    query = get_db().collection(collection_name)
+    if max_docs:
+        query = query.order_by("time", direction=Query.DESCENDING).limit(max_docs)
+    docs = [(doc.id, doc.to_dict()) for doc in query.stream()]
+    return docs, bool(max_docs) and len(docs) == max_docs
 
 @app.get("/api/collections/{collection_name}")
-async def get_collection_data(collection_name: str, limit: int = None):
+async def get_collection_data(collection_name: str, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None,
+                              fields: str = None, order: str = "asc", if_none_match: str = Header(None)):
+    """One page of a collection ordered by time, id (?order=desc for newest first).
+
+    Pass the X-Next-Cursor header of a response back as ?cursor= for the next
+    page, and ?fields=url,name,time to only fetch those fields. Pages are
+    served from the listener-maintained view when it can answer them.
+
+    Documents without a `time` field are never listed: Firestore's
+    order_by("time") leaves them out and the view skips them the same way.
+    `python TrackingFolder.py --backfill-time` gives such legacy docs their
+    creation time once.
+    """
     try:
-        if limit:
-            docs = tracking.collection(collection_name).order_by("time", direction=Query.ASCENDING).limit(limit).stream()
-        else:
-            docs = tracking.collection(collection_name).stream()
-        data = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            data.append(doc_data)
-        return JSONResponse(
-            content=json.loads(json.dumps(data, cls=FirestoreJSONEncoder))
-        )
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        descending = order.lower() == "desc"
+        
+        etag = collection_etag(collection_name, limit, cursor, fields, descending)
+        if etag and if_none_match == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        data = None
+        started = time.perf_counter()
+        view = collection_views.get(collection_name)
+        if view is not None:
+            check_listener(collection_name)
+            try:
+                await view.ensure_loaded(lambda: fetch_collection(collection_name, view.max_docs))
+            except Exception as e:
+                print(f"⚠️  Cold load of {collection_name} failed: {e}")
+            data = view.page(limit, cursor, descending, field_list)
+        source = "view"
+        if data is None:
+            source = "firestore"
+            data = await run_in_threadpool(query_page, collection_name, limit, cursor, descending, field_list)
+        metrics.observe_stage("collection_page", time.perf_counter() - started, source=source)
+        
+        headers = {"Cache-Control": "no-cache"}
+        if etag:
+            headers["ETag"] = etag
+        if len(data) == limit:
+            headers["X-Next-Cursor"] = data[-1]['id']
+        return StreamingResponse(stream_json_array(data), media_type="application/json", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # -------------------Phần tử dưới này là để theo dõi các hoạt động thay đổi của dữ liệu-----------------------
 
+# Listener đang chạy của mỗi collection
+firestore_watches = {}
+
+def check_listener(collection_name):
+    """A listener that died leaves its view as an expiring cold snapshot and drops the ETag it maintained"""
+    view = collection_views.get(collection_name)
+    watch = firestore_watches.get(collection_name)
+    if view is None or not view.live or (watch is not None and watch.is_active):
+        return
+    print(f"⚠️  Listener for {collection_name} stopped, serving it from Firestore again")
+    view.detach()
+    collection_versions.pop(collection_name, None)
+
 def listen_to_firestore(collection_name):
+    initial = [True]
+
+    view = collection_views.get(collection_name)
+
     def on_snapshot(col_snapshot, changes, read_time):
-        docs = tracking.collection(collection_name).order_by("time", direction=Query.ASCENDING).limit(100).stream()
-        data = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            data.append(doc_data)
-        # Broadcast đến WebSocket
-        asyncio.run(manager.broadcast_to_collection(json.dumps(data, cls=FirestoreJSONEncoder), collection_name))
-
-    # Bắt đầu lắng nghe nào tình yêu của anh.
-    tracking.collection(collection_name).on_snapshot(on_snapshot)
-
-def start_firestore_listener_thread(collection_name):
-    listener_thread = threading.Thread(target=listen_to_firestore, args=(collection_name,), daemon=True)
-    listener_thread.start()
+        # Lần gọi đầu tiên là toàn bộ collection: nạp vào view, client đã lấy qua REST nên không broadcast
+        if initial[0]:
+            initial[0] = False
+            if view is not None:
+                view.load((doc.id, doc.to_dict()) for doc in col_snapshot)
+            collection_versions[collection_name] = read_time
+            return
+        added, modified, removed = [], [], []
+        for change in changes:
+            if change.type.name == "REMOVED":
+                removed.append(change.document.id)
+                continue
+            doc_data = change.document.to_dict()
+            doc_data['id'] = change.document.id
+            (added if change.type.name == "ADDED" else modified).append(doc_data)
+        if view is not None:
+            view.apply([(doc['id'], doc) for doc in added + modified], removed)
+        # ETag đổi sau khi view đã cập nhật, trang mới không bị cache với nội dung cũ
+        collection_versions[collection_name] = read_time
+        if not (added or modified or removed):
+            return
+        # Ảnh đi từ Undatabase qua TrackingFolder mang landedAt: đo end-to-end ngay trước khi fan-out
+        now = time.time()
+        for doc_data in added:
+            landed_at = doc_data.get('landedAt')
+            if isinstance(landed_at, (int, float)):
+                metrics.END_TO_END_SECONDS.observe(max(now - landed_at, 0.0), collection=collection_name)
+        # Chỉ gửi phần thay đổi đến WebSocket
+        message = change_log.append(collection_name, added, modified, removed)
+        bridge.publish_threadsafe(message, collection_name)
+
+    # Bắt đầu lắng nghe nào tình yêu của anh. on_snapshot tự chạy trên thread của Firestore.
+    return get_db().collection(collection_name).on_snapshot(on_snapshot)
 
 @app.on_event("startup")
 async def startup_event():
     # Lúc bắt đầu nó chạy ở phần này đầu tiên để nhảy vào các phần tử ở trên.
-    start_firestore_listener_thread("Original")  
-    start_firestore_listener_thread("AIService")
-    start_firestore_listener_thread("Photobooth")
+    bridge.start()
+    # Kết nối Firestore và đăng ký listener trên thread riêng: cổng mở ngay, view nạp xong thì trang mới lấy từ view
+    threading.Thread(target=start_listeners, name="firestore-listeners", daemon=True).start()
+    metrics.startup("APIcalling", "ready", BOOT_STARTED)
+
+def start_listeners():
+    started = time.perf_counter()
+    for collection_name in GALLERY_COLLECTIONS:
+        try:
+            firestore_watches[collection_name] = listen_to_firestore(collection_name)
+        except Exception as e:
+            print(f"❌ Listener for {collection_name} failed: {e}")
+    print(f"👂 Listening to {len(firestore_watches)} collections ({(time.perf_counter() - started) * 1000:.0f} ms)")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for watch in firestore_watches.values():
+        watch.unsubscribe()
+    await bridge.stop()
+    # Ghi nốt các document còn trong buffer
+    firebase_clients.close()
+
+#Khi server FastAPI chạy, nó đăng ký lắng nghe thay đổi của các Firestore collection.
+#Mỗi lần có thay đổi, phần thay đổi được chuyển thành JSON, đưa về event loop chính và broadcast tới các client WebSocket đang lắng nghe.
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+# Phần multipart ngoài nội dung file (boundary, header của part)
+MULTIPART_OVERHEAD = 64 * 1024
+
+class UploadSizeLimit:
+    """ASGI middleware that stops oversized /upload bodies before the multipart parser spools them.
+
+    Starlette writes the whole form to a temp file before the handler runs,
+    so the limit has to be enforced here: a Content-Length over the limit
+    is refused without reading the body, and a chunked body is cut off with
+    a 413 as soon as it goes over.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/upload/"):
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse({"detail": f"File larger than {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+            return await response(scope, receive, send)
+        received = 0
 
-#Khi server FastAPI chạy, nó sẽ tạo một thread riêng để lắng nghe thay đổi của Firestore collection "Original".
-#Mỗi lần có thay đổi, dữ liệu mới nhất sẽ được lấy ra, chuyển thành JSON, và broadcast tới các client WebSocket đang lắng nghe.
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=f"File larger than {MAX_UPLOAD_BYTES} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimit)
+
+def create_upload_file(upload_dir: Path, prefix: str, extension: str):
+    """Open a new {prefix}-{timestamp}.{ext} file exclusively so parallel uploads never share a name"""
+    timestamp = int(time.time() * 1000)
+    while True:
+        file_path = upload_dir / f"{prefix}-{timestamp}.{extension}"
+        try:
+            return open(file_path, "xb"), file_path
+        except FileExistsError:
+            timestamp += 1
+
+def write_chunk(f, digest, chunk: bytes):
+    digest.update(chunk)
+    f.write(chunk)
 
 @app.post("/upload/{collection}")
 async def upload_image(collection: str, image: UploadFile = File(...)):
+    started = time.perf_counter()
     try:
         # Ensure collection is valid
         if collection not in ["Original", "AIService", "Photobooth"]:
@@ -155,18 +595,33 @@ async def upload_image(collection: str, image: UploadFile = File(...)):
         
         # Create directory if not exists - use ../images from routes folder  
         upload_dir = Path(f"../images/{collection}")
-        upload_dir.mkdir(parents=True, exist_ok=True)
+        await run_in_threadpool(upload_dir.mkdir, parents=True, exist_ok=True)
         
         # Generate unique filename
-        timestamp = int(time.time() * 1000)
         file_extension = image.filename.split('.')[-1] if '.' in image.filename else 'png'
-        filename = f"{collection.lower()}-{timestamp}.{file_extension}"
-        file_path = upload_dir / filename
+        f, file_path = await run_in_threadpool(create_upload_file, upload_dir, collection.lower(), file_extension)
+        filename = file_path.name
         
-        # Save file locally
-        content = await image.read()
-        with open(file_path, "wb") as f:
-            f.write(content)
+        # Save file locally - chép từng chunk từ file tạm Starlette đã spool, hash tính dần, không giữ cả file trong RAM.
+        # Body quá lớn đã bị UploadSizeLimit chặn trước khi spool; kiểm tra dưới đây chỉ là lớp chặn cuối
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                chunk = await image.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"File larger than {MAX_UPLOAD_BYTES} bytes")
+                await run_in_threadpool(write_chunk, f, digest, chunk)
+        except BaseException:
+            await run_in_threadpool(f.close)
+            await run_in_threadpool(file_path.unlink, missing_ok=True)
+            raise
+        await run_in_threadpool(f.close)
+        metrics.add_bytes("upload_received", size)
+        trace_id = metrics.trace_id(digest.hexdigest())
         
         # For Firebase emulator, we'll store files locally and serve via static endpoint
         # Skip Firebase Storage upload to avoid auth issues with emulator
@@ -176,17 +631,23 @@ async def upload_image(collection: str, image: UploadFile = File(...)):
         doc_data = {
             "name": filename,
             "originalName": image.filename,
-            "size": len(content),
+            "size": size,
             "contentType": image.content_type,
-            "time": admin_firestore.SERVER_TIMESTAMP,
+            "contentHash": digest.hexdigest(),
+            "traceId": trace_id,
+            "time": server_timestamp(),
             "url": storage_url,
             "storagePath": f"{collection}/{filename}",
             "localPath": str(file_path)
         }
         
-        # Add to Firestore
-        doc_ref = tracking.collection(collection).document()
-        doc_ref.set(doc_data)
+        # Add to Firestore (batched, ID is generated client-side); chỉ báo thành công khi batch đã commit
+        doc_ref = get_db().collection(collection).document()
+        try:
+            await run_in_threadpool(get_metadata_writer().write, doc_ref, doc_data)
+        except BaseException:
+            await run_in_threadpool(file_path.unlink, missing_ok=True)
+            raise
         
         # Notify WebSocket clients
         broadcast_data = {
@@ -196,7 +657,9 @@ async def upload_image(collection: str, image: UploadFile = File(...)):
                 "id": doc_ref.id,
                 "name": filename,
                 "originalName": image.filename,
-                "size": len(content),
+                "size": size,
+                "contentHash": digest.hexdigest(),
+                "traceId": trace_id,
                 "contentType": image.content_type,
                 "time": int(time.time() * 1000),  # Use actual timestamp instead of SERVER_TIMESTAMP
                 "url": storage_url,
@@ -205,23 +668,31 @@ async def upload_image(collection: str, image: UploadFile = File(...)):
                 "uploadTime": time.time()
             }
         }
-        await manager.broadcast_to_collection(json.dumps(broadcast_data, cls=FirestoreJSONEncoder), collection)
+        bridge.publish(json.dumps(broadcast_data, cls=FirestoreJSONEncoder), collection)
+        metrics.observe_stage("upload", time.perf_counter() - started)
         
         return JSONResponse({
             "success": True,
             "message": f"Image uploaded to {collection}",
             "filename": filename,
             "id": doc_ref.id,
+            "traceId": trace_id,
             "url": storage_url,
             "localPath": str(file_path)
         })
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+derivative_cache = DerivativeCache()
+
 @app.get("/static/{collection}/{filename}")
-async def serve_static_file(collection: str, filename: str):
+async def serve_static_file(collection: str, filename: str, w: int = None, format: str = None, q: int = 80,
+                            if_none_match: str = Header(None)):
+    """Serve an image; ?w=320&format=webp&q=75 returns a cached resized variant"""
     try:
         # Ensure collection is valid
         if collection not in ["Original", "AIService", "Photobooth"]:
@@ -230,12 +701,27 @@ async def serve_static_file(collection: str, filename: str):
         # Build file path - use ../images from routes folder
         file_path = Path(f"../images/{collection}/{filename}")
         
-        if not file_path.exists():
+        if not file_path.is_file():
             raise HTTPException(status_code=404, detail="File not found")
         
         # Return file
-        return FileResponse(str(file_path))
+        if w is None and format is None:
+            return FileResponse(str(file_path), headers={"Cache-Control": "public, max-age=86400"})
         
+        try:
+            width, fmt, quality = DerivativeCache.parse(w, format, q, file_path.suffix)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # ETag tính từ stat của ảnh gốc: client đã có bản này thì trả 304, không render
+        etag = DerivativeCache.etag(file_path, width, fmt, quality)
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+        variant_path, etag, media_type = await derivative_cache.get(file_path, width, fmt, quality)
+        return FileResponse(str(variant_path), media_type=media_type, headers=headers)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Static file error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -249,7 +735,7 @@ async def health_check():
         
         for collection in collections:
             try:
-                docs = tracking.collection(collection).limit(1).stream()
+                docs = get_db().collection(collection).limit(1).stream()
                 count = len(list(docs))
                 status[collection] = {"status": "connected", "test_query": "success"}
             except Exception as e:
@@ -261,7 +747,10 @@ async def health_check():
             "firestore_emulator": "localhost:8080",
             "storage_emulator": "localhost:9199",
             "collections": status,
-            "websocket_connections": len(manager.active_connections)
+            "websocket_connections": len(manager.active_connections),
+            "websocket_metrics": manager.metrics(),
+            "derivative_cache": derivative_cache.stats(),
+            "collection_views": {name: view.stats() for name, view in collection_views.items()}
         })
     
     except Exception as e:
@@ -270,18 +759,32 @@ async def health_check():
             "error": str(e)
         }, status_code=500)
 
+@app.get("/api/ws-stats")
+async def websocket_stats():
+    """Per-collection WebSocket queue depth and send latency"""
+    return JSONResponse(manager.metrics())
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Stage histograms, queue depths and byte counters in the Prometheus text format"""
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.post("/api/broadcast")
 async def broadcast_message(message: dict):
     """Endpoint for AI model server to send WebSocket broadcasts"""
     try:
-        if "collection" in message:
-            await manager.broadcast_to_collection(json.dumps(message), message["collection"])
-        else:
-            await manager.broadcast_all(json.dumps(message))
+        # landedAt: lúc watcher thấy ảnh gốc lần đầu (đồng hồ của cùng máy)
+        landed_at = message.get("landedAt")
+        if isinstance(landed_at, (int, float)):
+            metrics.END_TO_END_SECONDS.observe(max(time.time() - landed_at, 0.0),
+                                               collection=message.get("collection") or "*")
+        bridge.publish(json.dumps(message), message.get("collection"))
         return {"success": True, "message": "Broadcast sent"}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+metrics.startup("APIcalling", "imported", BOOT_STARTED)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,184 @@
+import os
+import time
+import asyncio
+import datetime
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+# Bản sao trong bộ nhớ của mỗi collection, do listener Firestore cập nhật; 0 = giữ toàn bộ
+COLLECTION_VIEW_MAX_DOCS = int(os.environ.get("COLLECTION_VIEW_MAX_DOCS", 0))
+# Dữ liệu nạp nguội (không có listener giữ cho mới) chỉ được dùng trong chừng này giây
+COLLECTION_VIEW_COLD_TTL = float(os.environ.get("COLLECTION_VIEW_COLD_TTL", 30))
+
+def sort_key(doc_id, data):
+    """(time, id) in Firestore's order; None for documents without a time field (order_by("time") skips them)"""
+    if "time" not in data:
+        return None
+    value = data["time"]
+    # Firestore sắp theo kiểu trước: null < bool < số < timestamp < chuỗi; time = null vẫn có trong kết quả
+    if value is None:
+        rank = (0, 0)
+    elif isinstance(value, bool):
+        rank = (1, value)
+    elif isinstance(value, (int, float)):
+        rank = (2, value)
+    elif isinstance(value, datetime.datetime):
+        rank = (3, value.timestamp())
+    elif isinstance(value, str):
+        rank = (4, value)
+    else:
+        rank = (5, str(value))
+    return rank, doc_id
+
+class CollectionView:
+    """Time-ordered in-memory index of one collection.
+
+    The Firestore listener loads it from its first snapshot and applies
+    every later change, so a page read is a bisect and a slice; only then
+    is the view live. Before that, or once the listener is detached,
+    concurrent readers share a single cold fetch whose result is served
+    for cold_ttl seconds and then fetched again; a stale view answers
+    nothing. With max_docs only the newest max_docs documents are kept;
+    pages reaching past them return None and the caller asks Firestore.
+    Once truncated the view holds exactly the documents at or after its
+    floor (the oldest key it kept), so an upsert older than the floor is
+    dropped instead of opening a gap that a cursor page would skip over.
+    """
+
+    def __init__(self, name: str, max_docs: int = COLLECTION_VIEW_MAX_DOCS, cold_ttl: float = COLLECTION_VIEW_COLD_TTL):
+        self.name = name
+        self.max_docs = max_docs
+        self.cold_ttl = cold_ttl
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.keys = []
+        self.ready = False
+        self.live = False
+        self.loaded_at = 0.0
+        self.truncated = False
+        self.floor = None
+        self.loading = None
+        self.cold_fetches = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, docs, from_listener: bool = True, truncated: bool = False):
+        """Replace the contents with (doc_id, data) pairs; a cold fetch never overrides the listener"""
+        entries = {}
+        keys = []
+        for doc_id, data in docs:
+            key = sort_key(doc_id, data)
+            if key is None:
+                continue
+            entries[doc_id] = (key, data)
+            keys.append(key)
+        keys.sort()
+        with self.lock:
+            if self.live and not from_listener:
+                return
+            self.docs = entries
+            self.keys = keys
+            self.truncated = truncated
+            self.floor = keys[0] if truncated and keys else None
+            self._trim()
+            self.ready = True
+            self.live = from_listener
+            self.loaded_at = time.monotonic()
+
+    def detach(self):
+        """The listener stopped: keep the contents only as a cold snapshot that expires after cold_ttl"""
+        with self.lock:
+            if self.live:
+                self.live = False
+                self.loaded_at = time.monotonic()
+
+    def _fresh(self):
+        return self.ready and (self.live or time.monotonic() - self.loaded_at < self.cold_ttl)
+
+    def apply(self, upserts, removed):
+        """Apply listener changes: upserts is [(doc_id, data)], removed is [doc_id]"""
+        with self.lock:
+            for doc_id in removed:
+                self._remove(doc_id)
+            for doc_id, data in upserts:
+                self._remove(doc_id)
+                key = sort_key(doc_id, data)
+                if key is None:
+                    continue
+                # Cũ hơn những document đã bị bỏ: không thuộc cửa sổ newest-N nữa
+                if self.truncated and self.floor is not None and key < self.floor:
+                    continue
+                self.docs[doc_id] = (key, data)
+                insort(self.keys, key)
+            self._trim()
+
+    def _remove(self, doc_id):
+        entry = self.docs.pop(doc_id, None)
+        if entry is not None:
+            index = bisect_left(self.keys, entry[0])
+            if index < len(self.keys) and self.keys[index] == entry[0]:
+                del self.keys[index]
+
+    def _trim(self):
+        if self.max_docs and len(self.keys) > self.max_docs:
+            excess = len(self.keys) - self.max_docs
+            for _, doc_id in self.keys[:excess]:
+                del self.docs[doc_id]
+            del self.keys[:excess]
+            self.truncated = True
+            self.floor = self.keys[0]
+
+    def page(self, limit: int, cursor: str = None, descending: bool = False, fields=None):
+        """Up to limit documents after the cursor doc, or None when the view cannot answer"""
+        with self.lock:
+            if not self._fresh():
+                if self.ready:
+                    self.misses += 1
+                return None
+            if cursor is not None:
+                entry = self.docs.get(cursor)
+                if entry is None:
+                    # Cursor lạ hoặc đã bị đẩy ra khỏi cửa sổ newest-N: để Firestore xử lý
+                    self.misses += 1
+                    return None
+            if descending:
+                end = bisect_left(self.keys, entry[0]) if cursor is not None else len(self.keys)
+                keys = self.keys[max(0, end - limit):end][::-1]
+                complete = len(keys) == limit or not self.truncated
+            else:
+                start = bisect_right(self.keys, entry[0]) if cursor is not None else 0
+                keys = self.keys[start:start + limit]
+                # Trang đầu theo thứ tự tăng dần cần cả những document cũ đã bị bỏ
+                complete = cursor is not None or not self.truncated
+            if not complete:
+                self.misses += 1
+                return None
+            self.hits += 1
+            rows = [self.docs[doc_id][1] for _, doc_id in keys]
+            ids = [doc_id for _, doc_id in keys]
+        if fields:
+            return [{**{f: row[f] for f in fields if f in row}, "id": doc_id} for doc_id, row in zip(ids, rows)]
+        return [{**row, "id": doc_id} for doc_id, row in zip(ids, rows)]
+
+    async def ensure_loaded(self, fetch):
+        """(Re)load the view with fetch() -> (docs, truncated) unless it is live or freshly loaded; callers share the fetch"""
+        with self.lock:
+            if self._fresh():
+                return
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(self._cold_load(fetch))
+        await asyncio.shield(self.loading)
+
+    async def _cold_load(self, fetch):
+        try:
+            self.cold_fetches += 1
+            docs, truncated = await asyncio.get_running_loop().run_in_executor(None, fetch)
+            self.load(docs, from_listener=False, truncated=truncated)
+        finally:
+            self.loading = None
+
+    def stats(self):
+        with self.lock:
+            return {"documents": len(self.keys), "ready": self.ready, "live": self.live, "truncated": self.truncated,
+                    "max_docs": self.max_docs, "hits": self.hits, "misses": self.misses,
+                    "cold_fetches": self.cold_fetches}
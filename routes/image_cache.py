@@ -0,0 +1,154 @@
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image
+
+# Ảnh thu nhỏ (thumbnail) được tạo theo yêu cầu và lưu lại trên đĩa
+DERIVATIVE_CACHE_DIR = os.environ.get("DERIVATIVE_CACHE_DIR", "../images/.cache/derivatives")
+DERIVATIVE_CACHE_MAX_BYTES = int(os.environ.get("DERIVATIVE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+MIN_WIDTH = 16
+MAX_WIDTH = 4096
+
+FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "jpg": ("JPEG", "image/jpeg", "jpg"),
+    "png": ("PNG", "image/png", "png"),
+}
+
+def render_derivative(source_path: str, target_path: str, width: int, pil_format: str, quality: int):
+    """Decode, shrink and encode one variant (runs in a worker thread)"""
+    with Image.open(source_path) as image:
+        if width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            # JPEG có thể decode thẳng ở độ phân giải nhỏ hơn
+            image.draft("RGB", (width, height))
+            if image.size != (width, height):
+                image = image.resize((width, height), Image.Resampling.LANCZOS)
+        if pil_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA")
+        directory, name = os.path.split(target_path)
+        tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+        try:
+            image.save(tmp_path, pil_format, quality=quality)
+            os.replace(tmp_path, target_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+class DerivativeCache:
+    """On-disk LRU of resized/re-encoded variants with a total size cap.
+
+    Variants are keyed by the source file's size and mtime plus the
+    requested width, format and quality, so the key doubles as a strong
+    ETag. Concurrent requests for the same variant share one render.
+    """
+
+    def __init__(self, cache_dir: str = DERIVATIVE_CACHE_DIR, max_bytes: int = DERIVATIVE_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        # Nạp lại cache cũ, file sửa lâu nhất bị xóa trước
+        existing = [p for p in self.cache_dir.iterdir() if p.is_file() and not p.name.startswith(".") and not p.name.endswith(".tmp")]
+        for path in sorted(existing, key=lambda p: p.stat().st_mtime):
+            size = path.stat().st_size
+            self.entries[path.name] = size
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def parse(width, fmt, quality, source_suffix):
+        """Validate query parameters; returns (width, format key, quality)"""
+        fmt = (fmt or source_suffix.lstrip(".")).lower()
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+        if width is not None:
+            width = max(MIN_WIDTH, min(int(width), MAX_WIDTH))
+        quality = max(1, min(int(quality), 100))
+        return width, fmt, quality
+
+    @staticmethod
+    def variant_key(source_path: Path, width: int, fmt: str, quality: int):
+        """Cache key of a variant from the source stat alone"""
+        stat = source_path.stat()
+        return hashlib.sha1(
+            f"{source_path.name}|{stat.st_size}|{stat.st_mtime_ns}|{width}|{FORMATS[fmt][0]}|{quality}".encode("utf-8")
+        ).hexdigest()
+
+    @classmethod
+    def etag(cls, source_path: Path, width: int, fmt: str, quality: int):
+        """Strong ETag of a variant, known before rendering so If-None-Match never pays for a render"""
+        return f'"{cls.variant_key(source_path, width, fmt, quality)}"'
+
+    async def get(self, source_path: Path, width: int, fmt: str, quality: int):
+        """Return (path, etag, media_type) for a variant, rendering it if needed"""
+        pil_format, media_type, extension = FORMATS[fmt]
+        key = self.variant_key(source_path, width, fmt, quality)
+        name = f"{key}.{extension}"
+        path = self.cache_dir / name
+        etag = f'"{key}"'
+
+        if name in self.entries:
+            if path.exists():
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return path, etag, media_type
+            # File đã bị xóa ngoài ý muốn: bỏ entry cũ, trừ dung lượng trước khi render lại
+            self.total_bytes -= self.entries.pop(name)
+
+        # Đã có request khác đang render đúng variant này thì chờ chung
+        pending = self.inflight.get(name)
+        if pending is not None:
+            await asyncio.shield(pending)
+            if path.exists():
+                return path, etag, media_type
+            # Bị đẩy ra bởi một lần render khác trong lúc chờ
+            return await self.get(source_path, width, fmt, quality)
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.inflight[name] = future
+        try:
+            await loop.run_in_executor(None, render_derivative, str(source_path), str(path),
+                                       width or 10 ** 9, pil_format, quality)
+            size = path.stat().st_size
+            self.total_bytes -= self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.total_bytes += size
+            self._evict(keep=name)
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+            # Tránh cảnh báo "exception never retrieved" khi không ai chờ chung
+            future.exception()
+            raise
+        finally:
+            del self.inflight[name]
+        return path, etag, media_type
+
+    def _evict(self, keep=None):
+        """Drop least recently used variants until under max_bytes; keep (just rendered, newest) always stays"""
+        while self.total_bytes > self.max_bytes and self.entries and next(iter(self.entries)) != keep:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                (self.cache_dir / name).unlink()
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,220 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+# File index nằm cạnh thư mục images, không nằm trong các folder được serve
+SYNC_INDEX_PATH = os.environ.get("SYNC_INDEX_PATH", "images/.sync_index.sqlite")
+# Nội dung được lưu một lần dưới tên theo hash: object không bao giờ bị ghi đè bằng byte khác
+CONTENT_PREFIX = "blobs"
+
+def content_blob_path(sha256):
+    return f"{CONTENT_PREFIX}/{sha256}"
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file, read in chunks so big photos don't sit in memory"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def temp_path_for(target_path):
+    """Hidden, per-thread temp name next to `target_path`; scans skip dot-prefixed files"""
+    directory, name = os.path.split(target_path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+def link_or_copy(source_path, target_path):
+    """Hard-link identical content instead of storing a second copy on disk"""
+    os.makedirs(os.path.dirname(target_path) or '.', exist_ok=True)
+    tmp_path = temp_path_for(target_path)
+    try:
+        try:
+            os.link(source_path, tmp_path)
+        except OSError:
+            shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        # Không để lại file tạm dở dang trong thư mục được đồng bộ
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class SyncIndex:
+    """Local record of what has already been pushed to Storage.
+
+    Keyed by the storage path ("Original/abc.png") with the size, mtime and
+    content hash the file had when it was uploaded, so a sync pass only has
+    to stat the local folders and hash the files whose stat changed.
+    """
+
+    def __init__(self, db_path=SYNC_INDEX_PATH):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " synced_at REAL NOT NULL)"
+        )
+        # blob_path: object trong Storage thực sự chứa các byte này (khác path khi file bị trùng nội dung)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        if "blob_path" not in columns:
+            self.conn.execute("ALTER TABLE files ADD COLUMN blob_path TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        # Object theo hash đã upload xong: ghi trước khi nhả khoá InFlightHashes
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " sha256 TEXT PRIMARY KEY,"
+            " blob_path TEXT NOT NULL,"
+            " uploaded_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, path):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT size, mtime_ns, sha256, COALESCE(blob_path, path) FROM files WHERE path = ?", (path,)
+            ).fetchone()
+
+    def mark_synced(self, path, size, mtime_ns, sha256, blob_path=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256, synced_at, blob_path) VALUES (?, ?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, sha256, time.time(), blob_path or path),
+            )
+            self.conn.commit()
+
+    def mark_blob(self, sha256, blob_path):
+        """Record that the content-addressed object blob_path holds these bytes"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO blobs (sha256, blob_path, uploaded_at) VALUES (?, ?, ?)",
+                (sha256, blob_path, time.time()),
+            )
+            self.conn.commit()
+
+    def find_by_hash(self, sha256):
+        """Content-addressed Storage object that already holds these bytes, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT blob_path FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def local_path_by_hash(self, sha256):
+        """Storage path of an indexed images/ file with these bytes, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT path FROM files WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def forget(self, paths):
+        with self.lock:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+            self.conn.commit()
+
+    def paths_with_prefix(self, prefix):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def entries_with_prefix(self, prefix):
+        """[(path, sha256, blob_path)] of every indexed file under prefix"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT path, sha256, COALESCE(blob_path, path) FROM files WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+
+    def changed_files(self, local_folder, storage_folder):
+        """Return [(file_name, local_path, size, mtime_ns, sha256)] for new or modified files.
+
+        Files whose size and mtime match the index are skipped without being
+        read. A touched file with identical bytes only gets its stat refreshed.
+        Index entries for files that disappeared locally are dropped.
+        """
+        prefix = f"{storage_folder}/"
+        seen = set()
+        changed = []
+        with os.scandir(local_folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                key = prefix + entry.name
+                seen.add(key)
+                stat = entry.stat()
+                row = self.get(key)
+                if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                    continue
+                sha256 = file_digest(entry.path)
+                if row and row[2] == sha256:
+                    self.mark_synced(key, stat.st_size, stat.st_mtime_ns, sha256, row[3])
+                    continue
+                changed.append((entry.name, entry.path, stat.st_size, stat.st_mtime_ns, sha256))
+
+        stale = self.paths_with_prefix(prefix) - seen
+        if stale:
+            self.forget(stale)
+        return changed
+
+    def reconcile(self, storage_folder, remote_names):
+        """Drop index entries whose blob no longer exists in Storage so they get re-uploaded"""
+        prefix = f"{storage_folder}/"
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, COALESCE(blob_path, path) FROM files WHERE substr(COALESCE(blob_path, path), 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+            gone = [blob_path for (blob_path,) in self.conn.execute(
+                "SELECT blob_path FROM blobs WHERE substr(blob_path, 1, ?) = ?", (len(prefix), prefix)
+            ) if blob_path[len(prefix):] not in remote_names]
+            if gone:
+                self.conn.executemany("DELETE FROM blobs WHERE blob_path = ?", [(p,) for p in gone])
+                self.conn.commit()
+        missing = {path for path, blob_path in rows if blob_path[len(prefix):] not in remote_names}
+        if missing:
+            self.forget(missing)
+        return missing
+
+class InFlightHashes:
+    """Lets only one worker at a time handle a given content hash.
+
+    acquire() returns True to the first caller, which must call release();
+    later callers block until then and get False, meaning "look the hash up
+    again, the first worker has dealt with it".
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}
+
+    def acquire(self, sha256):
+        with self.lock:
+            event = self.events.get(sha256)
+            if event is None:
+                self.events[sha256] = threading.Event()
+                return True
+        event.wait()
+        return False
+
+    def try_acquire(self, sha256):
+        """Non-blocking acquire: True if the caller now owns the hash"""
+        with self.lock:
+            if sha256 in self.events:
+                return False
+            self.events[sha256] = threading.Event()
+            return True
+
+    def release(self, sha256):
+        with self.lock:
+            event = self.events.pop(sha256, None)
+        if event:
+            event.set()
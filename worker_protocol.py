@@ -0,0 +1,131 @@
+import io
+import os
+import json
+import http_client
+
+# Giao thức stream giữa ServerForAI và máy AI.
+# Cả request và response là một chuỗi frame: một dòng JSON (header, có "size")
+# rồi đúng "size" byte dữ liệu ảnh. Request: {"job_id", "filename", "size"} + ảnh gốc.
+# Response: {"job_id", "status": "done"|"error", "filename", "size", "error"?} + ảnh kết quả,
+# gửi ngay khi từng ảnh xong, không theo thứ tự request.
+FRAME_CONTENT_TYPE = "application/x-ndjson-frames"
+STREAM_PATH = "/image/stream"
+CHUNK_SIZE = 64 * 1024
+
+def frame_header(header: dict) -> bytes:
+    return json.dumps(header, separators=(",", ":")).encode("utf-8") + b"\n"
+
+def encode_frame(header: dict, payload: bytes = b"") -> bytes:
+    return frame_header(dict(header, size=len(payload))) + payload
+
+def iter_job_frames(jobs, chunk_size=CHUNK_SIZE):
+    """Request body for a batch of jobs, read from disk chunk by chunk"""
+    for job in jobs:
+        size = os.path.getsize(job["path"])
+        yield frame_header({"job_id": job["id"], "filename": os.path.basename(job["path"]), "size": size})
+        with open(job["path"], "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+def read_exact(stream, size):
+    parts = []
+    while size:
+        chunk = stream.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Stream ended inside a frame")
+        parts.append(chunk)
+        size -= len(chunk)
+    return b"".join(parts)
+
+def read_frames(stream):
+    """Yield (header, payload) from a binary stream until it ends"""
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        header = json.loads(line)
+        yield header, read_exact(stream, int(header.get("size", 0)))
+
+def stream_to_node(address, jobs, timeout=None):
+    """Send a batch of jobs to a node in one chunked request; yield results as the node finishes them"""
+    response = http_client.post(f"http://{address}{STREAM_PATH}", data=iter_job_frames(jobs),
+                                headers={"Content-Type": FRAME_CONTENT_TYPE}, stream=True,
+                                **({"timeout": timeout} if timeout else {}))
+    with response:
+        response.raise_for_status()
+        yield from read_frames(IterStream(response.iter_content(CHUNK_SIZE)))
+
+def deliver_stream(address, jobs, on_result, timeout=None):
+    """Stream jobs to a node, call on_result(job, header, payload) per result; returns unanswered jobs"""
+    waiting = {job["id"]: job for job in jobs}
+    for header, payload in stream_to_node(address, jobs, timeout):
+        job = waiting.pop(header.get("job_id"), None)
+        if job is not None:
+            on_result(job, header, payload)
+    return list(waiting.values())
+
+class IterStream:
+    """readline()/read() over an iterator of byte chunks (a streamed response body)"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def _fill(self):
+        chunk = next(self.chunks, b"")
+        self.buffer += chunk
+        return bool(chunk)
+
+    def readline(self):
+        while b"\n" not in self.buffer and self._fill():
+            pass
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size and self._fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+class ChunkedReader(io.RawIOBase):
+    """Decodes a Transfer-Encoding: chunked body for servers that hand over the raw socket file"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.remaining = 0
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.finished:
+            return 0
+        if self.remaining == 0:
+            size_line = self.raw.readline()
+            self.remaining = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if self.remaining == 0:
+                # Chunk cuối: bỏ qua trailer tới dòng trống
+                while self.raw.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                self.finished = True
+                return 0
+        data = self.raw.read(min(len(buffer), self.remaining))
+        if not data:
+            raise EOFError("Connection closed inside a chunk")
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        if self.remaining == 0:
+            self.raw.readline()
+        return len(data)
+
+def write_chunk(wfile, data: bytes):
+    """Write one HTTP/1.1 chunk (an empty one ends the body)"""
+    wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+    wfile.flush()